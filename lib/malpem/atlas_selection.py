@@ -0,0 +1,117 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Ranks the atlases by their similarity (NMI) to the target after the rigid alignment to MNI space, computed on a
+# downsampled MNI grid, so that the expensive nonrigid registration is only run for the most similar atlases.
+
+import os
+import time
+import numpy
+import malpem.mytools
+import malpem.imageio
+import malpem.registration
+
+# Voxel size of the MNI grid used for the similarity is multiplied by this factor
+downsampling = 2
+# Number of histogram bins for the normalised mutual information
+bins = 64
+
+
+def get_grid(output_dir):
+# DEFINITIONS
+    mni_template = os.path.join(malpem.mytools.__malpem_path__, "atlas", "mni",
+                                "icbm_avg_152_t1_tal_lin_masked_div10000.nii.gz")
+# END DEFINITIONS
+    tmp_dir = os.path.join(output_dir, "tmp", "atlas_selection/")
+    mni_grid = malpem.mytools.intermediate_file(tmp_dir, "mni_grid")
+
+    # Several resampling tasks might ask for the grid at the same time, it is written under a unique name first
+    if not os.path.isfile(mni_grid):
+        malpem.mytools.check_ex_dir(os.path.join(output_dir, "tmp"))
+        if not os.path.isdir(tmp_dir):
+            try:
+                os.mkdir(tmp_dir)
+            except OSError:
+                pass
+
+        data, image = malpem.imageio.load_image(mni_template)
+        tmp_grid = malpem.mytools.intermediate_file(tmp_dir, "mni_grid-" + str(os.getpid()))
+        malpem.imageio.save_image(data[::downsampling, ::downsampling, ::downsampling], image, tmp_grid,
+                                  grid=numpy.diag([downsampling, downsampling, downsampling, 1]))
+        os.rename(tmp_grid, mni_grid)
+
+    return mni_grid
+
+
+def get_resampled_file(name, output_dir):
+    return malpem.mytools.intermediate_file(os.path.join(output_dir, "tmp", "atlas_selection"), name)
+
+
+def resample(name, input_file, mni_dof, timing_file, output_dir):
+    # Resamples an image on the MNI grid (rigid/affine dof with the MNI template as target)
+    start_time = time.time()
+    mni_grid = get_grid(output_dir)
+    malpem.registration.transform(mni_grid, input_file, get_resampled_file(name, output_dir), mni_dof, "linear",
+                                  output_dir)
+
+    f = open(timing_file, 'a')
+    f.write("resampling " + name + "," + str(time.time() - start_time) + "\n")
+    f.close()
+    return True
+
+
+def nmi(target, source, mask):
+    histogram, target_edges, source_edges = numpy.histogram2d(target[mask], source[mask], bins=bins)
+    p_joint = histogram / histogram.sum()
+
+    def entropy(p):
+        p = p[p > 0]
+        return -numpy.sum(p * numpy.log(p))
+
+    return (entropy(p_joint.sum(axis=1)) + entropy(p_joint.sum(axis=0))) / entropy(p_joint)
+
+
+def select_atlases(atlas_names, count, selection_file, timing_file, output_dir):
+    task_name = "Atlas selection (" + str(count) + " of " + str(len(atlas_names)) + " atlases)"
+    start_time = malpem.mytools.start_task(task_name)
+
+    grid, grid_image = malpem.imageio.load_image(get_grid(output_dir))
+    target, target_image = malpem.imageio.load_image(get_resampled_file("target", output_dir))
+    mask = grid > 0
+
+    scores = []
+    for name in atlas_names:
+        source, source_image = malpem.imageio.load_image(get_resampled_file(name, output_dir))
+        scores.append(nmi(target, source, mask))
+
+    ranking = sorted(range(len(atlas_names)), key=lambda i: -scores[i])
+
+    f = open(selection_file, 'w')
+    f.write("Atlas,NMI,Rank,Selected\n")
+    for rank in range(len(ranking)):
+        i = ranking[rank]
+        f.write(atlas_names[i] + "," + str(scores[i]) + "," + str(rank + 1) + "," + str(int(rank < count)) + "\n")
+    f.close()
+
+    f = open(timing_file, 'a')
+    f.write("similarity," + str(time.time() - start_time) + "\n")
+    f.close()
+
+    malpem.mytools.ensure_file(selection_file, "")
+    malpem.mytools.finished_task(start_time, task_name)
+    return True
+
+
+def read_selection(selection_file):
+    # Returns the names of the selected atlases
+    selected = []
+    f = open(selection_file)
+    for row in f:
+        arr = row.strip().split(',')
+        if len(arr) == 4 and arr[3] == "1":
+            selected.append(arr[0])
+    f.close()
+    return selected
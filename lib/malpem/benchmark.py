@@ -0,0 +1,482 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Benchmarks of pipeline stages. Every run is executed in a separate process so that its wall time and peak memory
+# (including the binaries it calls) can be measured independently of the other runs.
+#
+# The orchestration benchmark runs the complete pipeline in a synthetic installation: phantom images instead of the
+# atlases and benchmark_stub.py instead of the binaries, with a configurable cost per binary. This measures the
+# overhead of the Python code, the scheduler and the process spawns without IRTK/ITK/NiftySeg.
+#
+# The profile benchmark runs the complete pipeline of real images with every speed/accuracy profile and compares
+# runtime and segmentations with those of the first profile (usually "accurate").
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import socket
+import subprocess
+import traceback
+import numpy
+import nibabel
+import malpem.mytools
+import malpem.cache
+import malpem.brain_extraction
+import malpem.label_fusion
+import malpem.registration
+import malpem.pincram
+import malpem.pipeline
+import malpem.profiles
+import malpem.scheduler
+import malpem.trace
+
+# Binaries replaced by the stub in the synthetic installation
+stub_binaries = [os.path.join("lib", "irtk", name) for name in ["ireg", "transformation", "dofcombine", "dofinvert",
+                                                                 "cl_pairwiseSymDOF", "cl_averageDOFs",
+                                                                 "cl_apply_mask", "cl_gaussian_fusion", "cl_malpem",
+                                                                 "display", "dilation", "erosion", "subtract",
+                                                                 "padding", "evaluation"]] + \
+                [os.path.join("lib", "niftyseg", "seg_maths"), os.path.join("lib", "niftyseg", "seg_stats"),
+                 os.path.join("lib", "itk", "N4"), os.path.join("lib", "pincram", "pincram-0.2.3_ireg.sh")]
+
+# Name of the MNI template in atlas/mni
+mni_template = "icbm_avg_152_t1_tal_lin_masked_div10000.nii.gz"
+
+
+def measure(function, args, log_file=""):
+    # Returns exit code, wall time [s] and peak resident memory [MB] of function(*args) run in a child process.
+    # The resource usage reported by wait4 includes the processes the child has waited for (e.g. binaries).
+    sys.stdout.flush()
+    start_time = time.time()
+    pid = os.fork()
+    if pid == 0:
+        if not log_file == "":
+            fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+        exitcode = 0
+        try:
+            function(*args)
+        except SystemExit as e:
+            exitcode = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            exitcode = 1
+        sys.stdout.flush()
+        os._exit(exitcode)
+
+    pid, status, rusage = os.wait4(pid, 0)
+    exitcode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+    return exitcode, time.time() - start_time, rusage.ru_maxrss / 1024.0
+
+
+def get_fusion_inputs(run_dir):
+    # Target and propagated atlases of an existing MALPEM output directory (run without --cleanup)
+    targets = glob.glob(os.path.join(run_dir, "*_N4_masked.nii.gz")) + \
+              glob.glob(os.path.join(run_dir, "*_noN4_masked.nii.gz"))
+    if not len(targets) == 1:
+        print "--- ERROR: No unique brain extracted image (*_N4_masked.nii.gz) in " + run_dir + " ---"
+        exit(1)
+
+    prop_dir = os.path.join(run_dir, "tmp", "propagate")
+    a_labels = sorted(glob.glob(os.path.join(prop_dir, "seg-*.nii")) +
+                      glob.glob(os.path.join(prop_dir, "seg-*.nii.gz")))
+    a_images_scaled = [os.path.join(prop_dir, "mri-" + os.path.basename(f)[4:]) for f in a_labels]
+    for f in a_images_scaled:
+        malpem.mytools.ensure_file(f, "propagated atlas")
+    if len(a_labels) == 0:
+        print "--- ERROR: No propagated atlases in " + prop_dir + " ---"
+        exit(1)
+
+    return targets[0], a_images_scaled, a_labels
+
+
+def run_fusion(fusion_engine, input_file, a_images_scaled, a_labels, output_dir):
+    malpem.label_fusion.engine = fusion_engine
+    malpem.label_fusion.lwf(input_file, a_images_scaled, a_labels, os.path.join(output_dir, "fusion.nii.gz"),
+                            os.path.join(output_dir, "probabilityMap"), output_dir)
+
+
+def compare_fusion(dir_a, dir_b):
+    # Fraction of voxels with identical labels and maximum absolute difference of the probability maps
+    fusion_a = nibabel.load(os.path.join(dir_a, "fusion.nii.gz")).get_data()
+    fusion_b = nibabel.load(os.path.join(dir_b, "fusion.nii.gz")).get_data()
+    agreement = numpy.mean(fusion_a == fusion_b)
+
+    max_difference = 0.0
+    for label in range(malpem.label_fusion.label_count):
+        prob_a = os.path.join(dir_a, "probabilityMap_" + str(label) + ".nii.gz")
+        prob_b = os.path.join(dir_b, "probabilityMap_" + str(label) + ".nii.gz")
+        if os.path.isfile(prob_a) and os.path.isfile(prob_b):
+            difference = numpy.abs(nibabel.load(prob_a).get_data() - nibabel.load(prob_b).get_data()).max()
+            max_difference = max(max_difference, float(difference))
+
+    return agreement, max_difference
+
+
+def benchmark_fusion(run_dir, output_dir, engines, repeats):
+    input_file, a_images_scaled, a_labels = get_fusion_inputs(run_dir)
+    print "Benchmarking label fusion of " + str(len(a_labels)) + " atlases: " + input_file
+
+    malpem.mytools.check_ex_dir(output_dir)
+    results_file = os.path.join(output_dir, "fusion_benchmark.csv")
+    f = open(results_file, 'w')
+    f.write("Engine,Run,Exit code,Wall time [s],Peak memory [MB]\n")
+
+    for fusion_engine in engines:
+        engine_dir = os.path.join(output_dir, fusion_engine)
+        malpem.mytools.check_ex_dir(engine_dir)
+        for run in range(repeats):
+            # Results of the previous run
+            for old_file in glob.glob(os.path.join(engine_dir, "*.nii.gz")):
+                os.remove(old_file)
+
+            exitcode, wall_time, peak_memory = measure(run_fusion, (fusion_engine, input_file, a_images_scaled,
+                                                                    a_labels, engine_dir))
+            f.write(fusion_engine + "," + str(run + 1) + "," + str(exitcode) + "," + str(wall_time) + "," +
+                    str(peak_memory) + "\n")
+            print "%-8s run %d: exit code %d, %.1f s, %.0f MB" % (fusion_engine, run + 1, exitcode, wall_time,
+                                                                  peak_memory)
+    f.close()
+
+    for i in range(1, len(engines)):
+        if not os.path.isfile(os.path.join(output_dir, engines[0], "fusion.nii.gz")) or \
+                not os.path.isfile(os.path.join(output_dir, engines[i], "fusion.nii.gz")):
+            print "No comparison of " + engines[0] + " and " + engines[i] + ": fusion failed"
+            continue
+        agreement, max_difference = compare_fusion(os.path.join(output_dir, engines[0]),
+                                                   os.path.join(output_dir, engines[i]))
+        print "%s vs. %s: %.4f%% identical labels, max. probability difference %g" % \
+              (engines[0], engines[i], 100 * agreement, max_difference)
+
+    return results_file
+
+
+def create_phantom(shape, seed, label_count, voxel_size=1.5):
+    # Ellipsoid "brain" divided into sectors and shells (labels) with label dependent intensities plus noise
+    rng = numpy.random.RandomState(seed)
+    coords = [(numpy.arange(n) - (n - 1) / 2.0) / (n / 2.0) for n in shape]
+    x, y, z = numpy.meshgrid(coords[0], coords[1], coords[2], indexing="ij")
+    radius = numpy.sqrt((x / 0.8) ** 2 + (y / 0.9) ** 2 + (z / 0.75) ** 2)
+    brain = radius < 1
+    octant = (x > 0) + 2 * (y > 0) + 4 * (z > 0)
+    labels = numpy.where(brain, (octant * 17 + (radius * 17).astype(int)) % (label_count - 1) + 1, 0)
+    image = brain * (200.0 + (labels % 7) * 40.0) + rng.normal(0, 10, shape)
+
+    affine = numpy.diag([voxel_size, voxel_size, voxel_size, 1])
+    affine[0:3, 3] = -voxel_size * (numpy.array(shape) - 1) / 2.0
+    return image.astype(numpy.float32), labels.astype(numpy.int16), affine
+
+
+def save_phantom(data, affine, filename):
+    image = nibabel.Nifti1Image(data, affine)
+    image.set_qform(affine, 1)
+    image.set_sform(affine, 1)
+    nibabel.save(image, filename)
+
+
+def create_install(install_dir, atlas_count, shape, costs):
+    # Synthetic MALPEM installation: stub binaries, phantom atlases/MNI template, links to the configuration files.
+    # Returns the phantom input image.
+    if os.path.isdir(install_dir):
+        shutil.rmtree(install_dir)
+
+    stub = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_stub.py")
+    for binary in stub_binaries:
+        if not os.path.isdir(os.path.join(install_dir, os.path.dirname(binary))):
+            os.makedirs(os.path.join(install_dir, os.path.dirname(binary)))
+        os.symlink(stub, os.path.join(install_dir, binary))
+    neutral_dof = os.path.join(install_dir, "lib", "pincram", "neutral.dof.gz")
+    shutil.copyfile(os.path.join(malpem.mytools.__malpem_path__, "lib", "pincram", "neutral.dof.gz"), neutral_dof)
+    os.symlink(os.path.abspath(os.path.join(malpem.mytools.__malpem_path__, "etc")), os.path.join(install_dir, "etc"))
+
+    config = dict(costs)
+    config["label_count"] = malpem.label_fusion.label_count
+    f = open(os.path.join(install_dir, "stub.json"), 'w')
+    json.dump(config, f)
+    f.close()
+
+    label_count = malpem.label_fusion.label_count
+    image, labels, affine = create_phantom(shape, 0, label_count)
+    input_file = os.path.join(install_dir, "phantom.nii.gz")
+    save_phantom(image, affine, input_file)
+    save_phantom(labels, affine, os.path.join(install_dir, "stub_labels.nii.gz"))
+
+    for sub_dir in ["mri_masked", "mri_masked_scaled", "labels", "mninorm"]:
+        os.makedirs(os.path.join(install_dir, "atlas", "nmm", sub_dir))
+    os.makedirs(os.path.join(install_dir, "atlas", "mni"))
+    for sub_dir in ["limages/full", "limages/margin-d5", "lmasks/full", "mninorm"]:
+        os.makedirs(os.path.join(install_dir, "atlas", "pincram", sub_dir))
+    save_phantom(image, affine, os.path.join(install_dir, "atlas", "mni", mni_template))
+
+    for i in range(atlas_count):
+        name = "phantom%03d" % (i + 1)
+        image, labels, affine = create_phantom(shape, i + 1, label_count)
+        save_phantom(image, affine, os.path.join(install_dir, "atlas", "nmm", "mri_masked", name + ".nii.gz"))
+        save_phantom(image / image.max(), affine, os.path.join(install_dir, "atlas", "nmm", "mri_masked_scaled",
+                                                               name + ".nii.gz"))
+        save_phantom(labels, affine, os.path.join(install_dir, "atlas", "nmm", "labels", name + ".nii.gz"))
+        shutil.copyfile(neutral_dof, os.path.join(install_dir, "atlas", "nmm", "mninorm", name + ".dof.gz"))
+
+        # pincram atlases m1 ... mN (used by the native pincram)
+        name = "m" + str(i + 1)
+        for sub_dir in ["full", "margin-d5"]:
+            save_phantom(image, affine, os.path.join(install_dir, "atlas", "pincram", "limages", sub_dir,
+                                                     name + ".nii.gz"))
+        save_phantom((labels > 0).astype(numpy.int16), affine,
+                     os.path.join(install_dir, "atlas", "pincram", "lmasks", "full", name + ".nii.gz"))
+        shutil.copyfile(neutral_dof, os.path.join(install_dir, "atlas", "pincram", "mninorm", name + ".dof.gz"))
+
+    return input_file
+
+
+def run_pipeline(install_dir, input_file, output_dir, threads, fusion_engine, resampling, create_report,
+                 pincram_engine="script", intermediate_format="nii.gz", pincram_postprocessing="numpy"):
+    # Complete pipeline of one subject in the synthetic installation (as bin/malpem, without cache)
+    malpem.mytools.__malpem_path__ = install_dir
+    malpem.cache.__cache_dir__ = ""
+    malpem.brain_extraction.engine = pincram_engine
+    malpem.pincram.postprocessing = pincram_postprocessing
+    malpem.label_fusion.engine = fusion_engine
+    malpem.label_fusion.fusion_threads = int(threads)
+    malpem.registration.resampling = resampling
+    malpem.mytools.__malpem_intermediate_ext__ = "." + intermediate_format
+
+    atlases = malpem.pipeline.get_atlases()
+    subject = malpem.pipeline.Subject(input_file, output_dir, False, atlases, pincram_threads=threads)
+    scheduler = malpem.scheduler.Scheduler(threads)
+    malpem.pipeline.add_subject_tasks(scheduler, subject, create_report=create_report)
+    success = scheduler.run()
+    malpem.pipeline.finish_subject(subject)
+    if not success:
+        exit(1)
+
+
+def get_pipeline_metrics(records, wall_time, threads, costs):
+    # Scheduler utilisation, time spent in commands vs. Python, spawn cost per command (command wall time minus the
+    # configured stub cost) and I/O of all tasks
+    tasks = [record for record in records if record["kind"] == "task"]
+    commands = [record for record in records if record["kind"] == "command"]
+
+    def get_work(name):
+        cost = costs.get(name, costs["default"])
+        return cost.get("sleep", 0) + cost.get("cpu", 0)
+
+    busy_time = sum(record["wall"] for record in tasks)
+    command_time = sum(record["wall"] for record in commands)
+    stub_work = sum(get_work(record["name"]) for record in commands)
+
+    metrics = {"tasks": len(tasks), "failed_tasks": len([record for record in tasks if record["exit_code"] != 0]),
+               "commands": len(commands), "busy_time": busy_time, "command_time": command_time,
+               "stub_work": stub_work, "python_time": busy_time - command_time,
+               "utilisation": busy_time / (wall_time * threads) if wall_time > 0 else 0.0,
+               "spawn_ms": 1000 * (command_time - stub_work) / len(commands) if len(commands) > 0 else 0.0,
+               "read_bytes": sum(record.get("read_bytes") or 0 for record in tasks),
+               "write_bytes": sum(record.get("write_bytes") or 0 for record in tasks), "stages": {}}
+    stages = malpem.trace.get_summary(records)
+    for stage in stages:
+        metrics["stages"][stage] = stages[stage]["last"] - stages[stage]["first"]
+    return metrics
+
+
+def get_pincram_differences(compare_file):
+    # Rankings and masks of the numpy and binary pincram postprocessing (log/pincram_postprocessing.csv)
+    differences = []
+    f = open(compare_file, 'r')
+    for line in f.readlines()[1:]:
+        values = line.strip().split(",")
+        if len(values) == 5:
+            differences.append({"level": values[0], "identical": values[1] == "True",
+                                "first_difference": int(values[2]) if values[2] else 0,
+                                "nmi_difference": float(values[3]), "mask_difference": int(values[4])})
+    f.close()
+    return differences
+
+
+def get_revision():
+    try:
+        process = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], cwd=malpem.mytools.__malpem_path__,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        revision = process.communicate()[0].strip()
+        if process.returncode == 0:
+            return revision
+    except OSError:
+        pass
+    return ""
+
+
+def get_previous(results, record):
+    # Last successful result of a previous benchmark with the same configuration
+    keys = ["atlases", "threads", "shape", "fusion", "resampling", "pincram", "pincram_postprocessing",
+            "intermediate_format", "report", "costs"]
+    for result in reversed(results):
+        if result["exit_code"] == 0 and all(result.get(key) == record[key] for key in keys):
+            return result
+    return None
+
+
+def benchmark_pipeline(output_dir, atlas_counts, thread_counts, repeats, shape, costs, fusion_engine="binary",
+                       resampling="binary", create_report=False, keep_runs=False, pincram_engine="script",
+                       intermediate_format="nii.gz", pincram_postprocessing="numpy"):
+    # Results are appended to <output_dir>/pipeline_benchmark.jsonl (one JSON record per run) together with date,
+    # host and revision, so that benchmarks of different versions can be compared
+    malpem.mytools.check_ex_dir(output_dir)
+    runs_dir = os.path.join(output_dir, "runs")
+    malpem.mytools.check_ex_dir(runs_dir)
+    results_file = os.path.join(output_dir, "pipeline_benchmark.jsonl")
+    results = []
+    if os.path.isfile(results_file):
+        results = malpem.trace.read_records(results_file)
+
+    costs = dict(costs)
+    if "default" not in costs:
+        costs["default"] = {"sleep": 0, "cpu": 0, "memory": 0}
+    revision = get_revision()
+
+    for atlas_count in atlas_counts:
+        print "Creating synthetic installation with " + str(atlas_count) + " atlases (" + \
+              "x".join(str(n) for n in shape) + " voxels)"
+        install_dir = os.path.join(output_dir, "install-" + str(atlas_count))
+        input_file = create_install(install_dir, atlas_count, shape, costs)
+
+        for threads in thread_counts:
+            for run in range(repeats):
+                run_dir = os.path.join(runs_dir, "a" + str(atlas_count) + "-t" + str(threads) + "-r" + str(run + 1))
+                if os.path.isdir(run_dir):
+                    shutil.rmtree(run_dir)
+                os.makedirs(run_dir)
+
+                exitcode, wall_time, peak_memory = measure(run_pipeline, (install_dir, input_file, run_dir, threads,
+                                                                          fusion_engine, resampling, create_report,
+                                                                          pincram_engine, intermediate_format,
+                                                                          pincram_postprocessing),
+                                                           run_dir + ".log")
+
+                trace_file = os.path.join(run_dir, "log", "trace.jsonl")
+                records = []
+                if os.path.isfile(trace_file):
+                    records = malpem.trace.read_records(trace_file)
+
+                record = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "host": socket.gethostname(),
+                          "revision": revision, "atlases": atlas_count, "threads": threads, "run": run + 1,
+                          "shape": list(shape), "fusion": fusion_engine, "resampling": resampling,
+                          "pincram": pincram_engine, "pincram_postprocessing": pincram_postprocessing,
+                          "intermediate_format": intermediate_format,
+                          "report": create_report, "costs": costs,
+                          "exit_code": exitcode, "wall_time": wall_time, "peak_memory_mb": peak_memory}
+                record.update(get_pipeline_metrics(records, wall_time, threads, costs))
+                compare_file = os.path.join(run_dir, "log", "pincram_postprocessing.csv")
+                if os.path.isfile(compare_file):
+                    record["pincram_differences"] = get_pincram_differences(compare_file)
+                previous = get_previous(results, record)
+
+                f = open(results_file, 'a')
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+                f.close()
+
+                print "%3d atlases, %2d threads, run %d: exit code %d, %.1f s%s, utilisation %.0f%%, " \
+                      "spawn %.1f ms/command, Python %.1f s, %.0f MB written" % \
+                      (atlas_count, threads, run + 1, exitcode, wall_time,
+                       " (previous: %.1f s, %s)" % (previous["wall_time"], previous["revision"] or previous["date"])
+                       if previous is not None else "", 100 * record["utilisation"], record["spawn_ms"],
+                       record["python_time"], record["write_bytes"] / 1024.0 ** 2)
+
+                for level in record.get("pincram_differences", []):
+                    print "    pincram %s: ranking %s, max. NMI difference %g, %d mask voxel(s) differ" % \
+                          (level["level"], "identical" if level["identical"] else
+                           "differs from rank " + str(level["first_difference"]), level["nmi_difference"],
+                           level["mask_difference"])
+
+                if exitcode == 0 and not keep_runs:
+                    shutil.rmtree(run_dir)
+
+    return results_file
+
+
+def run_profile(profile, input_file, output_dir, threads):
+    # Complete pipeline of one subject with a speed/accuracy profile (as bin/malpem, without cache)
+    malpem.profiles.profile = profile
+    malpem.cache.__cache_dir__ = ""
+    malpem.label_fusion.fusion_threads = int(threads)
+
+    atlases = malpem.pipeline.get_atlases()
+    subject = malpem.pipeline.Subject(input_file, output_dir, False, atlases, pincram_threads=threads)
+    scheduler = malpem.scheduler.Scheduler(threads)
+    malpem.pipeline.add_subject_tasks(scheduler, subject, create_report=False)
+    success = scheduler.run()
+    malpem.pipeline.finish_subject(subject)
+    if not success:
+        exit(1)
+
+
+def get_labels(segmentation, binarise):
+    data = nibabel.load(segmentation).get_data()
+    if binarise:
+        return (data > 0).astype(numpy.int64).ravel()
+    return numpy.asarray(data, dtype=numpy.int64).ravel()
+
+
+def get_dice(segmentation_a, segmentation_b, binarise=False):
+    # Mean Dice overlap over all labels (except background) of both segmentations
+    labels_a = get_labels(segmentation_a, binarise)
+    labels_b = get_labels(segmentation_b, binarise)
+    count = max(labels_a.max(), labels_b.max()) + 1
+    size_a = numpy.bincount(labels_a, minlength=count)
+    size_b = numpy.bincount(labels_b, minlength=count)
+    overlap = numpy.bincount(labels_a[labels_a == labels_b], minlength=count)
+
+    present = (size_a + size_b) > 0
+    present[0] = False
+    if not present.any():
+        return 1.0
+    return float(numpy.mean(2.0 * overlap[present] / (size_a[present] + size_b[present])))
+
+
+def benchmark_profiles(input_files, output_dir, profiles, threads):
+    # Wall time, peak memory and Dice overlap (segmentation and brain mask) of every profile and subject, the first
+    # profile is the reference
+    malpem.mytools.check_ex_dir(output_dir)
+    results_file = os.path.join(output_dir, "profile_benchmark.csv")
+    f = open(results_file, 'w')
+    f.write("Subject,Profile,Exit code,Wall time [s],Peak memory [MB],Speedup,Dice segmentation,Dice brain mask\n")
+
+    for input_file in input_files:
+        base_file = malpem.mytools.nifty_basename(input_file)
+        reference_time = None
+        reference_dir = None
+        for profile in profiles:
+            malpem.mytools.check_ex_dir(os.path.join(output_dir, profile))
+            run_dir = os.path.join(output_dir, profile, base_file)
+            if os.path.isdir(run_dir):
+                shutil.rmtree(run_dir)
+            malpem.mytools.check_ex_dir(run_dir)
+
+            exitcode, wall_time, peak_memory = measure(run_profile, (profile, input_file, run_dir, threads),
+                                                       os.path.join(run_dir, "benchmark.log"))
+            if reference_time is None:
+                reference_time = wall_time
+                reference_dir = run_dir
+
+            dice_segmentation = ""
+            dice_mask = ""
+            if exitcode == 0 and os.path.isfile(os.path.join(reference_dir, base_file + "_MALPEM.nii.gz")):
+                dice_segmentation = get_dice(os.path.join(reference_dir, base_file + "_MALPEM.nii.gz"),
+                                             os.path.join(run_dir, base_file + "_MALPEM.nii.gz"))
+                dice_mask = get_dice(os.path.join(reference_dir, base_file + "_mask.nii.gz"),
+                                     os.path.join(run_dir, base_file + "_mask.nii.gz"), True)
+
+            speedup = reference_time / wall_time if wall_time > 0 else 0.0
+            f.write(",".join([base_file, profile, str(exitcode), str(wall_time), str(peak_memory), str(speedup),
+                              str(dice_segmentation), str(dice_mask)]) + "\n")
+            f.flush()
+            print "%-20s %-9s exit code %d, %.0f s (x%.1f), %.0f MB, Dice %s" % (base_file, profile, exitcode,
+                                                                                wall_time, speedup, peak_memory,
+                                                                                dice_segmentation or "-")
+    f.close()
+    return results_file
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Stand-in for the external binaries (IRTK, NiftySeg, N4, pincram) in the synthetic installation created by
+# malpem.benchmark. It is linked under the name of every binary (e.g. <install>/lib/irtk/ireg), spends the time and
+# memory configured for this binary in <install>/stub.json and creates the output files the pipeline expects by
+# copying one of its inputs:
+#   {"default": {"sleep": 0, "cpu": 0, "memory": 0}, "ireg": {"sleep": 2.0, "cpu": 0.5, "memory": 200},
+#    "label_count": 139}
+# (sleep and cpu in seconds, memory in MB)
+
+import os
+import sys
+import json
+import time
+import gzip
+import zlib
+import shutil
+
+
+def copy(source, output):
+    # Copies a file and (de)compresses it if only one of both names ends with .gz
+    if source.endswith(".gz") == output.endswith(".gz"):
+        shutil.copyfile(source, output)
+        return
+
+    if source.endswith(".gz"):
+        f_in = gzip.open(source, "rb")
+        f_out = open(output, "wb")
+    else:
+        f_in = open(source, "rb")
+        f_out = gzip.open(output, "wb")
+    shutil.copyfileobj(f_in, f_out)
+    f_in.close()
+    f_out.close()
+
+
+def get_option(args, option):
+    return args[args.index(option) + 1]
+
+
+def get_outputs(name, args, root, label_count):
+    # (source, output) pairs of every binary, same argument order as the calls in lib/malpem
+    neutral_dof = os.path.join(root, "lib", "pincram", "neutral.dof.gz")
+    labels = os.path.join(root, "stub_labels.nii.gz")
+
+    if name == "ireg":
+        return [(neutral_dof, get_option(args, "-dofout"))]
+    if name in ["dofcombine", "cl_pairwiseSymDOF"]:
+        return [(args[0], args[2])]
+    if name in ["dofinvert", "transformation", "cl_apply_mask", "dilation", "erosion"]:
+        return [(args[0], args[1])]
+    if name in ["subtract", "padding"]:
+        return [(args[0], args[2])]
+    if name == "cl_averageDOFs":
+        return [(args[1], args[-1])]
+    if name == "seg_maths":
+        return [(args[0], args[-1])]
+    if name == "N4":
+        return [(get_option(args, "-i"), get_option(args, "-o"))]
+    if name == "pincram-0.2.3_ireg.sh":
+        return [(args[0], get_option(args, "-result"))]
+    if name == "cl_gaussian_fusion":
+        # input sigma count (labels image)*count prob_base output
+        outputs = [(labels, args[-1])]
+        for label in range(label_count):
+            outputs.append((args[0], args[-2] + "_" + str(label) + ".nii.gz"))
+        return outputs
+    if name == "cl_malpem":
+        # input count priors*count output ... -posteriors prob_dir
+        count = int(args[1])
+        prob_dir = get_option(args, "-posteriors")
+        outputs = [(labels, args[2 + count])]
+        for label in range(count):
+            outputs.append((args[2 + label], os.path.join(prob_dir, "posteriors_" + str(label) + ".nii.gz")))
+        return outputs
+
+    # e.g. display: no output (the report uses its placeholder)
+    return []
+
+
+def main(argv):
+    name = os.path.basename(argv[0])
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(argv[0]))))
+
+    f = open(os.path.join(root, "stub.json"))
+    config = json.load(f)
+    f.close()
+    cost = config.get(name, config["default"])
+
+    # Resident memory: every page of the buffer is touched
+    memory = bytearray(int(cost.get("memory", 0) * 1024 * 1024))
+    memory[::4096] = b"\x01" * len(range(0, len(memory), 4096))
+
+    end_time = time.time() + cost.get("cpu", 0)
+    x = 0
+    while time.time() < end_time:
+        for i in range(10000):
+            x += i * i
+
+    time.sleep(cost.get("sleep", 0))
+
+    if name == "evaluation":
+        # Similarity of the source image, differs between the atlases
+        print "NMI: %.4f" % (1 + (zlib.crc32(os.path.basename(argv[2])) & 0xffff) / 65536.0)
+
+    for source, output in get_outputs(name, argv[1:], root, config.get("label_count", 139)):
+        copy(source, output)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -5,11 +5,26 @@
 #         see license file in project root directory
 
 import os.path
+import shutil
+import numpy
 import malpem.mytools
+import malpem.imageio
+import malpem.cache
+import malpem.profiles
 
-def N4(input_file, output_file, field_strength, input_mask, output_dir):
+# Second (masked) bias correction: a probe with few iterations on a coarser grid decides whether the full pass is
+# run, it is skipped if the probe changes the brain by less than refine_threshold (mean relative intensity change)
+refine_threshold = 0.005
+probe_iterations = "20x10"
+probe_shrink = 4
+
+
+def N4(input_file, output_file, field_strength, input_mask, output_dir, iterations="", shrink=2):
 # DEFINITIONS
     binary_N4 = os.path.join(malpem.mytools.__malpem_path__, "lib", "itk", "N4")
+    if iterations == "":
+        iterations = malpem.profiles.get("n4_iterations")
+    convergence = "-c [" + iterations + ",0.0000001]"
 # END DEFINITIONS
 
     task_name = "N4 bias correction"
@@ -21,36 +36,77 @@ def N4(input_file, output_file, field_strength, input_mask, output_dir):
     malpem.mytools.check_ex_dir(log_dir)
     logfile = os.path.join(log_dir, "N4-" + malpem.mytools.nifty_basename(input_file) + ".log")
 
+    tmp_output = malpem.mytools.tmp_file(output_file)
     if input_mask == "":
         if field_strength == '1.5T':
-            parameters_N4 = " -d 3 -i " + input_file + " -o " + output_file + " -s 2 -c [50x40x30x20,0.0000001] " \
-                                                                              "-b [200,3,0.0,0.5] -t [0.15,0.01,200]"
+            parameters_N4 = " -d 3 -i " + input_file + " -o " + tmp_output + " -s " + str(shrink) + " " + convergence + \
+                                                                              " -b [200,3,0.0,0.5] -t [0.15,0.01,200]"
         elif field_strength == '3T':
-            parameters_N4 = " -d 3 -i " + input_file + " -o " + output_file + " -s 2 -c [50x40x30x20,0.0000001] " \
-                                                                              "-b [75,3,0.0,0.5] -t [0.15,0.01,200]"
+            parameters_N4 = " -d 3 -i " + input_file + " -o " + tmp_output + " -s " + str(shrink) + " " + convergence + \
+                                                                              " -b [75,3,0.0,0.5] -t [0.15,0.01,200]"
         else:
             print "Warning N4: Unknown field strength defaulting to 1.5T parameters"
-            parameters_N4 = " -d 3 -i " + input_file + " -o " + output_file + " -s 2 -c [50x40x30x20,0.0000001] " \
-                                                                              "-b [200,3,0.0,0.5] -t [0.15,0.01,200]"
+            parameters_N4 = " -d 3 -i " + input_file + " -o " + tmp_output + " -s " + str(shrink) + " " + convergence + \
+                                                                              " -b [200,3,0.0,0.5] -t [0.15,0.01,200]"
     else:
         if field_strength == '1.5T':
-            parameters_N4 = " -d 3 -i " + input_file + " -x " + input_mask + " -o " + output_file + " -s 2 " \
-                            "-c [50x40x30x20,0.0000001] -b [200,3,0.0,0.5] -t [0.15,0.01,200]"
+            parameters_N4 = " -d 3 -i " + input_file + " -x " + input_mask + " -o " + tmp_output + " -s " + str(shrink) + " " + \
+                            convergence + " -b [200,3,0.0,0.5] -t [0.15,0.01,200]"
         elif field_strength == '3T':
-            parameters_N4 = " -d 3 -i " + input_file + " -x " + input_mask + " -o " + output_file + " -s 2 " \
-                            "-c [50x40x30x20,0.0000001] -b [75,3,0.0,0.5] -t [0.15,0.01,200]"
+            parameters_N4 = " -d 3 -i " + input_file + " -x " + input_mask + " -o " + tmp_output + " -s " + str(shrink) + " " + \
+                            convergence + " -b [75,3,0.0,0.5] -t [0.15,0.01,200]"
         else:
             print "Warning N4: Unknown field strength defaulting to 3T parameters"
-            parameters_N4 = " -d 3 -i " + input_file + " -x " + input_mask + " -o " + output_file + " -s 2 " \
-                            "-c [50x40x30x20,0.0000001] -b [75,3,0.0,0.5] -t [0.15,0.01,200]"
+            parameters_N4 = " -d 3 -i " + input_file + " -x " + input_mask + " -o " + tmp_output + " -s " + str(shrink) + " " + \
+                            convergence + " -b [75,3,0.0,0.5] -t [0.15,0.01,200]"
+
+    # The key only contains the parameters after the file names
+    cache_key = malpem.cache.get_key("N4", [input_file, input_mask], parameters_N4.split(tmp_output)[1])
+    if malpem.cache.fetch(cache_key, output_file):
+        malpem.mytools.finished_task(start_time, task_name)
+        return True
 
     malpem.mytools.execute_cmd(binary_N4, parameters_N4, logfile)
-    malpem.mytools.ensure_file(output_file, "")
+    malpem.mytools.commit_file(tmp_output, output_file)
+    malpem.cache.store(cache_key, output_file)
 
     malpem.mytools.finished_task(start_time, task_name)
     return True
 
 
+def get_change(image_a, image_b, mask):
+    # Mean absolute intensity change inside the mask relative to the mean intensity
+    data_a = malpem.imageio.load_image(image_a)[0]
+    data_b = malpem.imageio.load_image(image_b)[0]
+    inside = malpem.imageio.load_image(mask)[0] > 0
+    mean_a = numpy.abs(data_a[inside].astype(numpy.float64)).mean() if inside.any() else 0.0
+    if mean_a == 0:
+        return 0.0
+    return numpy.abs(data_a[inside].astype(numpy.float64) - data_b[inside]).mean() / mean_a
+
+
+def N4_refine(input_file, output_file, probe_file, field_strength, input_mask, output_dir):
+    # Masked bias correction of an image that was bias corrected already (input_file), the full pass uses the
+    # reduced schedule of the profile (n4_refine_iterations)
+    N4(input_file, probe_file, field_strength, input_mask, output_dir, probe_iterations, probe_shrink)
+    change = get_change(input_file, probe_file, input_mask)
+    os.remove(probe_file)
+
+    if change < refine_threshold:
+        print "Skipping second bias correction: probe changes the brain by %.2f%% (threshold %.2f%%)" % \
+              (100 * change, 100 * refine_threshold)
+        if malpem.mytools.file_extension(input_file) == malpem.mytools.file_extension(output_file):
+            shutil.copyfile(input_file, output_file)
+        else:
+            data, image = malpem.imageio.load_image(input_file)
+            malpem.imageio.save_image(data, image, output_file)
+        return True
+
+    print "Second bias correction: probe changes the brain by %.2f%%" % (100 * change)
+    return N4(input_file, output_file, field_strength, input_mask, output_dir,
+              malpem.profiles.get("n4_refine_iterations"))
+
+
 def get_full_image_mask(input_file, output_file):
 # DEFINITIONS
     binary_fsl = os.path.join(malpem.mytools.__malpem_path__, "lib", "niftyseg", "seg_maths")
@@ -7,12 +7,25 @@
 
 import os
 import malpem.mytools
+import malpem.cache
 import malpem.registration
+import malpem.profiles
+
+# "script": lib/pincram/pincram-0.2.3_ireg.sh with its own job pool, "native": the level loop as tasks of the MALPEM
+# scheduler (malpem.pincram)
+engine = "script"
+
+
+def get_mni_dof(input_file, output_dir):
+    # MNI alignment of the input of pincram (reused if it exists)
+    return os.path.join(output_dir, "mni-" + malpem.mytools.nifty_basename(input_file) + ".dof.gz")
+
 
 def pincram(input_file, output_mask, threads, output_dir):
 # DEFINITIONS
     binary_pincram = os.path.join(malpem.mytools.__malpem_path__, "lib", "pincram", "pincram-0.2.3_ireg.sh")
     a_pincram = os.path.join(malpem.mytools.__malpem_path__, "atlas", "pincram/")
+    levels = "-levels " + str(malpem.profiles.get("pincram_levels"))
 #   tpn = os.path.join(malpem.mytools.__malpem_path__, "atlas", "pincram/neutral.dof.gz")
 # END DEFINITIONS
 
@@ -32,20 +45,29 @@ def pincram(input_file, output_mask, threads, output_dir):
     discard_dir = os.path.join(tmp_dir, "discard/")
     #malpem.mytools.check_ex_dir(discard_dir)   (IF UNCOMMENTED TEMPORARY PINCRAM FILES ARE KEPT)
 
-    mni_dof = os.path.join(output_dir, "mni-" + malpem.mytools.nifty_basename(input_file) + ".dof.gz")
+    mni_dof = get_mni_dof(input_file, output_dir)
     if not os.path.isfile(mni_dof):
         malpem.registration.dof2mni(input_file, mni_dof, "rigid", output_dir)
     else:
         print "Skipping MNI alignment (" + mni_dof + "): file exists"
 
     parameters_pincram = input_file + " -result " + output_mask + " -tempbase " + tmp_dir + " -output " + discard_dir + \
-                         " -atlas " + a_pincram + " -levels 3 -par " + threads + " -tpn " + mni_dof
+                         " -atlas " + a_pincram + " " + levels + " -par " + threads + " -tpn " + mni_dof + \
+                         " -ext " + malpem.mytools.__malpem_intermediate_ext__
+
+    # The number of parallel jobs and the format of the intermediate files don't change the result and are not part
+    # of the key
+    cache_key = malpem.cache.get_key("pincram", [input_file, mni_dof, a_pincram, binary_pincram], levels)
+    if malpem.cache.fetch(cache_key, output_mask):
+        malpem.mytools.finished_task(start_time, task_name)
+        return True
 
     #binary_pincram = os.path.join(malpem.mytools.__malpem_path__, 'bin/transformation')
     #parameters_pincram = " " + input_file + " " + output_mask
     malpem.mytools.execute_cmd(binary_pincram, parameters_pincram, logfile)
 
     malpem.mytools.ensure_file(output_mask, "")
+    malpem.cache.store(cache_key, output_mask)
     malpem.mytools.finished_task(start_time, task_name)
 
     return True
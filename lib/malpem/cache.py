@@ -0,0 +1,178 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Content-addressed cache of intermediate results (N4 images, dofs, pincram masks, propagated images). The key of
+# a result is the hash of the tool, its parameters and the content of all input files, results are therefore reused
+# across runs and output folders. The cache is disabled if no cache directory is set.
+
+import os
+import shutil
+import hashlib
+
+__cache_dir__ = os.environ.get("MALPEM_CACHE_DIR", "")
+# Maximum size of the cache in bytes, least recently used results are evicted first
+__cache_size__ = 50 * 1024 ** 3
+# Size of the cache in bytes when it was last evicted plus the results stored since (-1: not counted yet). It is
+# counted once per run (see evict), the tasks inherit it and only walk the cache again once it exceeds the limit.
+__cache_used__ = -1
+# A full cache is evicted down to this fraction of its maximum size, so that not every following result evicts again
+evict_fraction = 0.9
+
+chunk_size = 1024 * 1024
+
+
+def enabled():
+    return not __cache_dir__ == ""
+
+
+def hash_file(filename):
+    # Content hashes are remembered per path, size and modification time so that atlas files are only hashed once
+    stat = os.stat(filename)
+    index_dir = os.path.join(__cache_dir__, "index")
+    index_file = os.path.join(index_dir, hashlib.sha1(os.path.abspath(filename)).hexdigest())
+    index_stamp = str(stat.st_size) + " " + repr(stat.st_mtime)
+
+    if os.path.isfile(index_file):
+        f = open(index_file)
+        arr = f.read().split(",")
+        f.close()
+        if len(arr) == 2 and arr[0] == index_stamp:
+            return arr[1]
+
+    content_hash = hashlib.sha1()
+    f = open(filename, "rb")
+    chunk = f.read(chunk_size)
+    while chunk:
+        content_hash.update(chunk)
+        chunk = f.read(chunk_size)
+    f.close()
+
+    if not os.path.isdir(index_dir):
+        try:
+            os.makedirs(index_dir)
+        except OSError:
+            pass
+    write_atomic(index_file, index_stamp + "," + content_hash.hexdigest())
+
+    return content_hash.hexdigest()
+
+
+def hash_dir(directory):
+    dir_hash = hashlib.sha1()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for curfile in sorted(files):
+            filename = os.path.join(root, curfile)
+            dir_hash.update(os.path.relpath(filename, directory) + ":" + hash_file(filename) + "\n")
+    return dir_hash.hexdigest()
+
+
+def get_key(tool, input_files, parameters):
+    # Empty file names (e.g. no dof_in) are part of the key so that the position of every input is unambiguous
+    if not enabled():
+        return ""
+
+    key = hashlib.sha1(tool + "\n" + parameters + "\n")
+    for input_file in input_files:
+        if input_file == "":
+            key.update("-\n")
+        elif os.path.isdir(input_file):
+            key.update(hash_dir(input_file) + "\n")
+        else:
+            key.update(hash_file(input_file) + "\n")
+    return key.hexdigest()
+
+
+def get_object(key):
+    return os.path.join(__cache_dir__, "objects", key[0:2], key)
+
+
+def write_atomic(filename, content):
+    tmp_file = filename + ".tmp-" + str(os.getpid())
+    f = open(tmp_file, "w")
+    f.write(content)
+    f.close()
+    os.rename(tmp_file, filename)
+
+
+def copy_atomic(source, destination):
+    tmp_file = os.path.join(os.path.dirname(destination), ".tmp-" + str(os.getpid()) + "-" +
+                            os.path.basename(destination))
+    shutil.copyfile(source, tmp_file)
+    os.rename(tmp_file, destination)
+
+
+def fetch(key, output_file):
+    if key == "":
+        return False
+
+    cache_object = get_object(key)
+    if not os.path.isfile(cache_object):
+        return False
+
+    try:
+        copy_atomic(cache_object, output_file)
+        # The modification time of a cached result is its last use (LRU eviction)
+        os.utime(cache_object, None)
+    except (IOError, OSError):
+        return False
+
+    print("Using cached result for " + output_file + " (" + key + ")")
+    return True
+
+
+def store(key, output_file):
+    if key == "" or not os.path.isfile(output_file):
+        return False
+
+    cache_object = get_object(key)
+    if not os.path.isdir(os.path.dirname(cache_object)):
+        try:
+            os.makedirs(os.path.dirname(cache_object))
+        except OSError:
+            pass
+
+    copy_atomic(output_file, cache_object)
+
+    # Results stored by other processes are not counted, they are found by the next eviction
+    global __cache_used__
+    if __cache_used__ < 0:
+        evict()
+    else:
+        __cache_used__ += os.path.getsize(cache_object)
+        if __cache_used__ > __cache_size__:
+            evict()
+    return True
+
+
+def evict():
+    global __cache_used__
+    objects_dir = os.path.join(__cache_dir__, "objects")
+    cache_objects = []
+    total_size = 0
+    for root, dirs, files in os.walk(objects_dir):
+        for curfile in files:
+            if curfile.startswith(".tmp-"):
+                continue
+            filename = os.path.join(root, curfile)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            cache_objects.append((stat.st_mtime, stat.st_size, filename))
+            total_size += stat.st_size
+
+    cache_objects.sort()
+    limit = __cache_size__ if total_size <= __cache_size__ else evict_fraction * __cache_size__
+    for mtime, size, filename in cache_objects:
+        if total_size <= limit:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total_size -= size
+    __cache_used__ = total_size
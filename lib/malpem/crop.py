@@ -0,0 +1,160 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Cropping of the brain extracted image to the bounding box of the brain mask (plus a margin) for the stages after the
+# brain extraction (--crop): atlas registration and propagation, label fusion and MALPEM work on the cropped grid,
+# their segmentations and probability maps are padded back into the geometry of the input image afterwards (same
+# header as the brain extracted image). The box is stored in log/crop_box.json, so that outputs of an interrupted
+# run are recognised and padded back on resume.
+
+import os
+import json
+import numpy
+import multiprocessing.pool
+import malpem.mytools
+import malpem.imageio
+import malpem.posteriors
+import malpem.scheduler
+
+# Cropping enabled, margin around the bounding box of the mask [mm]
+enabled = False
+margin = 10.0
+
+
+def get_box(mask_file, margin_mm):
+    # Returns start and end (exclusive) voxel index per axis of the bounding box of the mask plus the margin
+    mask, mask_image = malpem.imageio.load_image(mask_file)
+    mask = mask.reshape(mask.shape[0:3] + (-1,)).max(axis=3) > 0
+    if not mask.any():
+        print "--- ERROR: Empty brain mask, cannot crop (" + mask_file + ") ---"
+        exit(1)
+
+    zooms = mask_image.header.get_zooms()[0:3]
+    start = []
+    end = []
+    for axis in range(3):
+        indices = numpy.nonzero(mask.any(axis=tuple(a for a in range(3) if not a == axis)))[0]
+        margin_voxels = int(numpy.ceil(margin_mm / float(zooms[axis])))
+        start.append(max(0, int(indices[0]) - margin_voxels))
+        end.append(min(mask.shape[axis], int(indices[-1]) + 1 + margin_voxels))
+    return start, end
+
+
+def read_box(box_file):
+    f = open(box_file)
+    box = json.load(f)
+    f.close()
+    return box
+
+
+def get_slices(box):
+    return tuple(slice(box["start"][axis], box["end"][axis]) for axis in range(3))
+
+
+def crop(input_file, mask_file, output_file, box_file):
+    task_name = "Cropping to the brain mask"
+    start_time = malpem.mytools.start_task(task_name)
+
+    data, image = malpem.imageio.load_image(input_file)
+    start, end = get_box(mask_file, margin)
+    box = {"start": start, "end": end, "shape": list(data.shape[0:3]), "margin": margin}
+
+    # The cropped grid starts at the first voxel of the box, same orientation and voxel size
+    grid = numpy.eye(4)
+    grid[0:3, 3] = start
+    malpem.imageio.save_image(data[get_slices(box)], image, output_file, grid=grid)
+
+    cropped = numpy.prod([end[axis] - start[axis] for axis in range(3)])
+    print "Cropped " + "x".join(str(n) for n in data.shape[0:3]) + " to " + \
+          "x".join(str(end[axis] - start[axis]) for axis in range(3)) + " voxels (%.0f%%)" % \
+          (100.0 * cropped / numpy.prod(data.shape[0:3]))
+
+    f = open(box_file + ".tmp", 'w')
+    json.dump(box, f)
+    f.close()
+    os.rename(box_file + ".tmp", box_file)
+
+    malpem.mytools.finished_task(start_time, task_name)
+    return True
+
+
+def get_fill_value(data):
+    # Most frequent value on the faces of the box (background label, padding value of the probability maps)
+    faces = numpy.concatenate([data[0].ravel(), data[-1].ravel(), data[:, 0].ravel(), data[:, -1].ravel(),
+                               data[:, :, 0].ravel(), data[:, :, -1].ravel()])
+    values, counts = numpy.unique(faces, return_counts=True)
+    return values[numpy.argmax(counts)]
+
+
+def uncrop_file(filename, reference, box):
+    # Pads an output of the cropped grid back into the full grid (no-op if it has the full grid already)
+    image = malpem.imageio.load_image(filename)[1]
+    if list(image.shape[0:3]) == box["shape"]:
+        return False
+    if not list(image.shape[0:3]) == [box["end"][axis] - box["start"][axis] for axis in range(3)]:
+        print "--- ERROR: " + filename + " has neither the cropped nor the full grid ---"
+        exit(1)
+
+    data = numpy.asanyarray(image.dataobj)
+    full = numpy.empty(box["shape"] + list(data.shape[3:]), dtype=data.dtype)
+    full.fill(get_fill_value(data))
+    full[get_slices(box)] = data
+
+    malpem.imageio.save_image(full, reference, filename, image.get_data_dtype())
+    return True
+
+
+def uncrop_compact(filename, reference, box):
+    # The same for probability maps in the compact format, label by label
+    reader = malpem.posteriors.PosteriorReader(filename)
+    if list(reader.shape) == box["shape"]:
+        return False
+    if not list(reader.shape) == [box["end"][axis] - box["start"][axis] for axis in range(3)]:
+        print "--- ERROR: " + filename + " has neither the cropped nor the full grid ---"
+        exit(1)
+
+    writer = malpem.posteriors.PosteriorWriter(filename, reference, reader.label_count)
+    for label in range(reader.label_count):
+        data = reader.get_map(label)
+        full = numpy.empty(box["shape"], dtype=data.dtype)
+        full.fill(get_fill_value(data))
+        full[get_slices(box)] = data
+        writer.add(label, full)
+    writer.close()
+    return True
+
+
+def uncrop(reference_file, output_files, prob_dirs, box_file):
+    if not os.path.isfile(box_file):
+        print "Skipping padding: no crop box (" + box_file + ")"
+        return True
+
+    task_name = "Padding the results back to the full image"
+    start_time = malpem.mytools.start_task(task_name)
+
+    box = read_box(box_file)
+    reference = malpem.imageio.load_image(reference_file)[1]
+    if not list(reference.shape[0:3]) == box["shape"]:
+        print "--- ERROR: Crop box doesn't match " + reference_file + " ---"
+        exit(1)
+
+    files = [filename for filename in output_files if os.path.isfile(filename)]
+    for prob_dir in prob_dirs:
+        if os.path.isdir(prob_dir):
+            files += [os.path.join(prob_dir, name) for name in sorted(os.listdir(prob_dir))
+                      if malpem.mytools.file_extension(name) in [".nii", ".nii.gz", ".npz"] and
+                      not malpem.mytools.is_tmp_file(name)]
+
+    threads = max(1, int(os.environ.get(malpem.scheduler.thread_variables[0], "1")))
+    pool = multiprocessing.pool.ThreadPool(threads)
+    padded = pool.map(lambda filename: uncrop_compact(filename, reference, box) if filename.endswith(".npz") else
+                      uncrop_file(filename, reference, box), files)
+    pool.close()
+    pool.join()
+    print "Padded " + str(sum(padded)) + " of " + str(len(files)) + " file(s)"
+
+    malpem.mytools.finished_task(start_time, task_name)
+    return True
@@ -0,0 +1,131 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# In-process reading and writing of NIfTI images (nibabel), used instead of external tools wherever the
+# operation is simple enough to be done on the voxel array directly.
+
+import os
+import numpy
+import nibabel
+import nibabel.openers
+import malpem.mytools
+
+
+def load_image(filename):
+    image = nibabel.load(filename)
+    return numpy.asanyarray(image.dataobj), image
+
+
+def save_image(data, reference, filename, dtype=None, grid=None):
+    # The output gets the geometry (qform/sform) of the reference image and its data type unless specified. grid maps
+    # the voxels of a different grid (cropped, downsampled) to the voxels of the reference, qform and sform are both
+    # transformed by it and keep their codes.
+    header = reference.header.copy()
+    if dtype is None:
+        dtype = reference.get_data_dtype()
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(1, 0)
+
+    if grid is None:
+        grid = numpy.eye(4)
+    image = nibabel.Nifti1Image(numpy.asarray(data).astype(dtype), numpy.dot(reference.affine, grid), header)
+    image.set_qform(numpy.dot(reference.get_qform(), grid), int(reference.header["qform_code"]))
+    image.set_sform(numpy.dot(reference.get_sform(), grid), int(reference.header["sform_code"]))
+    tmp = malpem.mytools.tmp_file(filename)
+    nibabel.save(image, tmp)
+    os.rename(tmp, filename)
+
+
+def load_slab(image, z_start, z_end):
+    # Reads the slices z_start..z_end-1 of a (3D) image only, the data of a NIfTI file is stored slice by slice
+    data = numpy.asanyarray(image.dataobj[:, :, z_start:z_end])
+    return data.reshape(image.shape[0:2] + (z_end - z_start,))
+
+
+class SlabWriter(object):
+    # Writes a 3D NIfTI image slab by slab along z, so that the full volume never has to be held in memory. The
+    # geometry is taken from the reference image as in save_image. The image gets its name once complete.
+    def __init__(self, filename, reference, dtype):
+        header = nibabel.Nifti1Header()
+        header.set_data_shape(reference.shape[0:3])
+        header.set_zooms(reference.header.get_zooms()[0:3])
+        header.set_xyzt_units(*reference.header.get_xyzt_units())
+        header.set_data_dtype(dtype)
+        header.set_slope_inter(1, 0)
+        header.set_qform(reference.get_qform(), int(reference.header["qform_code"]))
+        header.set_sform(reference.get_sform(), int(reference.header["sform_code"]))
+        header["vox_offset"] = 352
+
+        self.filename = filename
+        self.tmp = malpem.mytools.tmp_file(filename)
+        self.dtype = header.get_data_dtype()
+        self.depth = reference.shape[2]
+        self.written = 0
+
+        # The opener compresses .nii.gz files with the same settings nibabel uses
+        self.file = nibabel.openers.Opener(self.tmp, "wb")
+        self.file.write(header.binaryblock + b"\x00" * 4)
+
+    def write(self, data):
+        data = numpy.asarray(data).astype(self.dtype)
+        self.file.write(data.tobytes(order="F"))
+        self.written += data.shape[2]
+
+    def close(self):
+        self.file.close()
+        if not self.written == self.depth:
+            print("--- ERROR: Incomplete image written (" + str(self.written) + " of " + str(self.depth) +
+                  " slices): " + self.filename + " ---")
+            exit(1)
+        os.rename(self.tmp, self.filename)
+
+
+def get_corners(image):
+    # World coordinates [mm] of the 8 corner voxels of the (3D) grid
+    shape = numpy.array(image.shape[0:3]) - 1
+    corners = numpy.array([[i, j, k, 1] for i in [0, shape[0]] for j in [0, shape[1]] for k in [0, shape[2]]])
+    return numpy.dot(image.affine, corners.T)[0:3]
+
+
+def same_grid(image_a, image_b, tolerance):
+    # Same dimensions and voxel positions differing less than tolerance [mm]
+    if not image_a.shape[0:3] == image_b.shape[0:3]:
+        return False
+    return numpy.abs(get_corners(image_a) - get_corners(image_b)).max() <= tolerance
+
+
+def copy_geometry(reference, filename):
+    # Replaces the geometry (voxel size, qform, sform) in the header of filename by that of the reference image. The
+    # voxel data is not converted: uncompressed files are changed in place, compressed files (e.g. the brain mask)
+    # are decompressed and recompressed as a stream behind the new header and replaced once complete.
+    # The header as stored in the file (nibabel.load resets the data offset)
+    f = nibabel.openers.Opener(filename, "rb")
+    header = nibabel.Nifti1Header.from_fileobj(f)
+    f.close()
+    header.set_zooms(reference.header.get_zooms()[0:3] + header.get_zooms()[3:])
+    header.set_xyzt_units(*reference.header.get_xyzt_units())
+    header.set_qform(reference.get_qform(), int(reference.header["qform_code"]))
+    header.set_sform(reference.get_sform(), int(reference.header["sform_code"]))
+
+    if not filename.endswith(".gz"):
+        f = open(filename, "r+b")
+        f.write(header.binaryblock)
+        f.close()
+        return
+
+    tmp_file = malpem.mytools.tmp_file(filename)
+    f_in = nibabel.openers.Opener(filename, "rb")
+    f_out = nibabel.openers.Opener(tmp_file, "wb")
+    f_in.read(len(header.binaryblock))
+    f_out.write(header.binaryblock)
+    while True:
+        data = f_in.read(1024 * 1024)
+        if not data:
+            break
+        f_out.write(data)
+    f_in.close()
+    f_out.close()
+    os.rename(tmp_file, filename)
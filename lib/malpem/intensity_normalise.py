@@ -4,27 +4,63 @@
 #
 #         see license file in project root directory
 
-import os
+import math
+import numpy
+import scipy.ndimage
 import malpem.mytools
+import malpem.imageio
+
+# Number of erosions (3x3x3) before the robust maximum intensity is estimated
+erosions = 5
+# Intensities above this percentile of the eroded image (foreground > 1) are mapped to 255
+robust_percentile = 0.98
+
+
+def robust_rescale_array(data):
+    # Same result as the former lib/scale script: the intensities are scaled such that the robust maximum of the
+    # eroded brain is mapped to 255, brighter voxels are clamped to 255 and negative (padded) voxels are set to -1
+    data = numpy.asarray(data, dtype=numpy.float64)
+
+    # Repeated 3x3x3 erosions are equivalent to one erosion with a larger cube
+    size = 2 * erosions + 1
+    eroded = scipy.ndimage.grey_erosion(data, size=(size, size, size), mode="nearest")
+
+    foreground = eroded[eroded > 1]
+    if len(foreground) == 0:
+        print("--- ERROR: Robust intensity rescaling failed, the eroded image has no foreground ---")
+        exit(1)
+    k = min(len(foreground) - 1, int(round(robust_percentile * (len(foreground) - 1))))
+    max_intensity = numpy.partition(foreground, k)[k]
+
+    # seg_stats printed the maximum with 6 significant digits and bc truncated the factor to 5 decimals, seg_maths
+    # -thr keeps voxels > the threshold and -uthr voxels < the threshold (as in the tissue segmentation)
+    max_intensity = float("%g" % max_intensity)
+    factor = math.floor(255.0 / max_intensity * 100000) / 100000
+
+    peaks = (data > max_intensity) * 255.0
+    result = data * factor
+    result[result >= 255] = 0
+    result += peaks
+
+    peaks = (result > 257) * 255.0
+    result[result >= 256] = 0
+    result += peaks
+
+    result[result < 0] = 0
+    result[data < 0] = -1
+
+    return result
 
 
 def robust_rescale(input_file, output_file, output_dir):
-# DEFINITIONS
-    binary_normalise = os.path.join(malpem.mytools.__malpem_path__, "lib", "scale")
-# END DEFINITIONS
     task_name = "Robust intensity rescaling"
     start_time = malpem.mytools.start_task(task_name)
 
     malpem.mytools.ensure_file(input_file, "")
-    log_dir = os.path.join(output_dir, "log/")
-    malpem.mytools.check_ex_dir(log_dir)
-    logfile = os.path.join(log_dir, "normalise-" + malpem.mytools.nifty_basename(input_file) + ".log")
-
-    parameters_normalise = input_file + " " + output_file + " " + output_dir
 
-    #binary_normalise = os.path.join(malpem.mytools.__malpem_path__, 'bin/transformation')
-    #parameters_normalise = input_file + " " + output_file
-    malpem.mytools.execute_cmd(binary_normalise, parameters_normalise, logfile)
+    data, image = malpem.imageio.load_image(input_file)
+    # Float output, the scaled intensities of an integer input would be truncated
+    malpem.imageio.save_image(robust_rescale_array(data), image, output_file, numpy.float32)
 
     malpem.mytools.ensure_file(output_file, "")
     malpem.mytools.finished_task(start_time, task_name)
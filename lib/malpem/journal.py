@@ -0,0 +1,275 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Journal of the finished tasks of a run (log/journal.jsonl). When a task has finished successfully, one record is
+# appended with its parameters, the records of the tasks it depends on, its input files and the size, modification
+# time and checksum of its outputs. On resume a task is only skipped if
+# - its last record has the same parameters and the same input files,
+# - the tasks it depends on are skipped as well and still have the records it was run with (otherwise an upstream
+#   task was run again, e.g. after a parameter change, and everything downstream is redone),
+# - its outputs are unchanged since the last task that wrote them (a file copied e.g. from a scratch directory is
+#   compared by its checksum).
+# Outputs of a task without record (e.g. killed while writing) are removed before the task runs again. Output folders
+# of older versions without journal are resumed from the existing files (first output of every task, as before),
+# which are then adopted into the journal.
+# Files are recorded relative to the output folder (which differs between runs with a scratch directory).
+
+import os
+import sys
+import json
+import time
+import fcntl
+import socket
+import hashlib
+
+chunk_size = 1024 * 1024
+
+# Parameters ("module:name", "subject:attribute") that change the results of a stage
+stage_parameters = {"N4": ["subject:field_strength", "malpem.profiles:profile"],
+                    "mni": ["malpem.profiles:profile"],
+                    "pincram-prepare": [],
+                    "pincram-rigid": ["malpem.profiles:profile"],
+                    "pincram-affine": ["malpem.profiles:profile"],
+                    "pincram-nonrigid": ["malpem.profiles:profile"],
+                    "pincram-select": ["malpem.profiles:profile", "malpem.pincram:postprocessing",
+                                       "malpem.pincram:nmi_bins"],
+                    "brain-extraction": ["subject:field_strength", "subject:do_n4_pincram", "malpem.profiles:profile",
+                                         "malpem.brain_extraction:engine", "malpem.bias_correction:refine_threshold"],
+                    "crop": ["malpem.crop:margin"],
+                    "atlas-selection": ["subject:atlas_select"],
+                    "register": ["malpem.profiles:profile"],
+                    "transform": ["malpem.registration:resampling"],
+                    "transform-image": ["malpem.registration:resampling"],
+                    "transform-labels": ["malpem.registration:resampling"],
+                    "fusion": ["malpem.label_fusion:engine", "subject:compact_posteriors"],
+                    "malpem": ["subject:compact_posteriors"],
+                    "screenshots-mask": ["malpem.report:engine"],
+                    "report": ["malpem.report:engine", "malpem.report:output_format"]}
+
+
+def get_parameters(stage, subject):
+    parameters = {}
+    for key in stage_parameters.get(stage, []):
+        owner, name = key.split(":")
+        if owner == "subject":
+            parameters[key] = getattr(subject, name)
+        else:
+            __import__(owner)
+            parameters[key] = getattr(sys.modules[owner], name)
+    # Same types as read from the journal
+    return json.loads(json.dumps(parameters))
+
+
+def get_checksum(filename):
+    checksum = hashlib.sha1()
+    f = open(filename, "rb")
+    chunk = f.read(chunk_size)
+    while chunk:
+        checksum.update(chunk)
+        chunk = f.read(chunk_size)
+    f.close()
+    return checksum.hexdigest()
+
+
+def get_fingerprint(filename):
+    # None for a file that doesn't exist (e.g. removed by the task)
+    if not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": get_checksum(filename)}
+
+
+def matches(fingerprint, filename):
+    if fingerprint is None:
+        return not os.path.exists(filename)
+    if not os.path.isfile(filename):
+        return False
+    stat = os.stat(filename)
+    if not stat.st_size == fingerprint["size"]:
+        return False
+    return stat.st_mtime == fingerprint["mtime"] or get_checksum(filename) == fingerprint["sha1"]
+
+
+def read_records(journal_file):
+    records = []
+    if not os.path.isfile(journal_file):
+        return records
+    f = open(journal_file)
+    for row in f:
+        row = row.strip()
+        if row:
+            try:
+                records.append(json.loads(row))
+            except ValueError:
+                # Incomplete last line of a crashed run
+                pass
+    f.close()
+    return records
+
+
+def write_record(journal_file, record):
+    # The journal is shared by all tasks (and workers) of a subject
+    f = open(journal_file, "a")
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.write(json.dumps(record, sort_keys=True) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+    fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+
+
+def get_key(base_dir, filename):
+    # Files in the output folder are recorded relative to it, inputs from elsewhere with their path
+    key = os.path.relpath(filename, base_dir)
+    if key.startswith(".."):
+        return filename
+    return key
+
+
+def get_fingerprints(base_dir, filenames):
+    return dict((get_key(base_dir, filename), get_fingerprint(filename)) for filename in filenames)
+
+
+def create_entry(name, parameters, deps, inputs=None, outputs=None, updates=None, rewrites=None, removes=None):
+    # Journal entry of a task. inputs: files from outside of the run (compared by fingerprint), outputs: files the
+    # task creates (None: not journaled, always run), updates: files of other tasks it changes in place, rewrites:
+    # the same if the change can't be repeated (e.g. a second bias correction, the task that creates the file has
+    # to run again first), removes: files of other tasks it deletes (e.g. temporary files)
+    return {"task": name, "parameters": parameters, "deps": deps, "inputs": inputs or [], "outputs": outputs,
+            "updates": (updates or []) + (rewrites or []), "rewrites": rewrites or [], "removes": removes or []}
+
+
+def create_record(last_records, base_dir, entry):
+    return {"task": entry["task"], "id": "%.6f-%s-%d" % (time.time(), socket.gethostname(), os.getpid()),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"), "parameters": entry["parameters"],
+            "deps": dict((dep, last_records[dep]["id"] if dep in last_records else None) for dep in entry["deps"]),
+            "inputs": get_fingerprints(base_dir, entry["inputs"]),
+            "outputs": get_fingerprints(base_dir, entry["outputs"] + entry["updates"]),
+            "removes": [get_key(base_dir, filename) for filename in entry["removes"]]}
+
+
+def run_journaled(journal_file, base_dir, entry, target, args):
+    # Scheduler task wrapper: removes stale outputs, runs the task and records it once it has finished successfully
+    for filename in entry["outputs"]:
+        if os.path.isfile(filename):
+            print "Removing output of an unfinished or outdated run: " + filename
+            os.remove(filename)
+
+    result = target(*args)
+    last_records = dict((record["task"], record) for record in read_records(journal_file))
+    write_record(journal_file, create_record(last_records, base_dir, entry))
+    return result
+
+
+class Journal(object):
+    # temporary_dirs: directories removed by the cleanup, in a run without journal missing outputs there were removed
+    # if everything downstream is done
+    def __init__(self, journal_file, base_dir, temporary_dirs=None):
+        self.journal_file = journal_file
+        self.base_dir = base_dir
+        self.temporary_dirs = temporary_dirs or []
+        # Last record of every task, last fingerprint and task of every file written by a task and the files that
+        # were removed by a task since (e.g. by the cleanup)
+        self.records = {}
+        self.files = {}
+        self.writers = {}
+        self.removed = set()
+        self.legacy = not os.path.isfile(journal_file)
+        if self.legacy:
+            # From now on only journaled outputs count
+            open(journal_file, "a").close()
+        for record in read_records(journal_file):
+            self.add_record(record)
+
+    def add_record(self, record):
+        self.records[record["task"]] = record
+        self.files.update(record["outputs"])
+        self.writers.update((key, record["task"]) for key in record["outputs"])
+        self.removed.difference_update(record["outputs"])
+        for key in record.get("removes", []):
+            # Files that didn't exist before don't count (e.g. not created with the engine in use)
+            if key not in self.files or self.files[key] is not None:
+                self.removed.add(key)
+            self.files[key] = None
+
+    def matches(self, fingerprints, filename):
+        key = get_key(self.base_dir, filename)
+        return key in fingerprints and matches(fingerprints[key], filename)
+
+    def is_temporary(self, filename):
+        return any(not os.path.relpath(filename, directory).startswith("..") for directory in self.temporary_dirs)
+
+    def is_removed(self, filename):
+        return get_key(self.base_dir, filename) in self.removed and not os.path.exists(filename)
+
+    def is_rewritten(self, filename, name):
+        # File of the task 'name' changed by a later task
+        return not self.writers.get(get_key(self.base_dir, filename), name) == name
+
+    def is_done(self, entry):
+        if entry["outputs"] is None:
+            return False
+        if self.legacy:
+            return len(entry["outputs"]) == 0 or os.path.isfile(entry["outputs"][0])
+
+        record = self.records.get(entry["task"])
+        if record is None or not record["parameters"] == entry["parameters"] or \
+                not sorted(record["deps"]) == sorted(entry["deps"]):
+            return False
+        for dep in entry["deps"]:
+            if dep in self.records and not record["deps"][dep] == self.records[dep]["id"]:
+                return False
+        for filename in entry["inputs"]:
+            if not self.matches(record["inputs"], filename):
+                return False
+        for filename in entry["outputs"]:
+            if not self.matches(self.files, filename):
+                return False
+        return True
+
+    def adopt(self, entry):
+        # Records a task whose outputs exist from a run without journal
+        entry = dict(entry, removes=[filename for filename in entry["outputs"]
+                                     if self.is_temporary(filename) and not os.path.isfile(filename)])
+        record = create_record(self.records, self.base_dir, entry)
+        write_record(self.journal_file, record)
+        self.add_record(record)
+
+    def resolve(self, entries):
+        # Names of the tasks (entries in dependency order) that have to run: the unfinished ones, everything
+        # downstream of them and the finished ones whose outputs they need but were removed or are rewritten
+        entry_names = dict((entry["task"], entry) for entry in entries)
+        done = {}
+        for entry in reversed(entries):
+            done[entry["task"]] = self.is_done(entry)
+            if self.legacy and not done[entry["task"]] and entry["outputs"] is not None and \
+                    self.is_temporary(entry["outputs"][0]):
+                # Outputs removed by the cleanup of an old run: done if everything downstream is done
+                dependents = [dependent["task"] for dependent in entries if entry["task"] in dependent["deps"] and
+                              dependent["outputs"] is not None]
+                done[entry["task"]] = len(dependents) > 0 and all(done[dependent] for dependent in dependents)
+        run = set(name for name in done if not done[name])
+
+        changed = True
+        while changed:
+            changed = False
+            for entry in entries:
+                if entry["task"] not in run and any(dep in run for dep in entry["deps"]):
+                    run.add(entry["task"])
+                    changed = True
+            for entry in reversed(entries):
+                if entry["task"] not in run:
+                    continue
+                for dep in entry["deps"]:
+                    if dep in run or dep not in entry_names:
+                        continue
+                    outputs = entry_names[dep]["outputs"] or []
+                    rewritten = [filename for filename in entry["rewrites"] if filename in outputs]
+                    if any(self.is_removed(filename) for filename in outputs) or \
+                            any(self.is_rewritten(filename, dep) for filename in rewritten):
+                        run.add(dep)
+                        changed = True
+        return run
@@ -5,13 +5,137 @@
 #         see license file in project root directory
 
 import os
+import numpy
+import nibabel
+import scipy.ndimage
+import multiprocessing.pool
 import intensity_normalise
 import malpem.mytools
+import malpem.imageio
+import malpem.posteriors
+import malpem.tissues
 
 # Gaussian weighted fusion (SD of kernel)
 sigma = 2.5
+# Implementation of the fusion: "binary" (cl_gaussian_fusion) or "native" (in-process, streamed in z-slabs)
+engine = "binary"
+# Native fusion: upper bound for the slab buffers of all threads [bytes] and number of threads processing slabs
+memory_limit = 2 * 1024 ** 3
+fusion_threads = 1
+# Native fusion: number of probability maps (background + 138 NMM structures)
+label_count = 139
+# Native fusion: the Gaussian kernel is truncated at this many SDs, which determines the halo of the slabs
+truncate = 3.0
+# Native fusion: added to the local mean squared difference to avoid infinite weights
+epsilon = 1e-6
+
+
+def get_slab_depth(shape, halo, threads):
+    # Buffers per slice of a slab: label_count vote maps + weight sum + fused labels, and about 8 working arrays
+    # (target, atlas image/labels, differences, local MSD, weights, indices) over the slab including the halo
+    slice_bytes = shape[0] * shape[1] * 4
+    budget = memory_limit / max(1, threads) / slice_bytes
+    depth = int((budget - 8 * 2 * halo) / (label_count + 10))
+    return max(1, min(shape[2], depth))
+
+
+def fuse_slab(target, atlases, z_start, z_end, kernel, halo):
+    # Locally weighted voting: every atlas votes with the inverse of its local mean squared intensity difference
+    # (Gaussian window) to the target. The slab is extended by the halo so that the smoothing gives the same result
+    # as on the full volume.
+    depth = target.shape[2]
+    h_start = max(0, z_start - halo)
+    h_end = min(depth, z_end + halo)
+    inner = slice(z_start - h_start, z_end - h_start)
+
+    target_slab = target[:, :, h_start:h_end]
+    shape = target.shape[0:2] + (z_end - z_start,)
+    votes = numpy.zeros((label_count, ) + shape, dtype=numpy.float32)
+    weight_sum = numpy.zeros(shape, dtype=numpy.float32)
+    voxels = numpy.arange(weight_sum.size)
+
+    for atlas_image, atlas_labels in atlases:
+        source = malpem.imageio.load_slab(atlas_image, h_start, h_end).astype(numpy.float32)
+        source -= target_slab
+        source *= source
+        msd = scipy.ndimage.gaussian_filter(source, kernel, mode="nearest", truncate=truncate)[:, :, inner]
+        weights = 1.0 / (msd + epsilon)
+
+        labels = numpy.rint(malpem.imageio.load_slab(atlas_labels, z_start, z_end)).astype(numpy.intp)
+        labels[(labels < 0) | (labels >= label_count)] = 0
+
+        votes.reshape(label_count, -1)[labels.ravel(), voxels] += weights.ravel()
+        weight_sum += weights
+
+    votes /= weight_sum
+    return votes, votes.argmax(axis=0)
+
+
+def lwf_native(input_file, a_images_scaled, a_labels, output_fusion, output_prob, compact=False):
+    # Same inputs/outputs as cl_gaussian_fusion, but only one slab (per thread) of all probability maps is held in
+    # memory. The atlases are read slab by slab, which is cheapest for uncompressed images. With compact, the
+    # probability maps are written slab by slab to one compact file (malpem.posteriors) instead of one NIfTI file per
+    # label.
+    target, target_image = malpem.imageio.load_image(input_file)
+    target = intensity_normalise.robust_rescale_array(target).astype(numpy.float32)
+    target = target.reshape(target_image.shape[0:3])
+
+    atlases = []
+    for i in range(len(a_images_scaled)):
+        atlas_image = nibabel.load(a_images_scaled[i])
+        atlas_labels = nibabel.load(a_labels[i])
+        if not atlas_image.shape[0:3] == target.shape or not atlas_labels.shape[0:3] == target.shape:
+            print "--- ERROR: image dimensions of propagated atlas differ from target: " + a_labels[i] + " ---"
+            exit(1)
+        atlases.append((atlas_image, atlas_labels))
+
+    # The kernel is defined in mm
+    kernel = [sigma / float(zoom) for zoom in target_image.header.get_zooms()[0:3]]
+    halo = int(truncate * kernel[2] + 0.5)
+    threads = max(1, int(fusion_threads))
+    depth = get_slab_depth(target.shape, halo, threads)
+    slabs = [(z, min(z + depth, target.shape[2])) for z in range(0, target.shape[2], depth)]
+    print "Native label fusion: " + str(len(slabs)) + " slab(s) of " + str(depth) + " slices, " + \
+          str(threads) + " thread(s)"
+
+    fusion_writer = malpem.imageio.SlabWriter(output_fusion, target_image, atlases[0][1].get_data_dtype())
+    if compact:
+        prob_writer = malpem.posteriors.PosteriorWriter(malpem.posteriors.get_compact_file(output_prob), target_image,
+                                                        label_count)
+    else:
+        prob_writers = [malpem.imageio.SlabWriter(malpem.posteriors.get_nifti_file(output_prob, label), target_image,
+                                                  numpy.float32) for label in range(label_count)]
+
+    # One batch holds a slab per thread, the results are written in slab order
+    pool = multiprocessing.pool.ThreadPool(threads)
+    for batch in range(0, len(slabs), threads):
+        results = pool.map(lambda slab: fuse_slab(target, atlases, slab[0], slab[1], kernel, halo),
+                           slabs[batch:batch + threads])
+        for slab, (votes, fusion) in zip(slabs[batch:batch + threads], results):
+            for label in range(label_count):
+                if compact:
+                    prob_writer.add(label, votes[label], slab[0])
+                else:
+                    prob_writers[label].write(votes[label])
+            fusion_writer.write(fusion)
+    pool.close()
+    pool.join()
+
+    if compact:
+        prob_writer.close()
+    else:
+        for writer in prob_writers:
+            writer.close()
+    fusion_writer.close()
+
+
+def get_scaled_file(input_file, output_dir):
+    # Intensity normalised target of cl_gaussian_fusion (reused if it exists)
+    return malpem.mytools.intermediate_file(os.path.join(output_dir, "tmp_fusion/"),
+                                            malpem.mytools.nifty_basename(input_file) + "_scaled")
 
-def lwf(input_file, a_images_scaled, a_labels, output_fusion, output_prob, output_dir):
+
+def lwf(input_file, a_images_scaled, a_labels, output_fusion, output_prob, output_dir, compact=False):
 # DEFINITIONS
     binary_labelfusion = os.path.join(malpem.mytools.__malpem_path__, "lib", "irtk", "cl_gaussian_fusion")
 # END DEFINITIONS
@@ -29,6 +153,12 @@ def lwf(input_file, a_images_scaled, a_labels, output_fusion, output_prob, outpu
         print "--- ERROR: number of atlas images/labels not identical ---"
         exit(1)
 
+    if engine == "native":
+        lwf_native(input_file, a_images_scaled, a_labels, output_fusion, output_prob, compact)
+        malpem.mytools.ensure_file(output_fusion, "")
+        malpem.mytools.finished_task(start_time, task_name)
+        return True
+
     a_count = len(a_images_scaled)
     a_parameters = ""
     for i in range(len(a_images_scaled)):
@@ -37,7 +167,7 @@ def lwf(input_file, a_images_scaled, a_labels, output_fusion, output_prob, outpu
     tmp_dir = os.path.join(output_dir, "tmp_fusion/")
     malpem.mytools.check_ex_dir(tmp_dir)
 
-    input_scaled = os.path.join(tmp_dir, malpem.mytools.nifty_basename(input_file) + "_scaled.nii.gz")
+    input_scaled = get_scaled_file(input_file, output_dir)
 
     if not os.path.isfile(input_scaled):
         intensity_normalise.robust_rescale(input_file, input_scaled, output_dir)
@@ -49,6 +179,10 @@ def lwf(input_file, a_images_scaled, a_labels, output_fusion, output_prob, outpu
 
     malpem.mytools.execute_cmd(binary_labelfusion, parameters_labelfusion, logfile)
 
+    # cl_gaussian_fusion only writes NIfTI files, they are converted while they are still in the page cache
+    if compact:
+        malpem.posteriors.nifti_to_compact(output_prob, label_count, delete=True)
+
     malpem.mytools.ensure_file(output_fusion, "")
     malpem.mytools.finished_task(start_time, task_name)
 
@@ -56,95 +190,18 @@ def lwf(input_file, a_images_scaled, a_labels, output_fusion, output_prob, outpu
 
 
 def create_tissue_seg(input_file, input_seg, output_seg, output_dir):
-# DEFINITIONS
-    binary_segmaths = os.path.join(malpem.mytools.__malpem_path__, "lib", "niftyseg", "seg_maths")
-
-    # NMM STRUCTURE IDs FOR RESPECTIVE TISSUE CLASSES
-    vent_list = [1, 2, 21, 22, 23, 24]
-    cgm_list = range(41, 139, 1)
-    dgm_list = range(1, 41, 1)
-    wm_list = [12, 13, 16, 17]
-    other_list = [14, 15, 18, 33, 34]
-    for i in wm_list:
-        dgm_list.remove(i)
-    for i in vent_list:
-        dgm_list.remove(i)
-    for i in other_list:
-        dgm_list.remove(i)
-# END DEFINITIONS
-
     task_name = "creating tissue segmentation from structural segmentation"
     start_time = malpem.mytools.start_task(task_name)
 
     malpem.mytools.ensure_file(input_seg, "")
 
-    log_dir = os.path.join(output_dir, "log/")
-    malpem.mytools.check_ex_dir(log_dir)
-    logfile = os.path.join(log_dir, "tissue-" + malpem.mytools.nifty_basename(input_file) + ".log")
-
-    parameters_segmaths = input_seg + " -mul 0 " + output_seg
-    malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-
-    for i in vent_list:
-        parameters_segmaths = input_seg + " -thr " + str(i-1) + " -uthr " + str(i+1) + " -bin -mul 1 -add " + \
-                              output_seg + " " + output_seg
-        malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-
-# DEEP GRAY MATTER, HANDLE CONSECUTIVE CLASSES SPECIAL TO ACCELERATE
-    low = 0
-    high = 0
-    for i in dgm_list:
-        if low == 0:
-            low = i
-        if high == 0:
-            high = i
-        elif high == i - 1:
-            high = i
-        else:
-            parameters_segmaths = input_seg + " -thr " + str(low-1) + " -uthr " + str(high+1) + " -bin -mul 2 -add " + \
-                                  output_seg + " " + output_seg
-            malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-            low = i
-            high = i
-
-    if low > 0:
-        parameters_segmaths = input_seg + " -thr " + str(low-1) + " -uthr " + str(high+1) + " -bin -mul 2 -add " + \
-                              output_seg + " " + output_seg
-        malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-# DONE DGM
-
-# CORTICAL GRAY MATTER, HANDLE CONSECUTIVE CLASSES SPECIAL TO ACCELERATE
-    low = 0
-    high = 0
-    for i in cgm_list:
-        if low == 0:
-            low = i
-        if high == 0:
-            high = i
-        elif high == i - 1:
-            high = i
-        else:
-            parameters_segmaths = input_seg + " -thr " + str(low-1) + " -uthr " + str(high+1) + " -bin -mul 3 -add " + \
-                                  output_seg + " " + output_seg
-            malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-            low = i
-            high = i
-
-    if low > 0:
-        parameters_segmaths = input_seg + " -thr " + str(low-1) + " -uthr " + str(high+1) + " -bin -mul 3 -add " + \
-                              output_seg + " " + output_seg
-        malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-# DONE CGM
-
-    for i in wm_list:
-        parameters_segmaths = input_seg + " -thr " + str(i-1) + " -uthr " + str(i+1) + " -bin -mul 4 -add " + \
-                              output_seg + " " + output_seg
-        malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-
-    for i in other_list:
-        parameters_segmaths = input_seg + " -thr " + str(i-1) + " -uthr " + str(i+1) + " -bin -mul 5 -add " + \
-                              output_seg + " " + output_seg
-        malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
+    # A single lookup table pass maps every structure ID to its tissue class (IDs outside of the table: background)
+    tissue_lut = numpy.array(malpem.tissues.get_tissue_table())
+    seg, seg_image = malpem.imageio.load_image(input_seg)
+    seg = numpy.rint(seg).astype(numpy.int64)
+    seg[(seg < 0) | (seg >= len(tissue_lut))] = 0
+
+    malpem.imageio.save_image(tissue_lut[seg], seg_image, output_seg)
 
     malpem.mytools.ensure_file(output_seg, "")
     malpem.mytools.finished_task(start_time, task_name)
@@ -152,84 +209,47 @@ def create_tissue_seg(input_file, input_seg, output_seg, output_dir):
 
 
 def create_tissue_maps(input_file, malpem_prob_dir, output_dir):
-    # DEFINITIONS
-    binary_segmaths = os.path.join(malpem.mytools.__malpem_path__, "lib", "niftyseg", "seg_maths")
-
-    # NMM STRUCTURE IDs FOR RESPECTIVE TISSUE CLASSES
-    vent_list = [1, 2, 21, 22, 23, 24]
-    cgm_list = range(41, 139, 1)
-    dgm_list = range(1, 41, 1)
-    wm_list = [12, 13, 16, 17]
-    other_list = [14, 15, 18, 33, 34]
-    
-    for i in wm_list:
-        dgm_list.remove(i)
-    for i in vent_list:
-        dgm_list.remove(i)
-    for i in other_list:
-        dgm_list.remove(i)
-    # END DEFINITIONS
-
     task_name = "creating tissue probability maps from structural segmentation maps"
     start_time = malpem.mytools.start_task(task_name)
 
-    log_dir = os.path.join(output_dir, "log/")
-    malpem.mytools.check_ex_dir(log_dir)
-    logfile = os.path.join(log_dir, "tissue-maps-" + malpem.mytools.nifty_basename(input_file) + ".log")
-
-    tissue_dummy = os.path.join(malpem_prob_dir, "posteriors_0.nii.gz")
-    tissue_bg = os.path.join(malpem_prob_dir, "tissueMap_background.nii.gz")
-    tissue_vent = os.path.join(malpem_prob_dir, "tissueMap_ventricles.nii.gz")
-    tissue_dgm = os.path.join(malpem_prob_dir, "tissueMap_dGM.nii.gz")
-    tissue_cgm = os.path.join(malpem_prob_dir, "tissueMap_cGM.nii.gz")
-    tissue_wm = os.path.join(malpem_prob_dir, "tissueMap_WM.nii.gz")
-    tissue_other = os.path.join(malpem_prob_dir, "tissueMap_other.nii.gz")
-
-    malpem.mytools.ensure_file(tissue_dummy, "")
-
-    parameters_segmaths = tissue_dummy + " -mul 0 "
-    for i in vent_list:
-        cur_map = os.path.join(malpem_prob_dir, "posteriors_" + str(i) + ".nii.gz")
-        malpem.mytools.ensure_file(cur_map, "")
-        parameters_segmaths += " -add " + cur_map
-    parameters_segmaths += " " + tissue_vent
-    malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-
-    parameters_segmaths = tissue_dummy + " -mul 0 "
-    for i in dgm_list:
-        cur_map = os.path.join(malpem_prob_dir, "posteriors_" + str(i) + ".nii.gz")
-        malpem.mytools.ensure_file(cur_map, "")
-        parameters_segmaths += " -add " + cur_map
-    parameters_segmaths += " " + tissue_dgm
-    malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-
-    parameters_segmaths = tissue_dummy + " -mul 0 "
-    for i in cgm_list:
-        cur_map = os.path.join(malpem_prob_dir, "posteriors_" + str(i) + ".nii.gz")
-        malpem.mytools.ensure_file(cur_map, "")
-        parameters_segmaths += " -add " + cur_map
-    parameters_segmaths += " " + tissue_cgm
-    malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-
-    parameters_segmaths = tissue_dummy + " -mul 0 "
-    for i in wm_list:
-        cur_map = os.path.join(malpem_prob_dir, "posteriors_" + str(i) + ".nii.gz")
-        malpem.mytools.ensure_file(cur_map, "")
-        parameters_segmaths += " -add " + cur_map
-    parameters_segmaths += " " + tissue_wm
-    malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-
-    parameters_segmaths = tissue_dummy + " -mul 0 "
-    for i in other_list:
-        cur_map = os.path.join(malpem_prob_dir, "posteriors_" + str(i) + ".nii.gz")
-        malpem.mytools.ensure_file(cur_map, "")
-        parameters_segmaths += " -add " + cur_map
-    parameters_segmaths += " " + tissue_other
-    malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
-
-    parameters_segmaths = tissue_dummy + " -add 1 -bin -sub " + tissue_vent + " -sub " + tissue_dgm + \
-                        " -sub " + tissue_cgm + " -sub " + tissue_wm + " -sub " + tissue_other + " " + tissue_bg
-    malpem.mytools.execute_cmd(binary_segmaths, parameters_segmaths, logfile)
+    tissue_table = malpem.tissues.get_tissue_table()
+    prob_base = os.path.join(malpem_prob_dir, "posteriors")
+
+    # One pass over the posteriors accumulates all tissue maps, the background is the remainder
+    # inside the image domain (posteriors are -1 in the padded region)
+    if malpem.posteriors.exists(prob_base):
+        reader = malpem.posteriors.PosteriorReader(malpem.posteriors.get_compact_file(prob_base))
+        dummy_image = reader.get_reference()
+        tissue_sums = reader.get_sums(tissue_table, len(malpem.tissues.tissue_classes) + 1)
+        tissue_maps = {}
+        for tissue_id, tissue_name, report_name in malpem.tissues.tissue_classes:
+            tissue_maps[tissue_id] = tissue_sums[tissue_id]
+        domain = ~reader.padding.reshape(reader.shape)
+    else:
+        tissue_dummy = malpem.posteriors.get_nifti_file(prob_base, 0)
+        malpem.mytools.ensure_file(tissue_dummy, "")
+
+        dummy, dummy_image = malpem.imageio.load_image(tissue_dummy)
+        tissue_maps = {}
+        for tissue_id, tissue_name, report_name in malpem.tissues.tissue_classes:
+            tissue_maps[tissue_id] = numpy.zeros(dummy.shape, dtype=numpy.float32)
+
+        for i in range(1, len(tissue_table)):
+            if tissue_table[i] == 0:
+                continue
+            cur_map = malpem.posteriors.get_nifti_file(prob_base, i)
+            malpem.mytools.ensure_file(cur_map, "")
+            posterior, posterior_image = malpem.imageio.load_image(cur_map)
+            tissue_maps[tissue_table[i]] += posterior
+        domain = dummy != -1
+
+    tissue_bg = domain.astype(numpy.float32)
+    for tissue_id, tissue_name, report_name in malpem.tissues.tissue_classes:
+        tissue_bg -= tissue_maps[tissue_id]
+        malpem.imageio.save_image(tissue_maps[tissue_id], dummy_image,
+                                  os.path.join(malpem_prob_dir, "tissueMap_" + tissue_name + ".nii.gz"))
+
+    malpem.imageio.save_image(tissue_bg, dummy_image, os.path.join(malpem_prob_dir, "tissueMap_background.nii.gz"))
 
     malpem.mytools.finished_task(start_time, task_name)
     return True
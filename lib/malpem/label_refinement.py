@@ -7,12 +7,14 @@
 
 import os
 import malpem.mytools
+import malpem.posteriors
 
 mrf_low = 1.0
 mrf_high = 2.5
 gamma = -1
 
-def malpem_refinement(input_file, priors_prob_base, output_malpem, output_prob_dir, output_dir):
+def malpem_refinement(input_file, priors_prob_base, priors_count, output_malpem, output_prob_dir, output_dir,
+                      compact=False):
 # DEFINITIONS
     binary_MALPEMrefinement = os.path.join(malpem.mytools.__malpem_path__, "lib", "irtk", "cl_malpem")
     mrf_parameter_file = os.path.join(malpem.mytools.__malpem_path__, "etc", "conn139_HC.mrf")
@@ -30,15 +32,27 @@ def malpem_refinement(input_file, priors_prob_base, output_malpem, output_prob_d
     tmp_dir = os.path.join(output_dir, "tmp_malpem/")
     malpem.mytools.check_ex_dir(tmp_dir)
 
-    priors_dir = os.path.dirname(priors_prob_base)
-    priors_count = len([curfile for curfile in os.listdir(priors_dir)
-                                  if os.path.isfile(os.path.join(priors_dir, curfile))])
+    # Priors stored in the compact format are expanded for cl_malpem, only the labels that occur (the others share
+    # one empty map), and removed once cl_malpem has read them
+    expanded = not os.path.isfile(malpem.posteriors.get_nifti_file(priors_prob_base, 0)) and \
+        malpem.posteriors.exists(priors_prob_base)
+    if expanded:
+        priors_files = malpem.posteriors.expand_for_reading(priors_prob_base,
+                                                            os.path.join(tmp_dir, os.path.basename(priors_prob_base)),
+                                                            malpem.mytools.__malpem_intermediate_ext__)
+        if not len(priors_files) == priors_count:
+            print "--- ERROR: " + str(len(priors_files)) + " instead of " + str(priors_count) + " priors in " + \
+                  malpem.posteriors.get_compact_file(priors_prob_base) + " ---"
+            exit(1)
+    else:
+        priors_files = [malpem.posteriors.get_nifti_file(priors_prob_base, i) for i in range(priors_count)]
 
     priors_parameters = ""
     for i in range(priors_count):
-        priors_parameters = priors_parameters + " " + priors_prob_base + "_" + str(i) + ".nii.gz"
+        malpem.mytools.ensure_file(priors_files[i], "")
+        priors_parameters = priors_parameters + " " + priors_files[i]
 
-    garbage = os.path.join(tmp_dir, "garbage.nii.gz")
+    garbage = malpem.mytools.intermediate_file(tmp_dir, "garbage")
     parameters_MALPEMrefinement = input_file + " " + str(priors_count) + " " + priors_parameters + " " + \
                                   output_malpem + " -mrf " + mrf_parameter_file + " " + \
                                   " -padding -1 -mrfweights " + str(mrf_low) + " " + str(mrf_high) + \
@@ -50,6 +64,14 @@ def malpem_refinement(input_file, priors_prob_base, output_malpem, output_prob_d
 
     malpem.mytools.execute_cmd(binary_MALPEMrefinement, parameters_MALPEMrefinement, logfile)
 
+    if expanded:
+        for filename in set(priors_files):
+            os.remove(filename)
+
+    # cl_malpem only writes NIfTI files (posteriors_<label>.nii.gz), they are converted right away
+    if compact:
+        malpem.posteriors.nifti_to_compact(os.path.join(output_prob_dir, "posteriors"), priors_count, delete=True)
+
     malpem.mytools.ensure_file(output_malpem, "")
 
     malpem.mytools.finished_task(start_time, task_name)
@@ -0,0 +1,142 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Manifest of the NMM atlases (atlas/nmm/manifest.json): file names, sizes, checksums, dimensions, voxel sizes,
+# label sets and MNI dofs of all atlases. MALPEM reads the atlas list from it with a single read instead of listing
+# the atlas directory and checking every atlas file. The manifest is only used as long as the atlas directories
+# haven't changed since it was created (modification times of the directories), otherwise the atlases are listed
+# and checked as before. Create/verify it with bin/malpem-atlas-manifest.
+
+import os
+import json
+import time
+import hashlib
+import malpem.mytools
+
+manifest_version = 1
+# Directories of atlas/nmm whose modification time invalidates the manifest
+sub_dirs = ["mri_masked", "mri_masked_scaled", "labels", "mninorm"]
+# Files of every atlas (same file name in each directory)
+image_dirs = ["mri_masked", "mri_masked_scaled", "labels"]
+
+chunk_size = 1024 * 1024
+
+
+def get_manifest_file(a_dir):
+    return os.path.join(a_dir, "manifest.json")
+
+
+def get_dir_stamps(a_dir):
+    stamps = {}
+    for sub_dir in sub_dirs:
+        path = os.path.join(a_dir, sub_dir)
+        stamps[sub_dir] = repr(os.stat(path).st_mtime) if os.path.isdir(path) else ""
+    return stamps
+
+
+def hash_file(filename):
+    content_hash = hashlib.sha1()
+    f = open(filename, "rb")
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        content_hash.update(data)
+    f.close()
+    return content_hash.hexdigest()
+
+
+def describe_file(filename):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "sha1": hash_file(filename)}
+
+
+def create(a_dir):
+    # Reads every atlas file once (checksums, headers, labels) and writes the manifest
+    import numpy
+    import nibabel
+
+    atlases = []
+    for a_file in sorted(os.listdir(os.path.join(a_dir, "mri_masked"))):
+        name = malpem.mytools.nifty_basename(a_file)
+        print "Adding atlas " + name
+        entry = {"name": name, "file": a_file, "mni_dof": os.path.join("mninorm", name + ".dof.gz"), "files": {}}
+
+        for sub_dir in image_dirs:
+            filename = os.path.join(a_dir, sub_dir, a_file)
+            malpem.mytools.ensure_file(filename, "atlas " + name)
+            image = nibabel.load(filename)
+            info = describe_file(filename)
+            info["shape"] = [int(n) for n in image.shape[0:3]]
+            info["voxel_size"] = [float(size) for size in image.header.get_zooms()[0:3]]
+            entry["files"][sub_dir] = info
+
+        labels = numpy.unique(numpy.asanyarray(nibabel.load(os.path.join(a_dir, "labels", a_file)).dataobj))
+        entry["labels"] = [int(label) for label in labels]
+
+        mni_dof = os.path.join(a_dir, entry["mni_dof"])
+        if os.path.isfile(mni_dof):
+            entry["files"]["mninorm"] = describe_file(mni_dof)
+        atlases.append(entry)
+
+    manifest = {"version": manifest_version, "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "stamps": get_dir_stamps(a_dir), "atlases": atlases}
+
+    manifest_file = get_manifest_file(a_dir)
+    tmp_file = os.path.join(a_dir, ".tmp-" + str(os.getpid()) + "-manifest.json")
+    f = open(tmp_file, 'w')
+    json.dump(manifest, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp_file, manifest_file)
+    return manifest_file
+
+
+def load(a_dir):
+    # Atlas entries of the manifest, None if there is no manifest or the atlas directories changed
+    manifest_file = get_manifest_file(a_dir)
+    if not os.path.isfile(manifest_file):
+        return None
+
+    f = open(manifest_file)
+    try:
+        manifest = json.load(f)
+    except ValueError:
+        return None
+    finally:
+        f.close()
+
+    if not manifest.get("version") == manifest_version or not manifest.get("stamps") == get_dir_stamps(a_dir):
+        return None
+    return manifest["atlases"]
+
+
+def verify(a_dir):
+    # Compares every atlas file with size and checksum in the manifest, returns the number of problems
+    manifest_file = get_manifest_file(a_dir)
+    malpem.mytools.ensure_file(manifest_file, "atlas manifest")
+    f = open(manifest_file)
+    manifest = json.load(f)
+    f.close()
+
+    problems = 0
+    if not manifest["stamps"] == get_dir_stamps(a_dir):
+        print "Atlas directories changed since the manifest was created"
+        problems += 1
+
+    for entry in manifest["atlases"]:
+        for sub_dir in entry["files"]:
+            if sub_dir == "mninorm":
+                filename = os.path.join(a_dir, entry["mni_dof"])
+            else:
+                filename = os.path.join(a_dir, sub_dir, entry["file"])
+
+            if not os.path.isfile(filename):
+                print "Missing: " + filename
+                problems += 1
+            elif not describe_file(filename) == dict((key, entry["files"][sub_dir][key]) for key in ["size", "sha1"]):
+                print "Changed: " + filename
+                problems += 1
+    return problems
@@ -5,12 +5,16 @@
 #         see license file in project root directory
 
 
-from subprocess import call
 import os
 import time
+import malpem.trace
 
 __malpem_debug__ = "0"
 __malpem_path__ = "."
+# Extensions of intermediate files that never leave the run (images, dofs). Uncompressed files (".nii", ".dof")
+# save the zlib time of writing and reading them, final results are always written as ".nii.gz".
+__malpem_intermediate_ext__ = ".nii.gz"
+__malpem_intermediate_dof_ext__ = ".dof.gz"
 
 
 def nifty_basename(input_file):
@@ -23,6 +27,37 @@ def nifty_basename(input_file):
     return base
 
 
+def intermediate_file(directory, name):
+    return os.path.join(directory, name + __malpem_intermediate_ext__)
+
+
+def intermediate_dof(directory, name):
+    return os.path.join(directory, name + __malpem_intermediate_dof_ext__)
+
+
+def tmp_file(filename):
+    # Outputs are written under a unique temporary name in their directory and renamed once complete, so that an
+    # existing output file is always complete (also if the run is killed or several processes write it)
+    return os.path.join(os.path.dirname(filename), ".tmp-" + str(os.getpid()) + "-" + os.path.basename(filename))
+
+
+def is_tmp_file(filename):
+    return os.path.basename(filename).startswith(".tmp-")
+
+
+def commit_file(tmp, filename, message=""):
+    ensure_file(tmp, message)
+    os.rename(tmp, filename)
+
+
+def file_extension(filename):
+    # e.g. ".nii.gz", ".nii", ".dof.gz"
+    base, ext = os.path.splitext(os.path.basename(filename))
+    if ext == ".gz":
+        ext = os.path.splitext(base)[1] + ext
+    return ext
+
+
 def basename(input_file):
     base = os.path.basename(input_file)
     base = os.path.splitext(base)[0]
@@ -50,15 +85,17 @@ def execute_cmd(cmd, parameters, logfile):
         f.write(final_cmd + "\n")
         f.close()
 
-    call(final_cmd, shell=True)
+    malpem.trace.run_command(final_cmd, os.path.basename(cmd))
 
 
 def start_task(task):
     print("--- STARTED %s ---" % task)
+    malpem.trace.begin_stage(task)
     return time.time()
 
 
 def finished_task(start_time, task):
+    malpem.trace.end_stage(task, start_time)
     seconds = time.time() - start_time
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
@@ -0,0 +1,488 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Level loop of lib/pincram/pincram-0.2.3_ireg.sh (pincram, Heckemann et al. 2015) with the registrations and
+# transformations of every atlas as tasks of the MALPEM scheduler (--pincram native), instead of the jobs of the
+# script's own pool which checks for a free slot every 8 seconds. Each level (rigid, affine, nonrigid) registers the
+# atlases selected at the previous level, fuses their masks, ranks all atlases by NMI in the margin of the fused mask
+# and selects the best ones for the next level. Steps, parameters and file names are those of the script (working
+# directory tmp_pincram/native), the tasks of a level are traced as stage pincram-<level>. The fusion, morphology and
+# ranking of a level are computed in-process on the voxel arrays instead of one process per step and atlas
+# (postprocessing), only the transformed atlases and the data mask of the next level are files.
+
+import os
+import glob
+import shutil
+import numpy
+import scipy.ndimage
+import multiprocessing.pool
+import malpem.mytools
+import malpem.imageio
+import malpem.profiles
+import malpem.scheduler
+
+level_names = ["rigid", "affine", "nonrigid"]
+# Threshold of the fused masks (fraction of the atlases) per level
+thresholds = ["0.56", "0.60", "0.40"]
+# Dilation of the margin of the data mask (target of the next level)
+data_mask_dilations = [3, 3]
+# Number of best ranked atlases of which the mask of a level is built
+max_mask_atlases = 19
+# "numpy": mask fusion, morphology and NMI ranking in-process on the voxel arrays (thread pool), "binary": seg_maths,
+# dilation, erosion, subtract, padding and evaluation as in the script, "compare": both on the same files of every
+# level, the binary results are used and the differences are written to log/pincram_postprocessing.csv
+postprocessing = "numpy"
+# Bins per image of the joint histogram of the NMI
+nmi_bins = 64
+
+
+def get_dir(subject):
+    return os.path.join(subject.output_dir, "tmp_pincram", "native")
+
+
+def get_atlas_dir():
+    return os.path.join(malpem.mytools.__malpem_path__, "atlas", "pincram")
+
+
+def get_binary(name):
+    if name == "seg_maths":
+        return os.path.join(malpem.mytools.__malpem_path__, "lib", "niftyseg", name)
+    return os.path.join(malpem.mytools.__malpem_path__, "lib", "irtk", name)
+
+
+def get_file(subject, name):
+    return malpem.mytools.intermediate_file(get_dir(subject), name)
+
+
+def get_log(subject, name):
+    return os.path.join(get_dir(subject), "log", name + ".log")
+
+
+def get_atlas_count():
+    # The atlases are m1 ... mN
+    return len(glob.glob(os.path.join(get_atlas_dir(), "lmasks", "full", "m*.nii.gz")))
+
+
+def get_levels():
+    levels = malpem.profiles.get("pincram_levels")
+    if levels not in [1, 2]:
+        levels = 3
+    return levels
+
+
+def get_target(subject, level):
+    if level == 0:
+        return get_file(subject, "target-full")
+    return get_file(subject, "dmasked-" + level_names[level - 1])
+
+
+def get_selection_file(subject, level_name):
+    return os.path.join(get_dir(subject), "selection-" + level_name + ".csv")
+
+
+def get_registration_files(subject, level, index):
+    # Transformation, transformed image and transformed mask of atlas m<index> at a level
+    level_name = level_names[level]
+    return [os.path.join(get_dir(subject), "reg-s" + str(index) + "-" + level_name + ".dof.gz"),
+            get_file(subject, "srctr-" + level_name + "-s" + str(index)),
+            get_file(subject, "masktr-" + level_name + "-s" + str(index))]
+
+
+def get_outputs(subject, level=None, index=None):
+    # Files of the tasks that later tasks use (journal): preparation (no level), registration of atlas m<index> and
+    # selection of a level. The last selection writes the brain mask and removes all others.
+    if level is None:
+        return [get_file(subject, "target-full"), get_selection_file(subject, "init")]
+    if index is not None:
+        return get_registration_files(subject, level, index)
+    if level == get_levels() - 1:
+        return [subject.image_mask]
+    return [get_selection_file(subject, level_names[level]), get_target(subject, level + 1)]
+
+
+def read_list(filename):
+    f = open(filename)
+    items = [line.strip() for line in f if not line.strip() == ""]
+    f.close()
+    return items
+
+
+def write_list(filename, items):
+    f = open(filename, 'w')
+    for item in items:
+        f.write(str(item) + "\n")
+    f.close()
+
+
+def run(name, parameters, logfile):
+    malpem.mytools.execute_cmd(get_binary(name), parameters, logfile)
+
+
+def prepare(subject):
+    task_name = "pincram preparation"
+    start_time = malpem.mytools.start_task(task_name)
+
+    malpem.mytools.check_ex_dir(os.path.join(subject.output_dir, "tmp_pincram"))
+    malpem.mytools.check_ex_dir(get_dir(subject))
+    malpem.mytools.check_ex_dir(os.path.join(get_dir(subject), "log"))
+
+    atlas_count = get_atlas_count()
+    if atlas_count == 0:
+        print "--- ERROR: No pincram atlases in " + get_atlas_dir() + " ---"
+        exit(1)
+
+    # The script converts the target to float (its header reset is overwritten by this conversion)
+    data, image = malpem.imageio.load_image(subject.image_n4)
+    malpem.imageio.save_image(data, image, get_file(subject, "target-full"), numpy.float32)
+    write_list(get_selection_file(subject, "init"), range(1, atlas_count + 1))
+
+    malpem.mytools.finished_task(start_time, task_name)
+    return True
+
+
+def register(subject, level, index):
+    # Registration of atlas m<index> to the target of this level, transformation of its image and mask
+    level_name = level_names[level]
+    previous_name = "init" if level == 0 else level_names[level - 1]
+    if str(index) not in read_list(get_selection_file(subject, previous_name)):
+        print "Skipping pincram registration of atlas m" + str(index) + ": not selected at level " + previous_name
+        return True
+
+    task_name = "pincram registration (" + level_name + ", m" + str(index) + ")"
+    start_time = malpem.mytools.start_task(task_name)
+
+    work_dir = get_dir(subject)
+    atlas_file = "m" + str(index) + ".nii.gz"
+    source = os.path.join(get_atlas_dir(), "limages", "margin-d5" if level >= 2 else "full", atlas_file)
+    mask = os.path.join(get_atlas_dir(), "lmasks", "full", atlas_file)
+    dof_out, source_tgtspc, mask_tgtspc = get_registration_files(subject, level, index)
+    dof_in = os.path.join(work_dir, "reg-s" + str(index) + "-" + previous_name + ".dof.gz")
+    target = get_target(subject, level)
+    log_base = "reg-s" + str(index) + "-" + level_name
+
+    if level == 0:
+        # Initialisation with the MNI alignment of atlas and target
+        pre_dof = os.path.join(work_dir, "pre-s" + str(index) + ".dof.gz")
+        run("dofcombine", os.path.join(get_atlas_dir(), "mninorm", "m" + str(index) + ".dof.gz") + " " +
+            subject.mni_dof + " " + pre_dof + " -invert2", get_log(subject, log_base + "-dofcombine"))
+        parameters_ireg = target + " " + source + " -model Rigid -dofin " + pre_dof + " -dofout " + dof_out
+    elif level == 1:
+        parameters_ireg = target + " " + source + " -model Affine -dofin " + dof_in + " -dofout " + dof_out
+    else:
+        parameters_ireg = target + " " + source + " -dofin " + dof_in + " -dofout " + dof_out + " -parin " + \
+            os.path.join(malpem.mytools.__malpem_path__, "lib", "pincram", "lev" + str(level) + ".cfg") + \
+            " -parout " + os.path.join(work_dir, log_base + ".parout")
+    run("ireg", parameters_ireg, get_log(subject, log_base))
+    malpem.mytools.ensure_file(dof_out, "pincram registration")
+
+    run("transformation", mask + " " + mask_tgtspc + " -linear -dofin " + dof_out + " -target " + target,
+        get_log(subject, log_base + "-mask"))
+    run("transformation", source + " " + source_tgtspc + " -linear -dofin " + dof_out + " -target " + target,
+        get_log(subject, log_base + "-image"))
+    malpem.mytools.ensure_file(mask_tgtspc, "pincram transformation")
+    malpem.mytools.ensure_file(source_tgtspc, "pincram transformation")
+
+    malpem.mytools.finished_task(start_time, task_name)
+    return True
+
+
+def get_threads():
+    # Threads assigned to the task by the scheduler
+    return max(1, int(os.environ.get(malpem.scheduler.thread_variables[0], "1")))
+
+
+def average_masks(subject, masks, output_file, log_name):
+    parameters = " -add ".join(masks) + " -div " + str(len(masks)) + " " + output_file
+    run("seg_maths", parameters, get_log(subject, log_name))
+    malpem.mytools.ensure_file(output_file, "pincram mask fusion")
+
+
+def threshold(subject, input_file, value, output_file, log_name):
+    run("seg_maths", input_file + " -thr " + value + " -bin " + output_file, get_log(subject, log_name))
+    malpem.mytools.ensure_file(output_file, "pincram mask threshold")
+
+
+def get_nmi_binary(subject, target, source, mask, log_name):
+    logfile = get_log(subject, log_name)
+    run("evaluation", target + " " + source + " -Tp 0 -mask " + mask + " -linear", logfile)
+    f = open(logfile)
+    for line in f:
+        if "NMI" in line and len(line.split(" ")) > 1:
+            f.close()
+            return line.split(" ")[1].strip()
+    f.close()
+    return ""
+
+
+def rank_binary(subject, level, atlases):
+    # Fused mask of the registered atlases and its margin (seg_maths, dilation, erosion, subtract, padding), NMI of
+    # every atlas in the margin (evaluation). Returns the lines "<NMI>,<index>".
+    level_name = level_names[level]
+    masks = sorted([get_file(subject, "masktr-" + level_name + "-s" + index) for index in atlases])
+    tmask = get_file(subject, "tmask-" + level_name)
+    margin = get_file(subject, "emargin-" + level_name)
+    margin_dil = get_file(subject, "emargin-" + level_name + "-dil")
+    target_margin = get_file(subject, "emasked-" + level_name)
+    average_masks(subject, masks, get_file(subject, "tmask-" + level_name + "-atlas"), "tmask-" + level_name)
+    threshold(subject, get_file(subject, "tmask-" + level_name + "-atlas"), thresholds[level], tmask,
+              "tmask-" + level_name + "-thr")
+    run("dilation", tmask + " " + get_file(subject, "tmask-" + level_name + "-wide") + " -iterations 1",
+        get_log(subject, "noisy"))
+    run("erosion", tmask + " " + get_file(subject, "tmask-" + level_name + "-narrow") + " -iterations 1",
+        get_log(subject, "noisy"))
+    run("subtract", get_file(subject, "tmask-" + level_name + "-wide") + " " +
+        get_file(subject, "tmask-" + level_name + "-narrow") + " " + margin, get_log(subject, "noisy"))
+    run("dilation", margin + " " + margin_dil + " -iterations 3", get_log(subject, "noisy"))
+    run("padding", get_file(subject, "target-full") + " " + margin_dil + " " + target_margin + " 0 0",
+        get_log(subject, "noisy"))
+    malpem.mytools.ensure_file(target_margin, "pincram margin")
+
+    similarities = []
+    for index in read_list(get_selection_file(subject, "init")):
+        source_tgtspc = get_file(subject, "srctr-" + level_name + "-s" + index)
+        if os.path.isfile(source_tgtspc):
+            nmi = get_nmi_binary(subject, target_margin, source_tgtspc, margin_dil,
+                                 "evaluation-" + level_name + "-s" + index)
+            similarities.append(nmi + "," + index)
+    return similarities
+
+
+def build_masks_binary(subject, level, selection, last):
+    # Mask of the selected atlases, if not last the data mask (target of the next level). Returns the mask.
+    level_name = level_names[level]
+    selected_masks = [get_file(subject, "masktr-" + level_name + "-s" + index) for index in selection]
+    selected_atlas = get_file(subject, "tmask-" + level_name + "-sel-atlas")
+    selected_mask = get_file(subject, "tmask-" + level_name + "-sel")
+    average_masks(subject, selected_masks, selected_atlas, "tmask-" + level_name + "-sel")
+    threshold(subject, selected_atlas, thresholds[level], selected_mask, "tmask-" + level_name + "-sel-thr")
+    if last:
+        return malpem.imageio.load_image(selected_mask)[0]
+
+    wide = get_file(subject, "tmask-" + level_name + "-wide")
+    narrow = get_file(subject, "tmask-" + level_name + "-narrow")
+    data_margin = get_file(subject, "dmargin-" + level_name)
+    data_margin_dil = get_file(subject, "dmargin-" + level_name + "-dil")
+    threshold(subject, selected_atlas, "0.15", wide, "dmask-" + level_name + "-wide")
+    threshold(subject, selected_atlas, "0.99", narrow, "dmask-" + level_name + "-narrow")
+    run("subtract", wide + " " + narrow + " " + data_margin + " -no_norm", get_log(subject, "noisy"))
+    run("dilation", data_margin + " " + data_margin_dil + " -iterations " + str(data_mask_dilations[level]),
+        get_log(subject, "noisy"))
+    run("padding", get_file(subject, "target-full") + " " + data_margin_dil + " " + get_target(subject, level + 1) +
+        " 0 0", get_log(subject, "noisy"))
+    return None
+
+
+def load_float(filename):
+    return numpy.asarray(malpem.imageio.load_image(filename)[0], dtype=numpy.float32)
+
+
+def sum_masks(masks, pool):
+    # The masks are added in the order in which they are loaded (0/1 values, the float sum is exact)
+    total = None
+    for data in pool.imap_unordered(load_float, masks):
+        if total is None:
+            total = numpy.zeros(data.shape, numpy.float32)
+        elif not data.shape == total.shape:
+            print "--- ERROR: Transformed pincram masks differ in size ---"
+            exit(1)
+        total += data
+    return total
+
+
+def average_threshold(total, count, value):
+    # seg_maths <mask> -add ... -div <count> -thr <value> -bin (float32, -thr keeps values above the threshold)
+    return total / numpy.float32(count) > numpy.float32(value)
+
+
+def dilate(mask, iterations):
+    # IRTK dilation/erosion use the 26-neighbourhood
+    return scipy.ndimage.binary_dilation(mask, numpy.ones((3, 3, 3), bool), iterations)
+
+
+def erode(mask, iterations):
+    return scipy.ndimage.binary_erosion(mask, numpy.ones((3, 3, 3), bool), iterations, border_value=1)
+
+
+def get_entropy(p):
+    p = p[p > 0]
+    return -numpy.sum(p * numpy.log(p))
+
+
+def get_bins(values, bins):
+    value_min = values.min()
+    value_range = max(values.max() - value_min, 1e-6)
+    return numpy.minimum((values - value_min) * (bins / value_range), bins - 1).astype(numpy.int64)
+
+
+def get_nmi(target_bins, source_values):
+    # Normalised mutual information (H(T) + H(S)) / H(T, S) of the joint histogram
+    if source_values.size == 0:
+        return 0.0
+    histogram = numpy.bincount(target_bins * nmi_bins + get_bins(source_values, nmi_bins),
+                               minlength=nmi_bins ** 2).reshape(nmi_bins, nmi_bins)
+    p = histogram / float(histogram.sum())
+    joint_entropy = get_entropy(p)
+    if joint_entropy <= 0:
+        return 0.0
+    return (get_entropy(p.sum(1)) + get_entropy(p.sum(0))) / joint_entropy
+
+
+def rank_numpy(subject, level, atlases, target, pool):
+    # Same as rank_binary on the voxel arrays: fused mask, margin and NMI of every atlas in the margin
+    level_name = level_names[level]
+    masks = [get_file(subject, "masktr-" + level_name + "-s" + index) for index in atlases]
+    tmask = average_threshold(sum_masks(masks, pool), len(masks), thresholds[level])
+    margin = dilate(dilate(tmask, 1) & ~erode(tmask, 1), 3)
+
+    # evaluation -Tp 0 -mask: voxels of the margin with target intensity above the padding value
+    voxels = margin & (target > 0)
+    target_values = target[voxels]
+    if target_values.size == 0:
+        print "--- ERROR: Empty pincram margin at level " + level_name + " ---"
+        exit(1)
+    target_bins = get_bins(target_values, nmi_bins)
+
+    def get_similarity(index):
+        source_tgtspc = get_file(subject, "srctr-" + level_name + "-s" + index)
+        return "%.6f" % get_nmi(target_bins, load_float(source_tgtspc)[voxels]) + "," + index
+
+    indices = [index for index in read_list(get_selection_file(subject, "init"))
+               if os.path.isfile(get_file(subject, "srctr-" + level_name + "-s" + index))]
+    return pool.map(get_similarity, indices)
+
+
+def build_masks_numpy(subject, level, selection, target, pool):
+    # Same as build_masks_binary on the voxel arrays, only the data mask (target of the next level) is written
+    level_name = level_names[level]
+    selected_masks = [get_file(subject, "masktr-" + level_name + "-s" + index) for index in selection]
+    total = sum_masks(selected_masks, pool)
+    if level == get_levels() - 1:
+        return average_threshold(total, len(selected_masks), thresholds[level])
+
+    margin = average_threshold(total, len(selected_masks), "0.15") & \
+        ~average_threshold(total, len(selected_masks), "0.99")
+    data_mask = dilate(margin, data_mask_dilations[level])
+    malpem.imageio.save_image(numpy.where(data_mask, target, 0), malpem.imageio.load_image(
+        get_file(subject, "target-full"))[1], get_target(subject, level + 1), numpy.float32)
+    return None
+
+
+def sort_ranking(similarities):
+    # Same order as 'sort -rn' of the lines "<NMI>,<index>": by NMI, then by the whole line (both descending)
+    def get_key(line):
+        try:
+            return float(line.split(",")[0]), line
+        except ValueError:
+            return 0.0, line
+    return sorted(similarities, key=get_key, reverse=True)
+
+
+def get_compare_file(subject):
+    return os.path.join(subject.output_dir, "log", "pincram_postprocessing.csv")
+
+
+def compare_postprocessing(subject, level_name, similarities_numpy, similarities_binary, mask_numpy, mask_binary):
+    # One line per level: whether the rankings are identical, the first rank that differs, the largest difference
+    # of the NMI values and the number of voxels in which the masks differ
+    ranking_numpy = [line.split(",")[1] for line in similarities_numpy]
+    ranking_binary = [line.split(",")[1] for line in similarities_binary]
+    first_difference = ""
+    for rank in range(max(len(ranking_numpy), len(ranking_binary))):
+        if rank >= len(ranking_numpy) or rank >= len(ranking_binary) or \
+                not ranking_numpy[rank] == ranking_binary[rank]:
+            first_difference = str(rank + 1)
+            break
+
+    nmi_numpy = dict((line.split(",")[1], line.split(",")[0]) for line in similarities_numpy)
+    nmi_difference = 0.0
+    for line in similarities_binary:
+        try:
+            nmi_difference = max(nmi_difference, abs(float(line.split(",")[0]) - float(nmi_numpy[line.split(",")[1]])))
+        except (KeyError, ValueError):
+            nmi_difference = float("inf")
+    mask_difference = int(numpy.sum((numpy.asarray(mask_numpy) != 0) != (numpy.asarray(mask_binary) != 0)))
+
+    # Restarted with the first level
+    compare_file = get_compare_file(subject)
+    if level_name == level_names[0] and os.path.isfile(compare_file):
+        os.remove(compare_file)
+    new_file = not os.path.isfile(compare_file)
+    f = open(compare_file, 'a')
+    if new_file:
+        f.write("Level,Identical ranking,First difference [rank],Max. NMI difference,Mask difference [voxels]\n")
+    f.write(",".join([level_name, str(first_difference == ""), first_difference, str(nmi_difference),
+                      str(mask_difference)]) + "\n")
+    f.close()
+    print "pincram postprocessing (" + level_name + "): ranking " + \
+          ("identical" if first_difference == "" else "differs from rank " + first_difference) + ", " + \
+          str(mask_difference) + " mask voxel(s) differ"
+
+
+def select(subject, level):
+    # Fused mask of the level, NMI ranking of all atlases in its margin, selection for the next level
+    level_name = level_names[level]
+    previous_name = "init" if level == 0 else level_names[level - 1]
+    last = level == get_levels() - 1
+    task_name = "pincram selection (" + level_name + ")"
+    start_time = malpem.mytools.start_task(task_name)
+
+    work_dir = get_dir(subject)
+    atlases = read_list(get_selection_file(subject, previous_name))
+    if len(atlases) == 0:
+        print "--- ERROR: No registered pincram atlases at level " + level_name + " ---"
+        exit(1)
+
+    # Reference for the atlas selection (fused from all)
+    pool = None
+    if not postprocessing == "binary":
+        target = load_float(get_file(subject, "target-full"))
+        pool = multiprocessing.pool.ThreadPool(get_threads())
+        similarities = rank_numpy(subject, level, atlases, target, pool)
+    if not postprocessing == "numpy":
+        if postprocessing == "compare":
+            similarities_numpy = similarities
+        similarities = rank_binary(subject, level, atlases)
+
+    # Selection
+    similarities = sort_ranking(similarities)
+    ranking = [line.split(",")[1] for line in similarities]
+    write_list(os.path.join(work_dir, "simm-" + level_name + ".csv"), similarities)
+    write_list(os.path.join(work_dir, "ranking-" + level_name + ".csv"), ranking)
+
+    atlas_count = len(read_list(get_selection_file(subject, "init")))
+    use_percent = int("%.0f" % (100 * (8.0 / atlas_count) ** (1.0 / 3)))
+    selected = len(atlases) * use_percent / 100
+    if selected < 9:
+        selected = 7
+    write_list(get_selection_file(subject, level_name), ranking[0:selected])
+    if len(ranking) > selected:
+        write_list(os.path.join(work_dir, "unselected-" + level_name + ".csv"), ranking[selected:])
+    print "Selected " + str(selected) + " at " + level_name
+
+    # Label from the selection (the data mask is compared if not last, the numpy mask is overwritten by the binary)
+    if not postprocessing == "binary":
+        mask = build_masks_numpy(subject, level, ranking[0:selected][0:max_mask_atlases], target, pool)
+        pool.close()
+        pool.join()
+    if not postprocessing == "numpy":
+        if postprocessing == "compare":
+            mask_numpy = mask if last else malpem.imageio.load_image(get_target(subject, level + 1))[0]
+        mask = build_masks_binary(subject, level, ranking[0:selected][0:max_mask_atlases], last)
+        if postprocessing == "compare":
+            mask_binary = mask if last else malpem.imageio.load_image(get_target(subject, level + 1))[0]
+            compare_postprocessing(subject, level_name, sort_ranking(similarities_numpy), similarities, mask_numpy,
+                                   mask_binary)
+
+    if last:
+        # Brain mask in the geometry of the input image
+        malpem.imageio.save_image(mask, malpem.imageio.load_image(subject.image_n4)[1], subject.image_mask,
+                                  numpy.int16)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        malpem.mytools.ensure_file(get_target(subject, level + 1), "pincram data mask")
+
+    malpem.mytools.finished_task(start_time, task_name)
+    return True
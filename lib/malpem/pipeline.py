@@ -0,0 +1,558 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+import os
+import time
+import shutil
+import numpy
+import nibabel
+import malpem.mytools
+import malpem.bias_correction
+import malpem.brain_extraction
+import malpem.crop
+import malpem.journal
+import malpem.pincram
+import malpem.label_fusion
+import malpem.label_refinement
+import malpem.manifest
+import malpem.posteriors
+import malpem.tissues
+import malpem.scratch
+import malpem.trace
+import malpem.registration
+import malpem.report
+import malpem.resources
+import malpem.atlas_selection
+
+
+class Atlas(object):
+    def __init__(self, a_file, metadata=None):
+        a_dir = os.path.join(malpem.mytools.__malpem_path__, "atlas", "nmm")
+
+        self.name = malpem.mytools.nifty_basename(a_file)
+        # entry of the atlas manifest (checksums, dimensions, voxel sizes, labels) if available
+        self.metadata = metadata
+        # brain extracted MR image of the atlas (registration source)
+        self.image = os.path.join(a_dir, "mri_masked", a_file)
+        # intensity normalised atlas image for weighted label fusion
+        self.image_scaled = os.path.join(a_dir, "mri_masked_scaled", a_file)
+        # labels to be propagated
+        self.labels = os.path.join(a_dir, "labels", a_file)
+        # rigid dof of the atlas image to MNI space (used for initialisation)
+        self.mni_dof = os.path.join(a_dir, "mninorm", self.name + ".dof.gz")
+
+
+def get_atlases():
+    a_dir = os.path.join(malpem.mytools.__malpem_path__, "atlas", "nmm")
+    a_images_dir = os.path.join(a_dir, "mri_masked")
+
+    # An up to date manifest lists the atlases without touching the atlas files (missing files are reported by
+    # the tasks using them)
+    entries = malpem.manifest.load(a_dir)
+    if entries is not None:
+        return [Atlas(str(entry["file"]), entry) for entry in entries]
+    print "Checking atlas files (no up to date atlas manifest, see bin/malpem-atlas-manifest)"
+
+    atlases = []
+    for a_file in sorted(os.listdir(a_images_dir)):
+        atlas = Atlas(a_file)
+        malpem.mytools.ensure_file(atlas.labels, "")
+        malpem.mytools.ensure_file(atlas.image, "")
+        malpem.mytools.ensure_file(atlas.image_scaled, "")
+        atlases.append(atlas)
+
+    return atlases
+
+
+class Subject(object):
+    # All files of one MALPEM run, creating the output directories and copying user provided input files
+    def __init__(self, input_file, output_dir, create_subdir, atlases, field_strength="1.5T", input_mask="",
+                 mni_init_dof="", do_n4=True, do_n4_pincram=True, pincram_threads="1", atlas_select=0,
+                 scratch_dir=""):
+        self.input_file = input_file
+        self.field_strength = field_strength
+        self.do_n4 = do_n4
+        self.do_n4_pincram = do_n4_pincram
+        self.pincram_threads = str(pincram_threads)
+        # Size of the input image for the memory estimates of the tasks
+        self.voxels = int(numpy.prod(nibabel.load(input_file).shape[0:3]))
+
+## I) General output files
+        self.base_file = malpem.mytools.nifty_basename(input_file)
+        malpem.mytools.check_ex_dir(output_dir)
+
+        if create_subdir:
+            output_dir = os.path.join(output_dir, self.base_file + "_" + time.strftime("%d-%m-%y_%H-%M-%S"))
+
+        malpem.mytools.check_ex_dir(output_dir)
+
+        # With a scratch directory all stages work in a directory on local disk, only the results are copied to
+        # the output directory (final_output_dir)
+        self.final_output_dir = output_dir
+        if not scratch_dir == "":
+            work_dir = malpem.scratch.create(scratch_dir, self.base_file)
+            if not work_dir == "":
+                print "Working directory: " + work_dir
+                output_dir = work_dir
+
+        self.output_dir = output_dir
+
+        self.tmp_dir = os.path.join(output_dir, "tmp/")
+        malpem.mytools.check_ex_dir(self.tmp_dir)
+
+        self.image_n4 = os.path.join(output_dir, self.base_file + "_N4.nii.gz")
+        # The N4 corrected image is moved here for the second bias correction, so it keeps its (compressed) format
+        self.image_n4_initial = os.path.join(self.tmp_dir, self.base_file + "_N4_initial.nii.gz")
+        self.image_n4_probe = malpem.mytools.intermediate_file(self.tmp_dir, self.base_file + "_N4_probe")
+        self.image_n4_masked = os.path.join(output_dir, self.base_file + "_N4_masked.nii.gz")
+        self.image_full_mask = os.path.join(output_dir, self.base_file + "_mask_full_image.nii.gz")
+
+        if not do_n4:
+            self.image_n4 = os.path.join(output_dir, self.base_file + "_noN4.nii.gz")
+            self.image_n4_masked = os.path.join(output_dir, self.base_file + "_noN4_masked.nii.gz")
+            shutil.copyfile(input_file, self.image_n4)
+
+        self.image_mask = os.path.join(output_dir, self.base_file + "_mask.nii.gz")
+        self.input_mask = input_mask
+
+        if not mni_init_dof == "":
+            shutil.copyfile(mni_init_dof, os.path.join(output_dir, "mni_init.dof.gz"))
+
+        self.mni_dof = os.path.join(output_dir, "mni-" + self.base_file + ".dof.gz")
+
+        self.segmentation_fusion = os.path.join(output_dir, self.base_file + "_fusion.nii.gz")
+        self.segmentation_malpem = os.path.join(output_dir, self.base_file + "_MALPEM.nii.gz")
+        self.segmentation_malpem_tissues = os.path.join(output_dir, self.base_file + "_MALPEM_tissues.nii.gz")
+
+        self.report_file = os.path.join(output_dir, self.base_file + "_Report.pdf")
+
+        self.fusion_prob_dir = os.path.join(output_dir, "prob_fusion/")
+        malpem.mytools.check_ex_dir(self.fusion_prob_dir)
+        self.fusion_prob_base = os.path.join(self.fusion_prob_dir, "probabilityMap")
+
+        self.malpem_prob_dir = os.path.join(output_dir, "prob_MALPEM/")
+        malpem.mytools.check_ex_dir(self.malpem_prob_dir)
+        self.malpem_prob_base = os.path.join(self.malpem_prob_dir, "posteriors")
+        # Probability maps in the compact format (set by add_subject_tasks)
+        self.compact_posteriors = False
+
+        # Execution timeline of all tasks
+        malpem.mytools.check_ex_dir(os.path.join(output_dir, "log"))
+        self.trace_file = os.path.join(output_dir, "log", "trace.jsonl")
+        # Finished tasks, decides which tasks are skipped on resume
+        self.journal_file = os.path.join(output_dir, "log", "journal.jsonl")
+
+        # Target of the stages after the brain extraction, with --crop the brain extracted image cropped to the mask
+        self.image_target = self.image_n4_masked
+        self.crop_box = os.path.join(output_dir, "log", "crop_box.json")
+        if malpem.crop.enabled:
+            self.image_target = malpem.mytools.intermediate_file(self.tmp_dir, self.base_file + "_N4_masked_crop")
+
+## II) Files for atlas propagation ##
+        self.atlases = atlases
+
+        # only the atlas_select most similar atlases are propagated (all if 0)
+        self.atlas_select = int(atlas_select)
+        self.atlas_selection_file = os.path.join(output_dir, "atlas_selection.csv")
+        self.atlas_selection_timing_file = os.path.join(output_dir, "atlas_selection_timing.csv")
+
+        # initialisation dofs for atlas registration (usually combined rigid transformations to MNI space)
+        self.a_init_dofs = []
+        # dofs (tgt=input, src=atlas) used for atlas propagation (will be calculated)
+        self.a_dofs = []
+        # propagated labels
+        self.a_labels_tgtspc = []
+        # propagated images
+        self.a_images_scaled_tgtspc = []
+        # deformation fields of the atlas dofs (source voxel coordinates of every voxel, resampling "field")
+        self.a_fields = []
+
+        a_dofs_dir = os.path.join(output_dir, "dofs/")
+        malpem.mytools.check_ex_dir(a_dofs_dir)
+        a_prop_dir = os.path.join(self.tmp_dir, "propagate/")
+        malpem.mytools.check_ex_dir(a_prop_dir)
+
+        for atlas in atlases:
+            self.a_dofs.append(malpem.mytools.intermediate_dof(a_dofs_dir, "dof-" + atlas.name + "-" + self.base_file))
+            self.a_init_dofs.append(malpem.mytools.intermediate_dof(a_dofs_dir, "init-" + atlas.name + "-" +
+                                                                    self.base_file))
+            self.a_labels_tgtspc.append(malpem.mytools.intermediate_file(a_prop_dir, "seg-" + atlas.name + "-" +
+                                                                         self.base_file))
+            self.a_images_scaled_tgtspc.append(malpem.mytools.intermediate_file(a_prop_dir, "mri-" + atlas.name +
+                                                                                "-" + self.base_file))
+            self.a_fields.append(malpem.mytools.intermediate_file(a_dofs_dir, "field-" + atlas.name + "-" +
+                                                                  self.base_file))
+
+        # Resume from the results of a previous run
+        if not self.output_dir == self.final_output_dir:
+            malpem.scratch.copy_results(self.final_output_dir, self.output_dir, self.get_results())
+
+    def get_results(self):
+        # Files and directories (relative to the output directory) that are kept when working in a scratch directory
+        results = []
+        for result in [self.image_n4, self.image_n4_masked, self.image_mask, self.image_full_mask, self.mni_dof,
+                       self.segmentation_fusion, self.segmentation_malpem, self.segmentation_malpem_tissues,
+                       self.report_file, self.atlas_selection_file, self.atlas_selection_timing_file,
+                       self.fusion_prob_dir, self.malpem_prob_dir]:
+            results.append(os.path.relpath(result, self.output_dir))
+        results += ["mni_init.dof.gz", "report", "log"]
+        if malpem.scratch.keep_dofs:
+            results.append("dofs")
+        return results
+
+
+def finish_subject(subject):
+    # Writes the timeline/summary of the run and copies the results back from the scratch directory
+    malpem.trace.write_reports(subject.trace_file)
+    finish_scratch(subject)
+    return True
+
+
+def finish_scratch(subject):
+    # Copies the results back and removes the working directory (no-op without scratch directory or if done)
+    if subject.output_dir == subject.final_output_dir or not os.path.isdir(subject.output_dir):
+        return True
+
+    task_name = "Copying results to " + subject.final_output_dir
+    start_time = malpem.mytools.start_task(task_name)
+    malpem.scratch.copy_results(subject.output_dir, subject.final_output_dir, subject.get_results())
+    malpem.scratch.remove(subject.output_dir)
+    malpem.mytools.finished_task(start_time, task_name)
+    return True
+
+
+def bias_correction(subject):
+    # perform bias correction with the full image domain as foreground to avoid using unpredictable OTSU mask
+    print "Creating artificial 'full image mask' to perform bias correction on complete image domain"
+    malpem.bias_correction.get_full_image_mask(subject.input_file, subject.image_full_mask)
+    malpem.bias_correction.N4(subject.input_file, subject.image_n4, subject.field_strength, subject.image_full_mask,
+                              subject.output_dir)
+
+
+def brain_extraction(subject):
+    # A mask of the user is copied here (not when the subject is set up), so a resumed run keeps the matched mask
+    if not subject.input_mask == "":
+        shutil.copyfile(subject.input_mask, subject.image_mask)
+    elif not os.path.isfile(subject.image_mask):
+        malpem.brain_extraction.pincram(subject.image_n4, subject.image_mask, subject.pincram_threads,
+                                        subject.output_dir)
+
+    # The mask gets the header of the image, so that both headers match numerically. This only rewrites the header
+    # of the mask unless the grids differ, then both are resampled (nearest neighbour) as before.
+    malpem.registration.match_header(subject.image_n4, subject.image_mask, subject.output_dir)
+
+    # Note that the MNI transformation above was calculated with the originally N4 corrected image
+    if subject.do_n4_pincram:
+        print "Running a second bias correction with the calculated brain mask"
+        # Move file to make sure file doesn't exist if this N4 fails and MALPEM doesn't continue silently
+        shutil.move(subject.image_n4, subject.image_n4_initial)
+        malpem.bias_correction.N4_refine(subject.image_n4_initial, subject.image_n4, subject.image_n4_probe,
+                                         subject.field_strength, subject.image_mask, subject.output_dir)
+
+    malpem.brain_extraction.apply_mask(subject.image_n4, subject.image_n4_masked, subject.image_mask)
+
+
+def is_selected(subject, index):
+    if subject.atlas_select <= 0 or subject.atlas_select >= len(subject.atlases):
+        return True
+    return subject.atlases[index].name in malpem.atlas_selection.read_selection(subject.atlas_selection_file)
+
+
+def register_atlas(subject, index):
+    atlas = subject.atlases[index]
+    if not is_selected(subject, index):
+        print "Skipping registration of atlas " + atlas.name + ": not selected"
+        return True
+
+    malpem.registration.dofcombine(atlas.mni_dof, subject.mni_dof, subject.a_init_dofs[index], False, True,
+                                   subject.output_dir)
+    malpem.registration.register(subject.image_target, atlas.image, subject.a_init_dofs[index],
+                                 subject.a_dofs[index], "nonrigid", subject.output_dir)
+
+
+def transform_atlas(subject, index, source, output_file, interpolation):
+    if not is_selected(subject, index):
+        print "Skipping transformation of atlas " + subject.atlases[index].name + ": not selected"
+        return True
+
+    malpem.registration.transform(subject.image_target, source, output_file, subject.a_dofs[index],
+                                  interpolation, subject.output_dir)
+
+
+def propagate_atlas(subject, index):
+    # Image and labels of an atlas resampled with one evaluation of its transformation
+    atlas = subject.atlases[index]
+    if not is_selected(subject, index):
+        print "Skipping propagation of atlas " + atlas.name + ": not selected"
+        return True
+
+    if atlas.metadata is not None:
+        same_grid = atlas.metadata["files"]["mri_masked_scaled"]["shape"] == atlas.metadata["files"]["labels"]["shape"]
+    else:
+        same_grid = nibabel.load(atlas.image_scaled).shape[0:3] == nibabel.load(atlas.labels).shape[0:3]
+    if not same_grid:
+        print "Image and labels of atlas " + atlas.name + " have different grids, transforming them separately"
+        transform_atlas(subject, index, atlas.image_scaled, subject.a_images_scaled_tgtspc[index], "linear")
+        transform_atlas(subject, index, atlas.labels, subject.a_labels_tgtspc[index], "nn")
+        return True
+
+    if not os.path.isfile(subject.a_fields[index]):
+        malpem.registration.deformation_field(subject.image_target, atlas.labels, subject.a_dofs[index],
+                                              subject.a_fields[index], subject.output_dir)
+    else:
+        print "Skipping deformation field (" + subject.a_fields[index] + "): file exists"
+
+    malpem.registration.resample_field(subject.image_target, subject.a_fields[index],
+                                       [atlas.image_scaled, atlas.labels],
+                                       [subject.a_images_scaled_tgtspc[index], subject.a_labels_tgtspc[index]],
+                                       ["linear", "nn"])
+
+
+def label_fusion(subject):
+    selected = [i for i in range(len(subject.atlases)) if is_selected(subject, i)]
+    malpem.label_fusion.lwf(subject.image_target, [subject.a_images_scaled_tgtspc[i] for i in selected],
+                            [subject.a_labels_tgtspc[i] for i in selected], subject.segmentation_fusion,
+                            subject.fusion_prob_base, subject.output_dir, subject.compact_posteriors)
+
+
+def get_cleanup_dirs(output_dir):
+    return [os.path.join(output_dir, name) for name in ["tmp", "tmp_fusion", "tmp_malpem", "tmp_pincram", "dofs"]]
+
+
+def cleanup(output_dir):
+    task_name_cu = "Cleaning up directories / deleting tmp files"
+    start_time_cu = malpem.mytools.start_task(task_name_cu)
+    for directory in get_cleanup_dirs(output_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+    malpem.mytools.finished_task(start_time_cu, task_name_cu)
+
+
+def get_prob_files(prob_base):
+    # Probability maps of all labels (NIfTI format)
+    return [malpem.posteriors.get_nifti_file(prob_base, label) for label in range(malpem.label_fusion.label_count)]
+
+
+def add_subject_tasks(scheduler, subject, pincram_only=False, create_report=True, do_cleanup=False,
+                      compact_posteriors=False):
+    # Adds the complete MALPEM pipeline of one subject to the task graph. Every task is started as soon as the tasks
+    # it depends on are finished, e.g. the transformations of an atlas start once its registration is done. Tasks are
+    # named after the subject so that several subjects can share one scheduler. The journal of the run decides
+    # which tasks are skipped on resume (see malpem.journal), all tasks are declared with their files first.
+    group = subject.base_file
+    subject.compact_posteriors = compact_posteriors
+    journal = malpem.journal.Journal(subject.journal_file, subject.output_dir, get_cleanup_dirs(subject.output_dir))
+    if journal.legacy:
+        print "No journal in " + subject.output_dir + ": resuming from existing files"
+    tasks = []
+    atlas_count = len(subject.atlases)
+    if 0 < subject.atlas_select < atlas_count:
+        atlas_count = subject.atlas_select
+
+    def add(stage, target, args, deps, atlas="", outputs=None, inputs=None, updates=None, rewrites=None,
+            removes=None):
+        # Tasks without outputs are not journaled and always run
+        name = stage if atlas == "" else stage + "-" + atlas
+        entry = malpem.journal.create_entry(name, malpem.journal.get_parameters(stage, subject),
+                                            [dep for dep in deps if dep is not None], inputs, outputs, updates,
+                                            rewrites, removes)
+        tasks.append((entry, stage, atlas, target, args))
+        return name
+
+    def schedule():
+        # Copy the results back from the scratch directory as soon as the subject is finished
+        if not subject.output_dir == subject.final_output_dir:
+            add("copy-results", finish_subject, (subject,), [task[0]["task"] for task in tasks])
+
+        run = journal.resolve([task[0] for task in tasks])
+        tasks_all = []
+        for entry, stage, atlas, target, args in tasks:
+            if entry["task"] not in run:
+                print "Skipping " + entry["task"] + ": finished"
+                if journal.legacy:
+                    journal.adopt(entry)
+                continue
+
+            if entry["outputs"] is not None:
+                target, args = malpem.journal.run_journaled, (subject.journal_file, subject.output_dir, entry, target,
+                                                              args)
+            # Every task is traced with its subject/stage/atlas tags and the estimated memory of its stage
+            threads, max_threads, memory = malpem.resources.get_cost(stage, subject.voxels, atlas_count,
+                                                                     subject.pincram_threads)
+            tags = {"subject": group, "stage": stage, "atlas": atlas, "task": entry["task"],
+                    "memory_estimate_mb": memory / 1024.0 ** 2}
+            tasks_all.append(scheduler.add(group + ":" + entry["task"], malpem.trace.run_traced,
+                                           (subject.trace_file, tags, target, args),
+                                           [group + ":" + dep for dep in entry["deps"]], group, threads, max_threads,
+                                           memory))
+        return tasks_all
+
+    # Run N4 Bias Correction (ITK implementation, parameters depend on 1.5T/3T)
+    task_n4 = None
+    if subject.do_n4:
+        task_n4 = add("N4", bias_correction, (subject,), [], outputs=[subject.image_n4, subject.image_full_mask],
+                      inputs=[subject.input_file])
+    else:
+        print "Skipping bias correction: specified by user"
+
+    # Align with MNI space (helpful as initialisation for both multi atlas label propagation and brain extraction)
+    mni_inputs = [] if subject.do_n4 else [subject.input_file]
+    mni_init_dof = os.path.join(subject.output_dir, "mni_init.dof.gz")
+    if os.path.isfile(mni_init_dof):
+        mni_inputs.append(mni_init_dof)
+    task_mni = add("mni", malpem.registration.dof2mni, (subject.image_n4, subject.mni_dof, "rigid", subject.output_dir),
+                   [task_n4], outputs=[subject.mni_dof], inputs=mni_inputs)
+
+    # Run brain extraction (pincram, Heckemann et al. 2015)
+    task_pincram = None
+    if malpem.brain_extraction.engine == "native" and subject.input_mask == "":
+        # Registrations of every level as single tasks, the brain extraction task finds the mask. The last selection
+        # removes the files of all pincram tasks.
+        pincram_files = malpem.pincram.get_outputs(subject)
+        task_pincram = add("pincram-prepare", malpem.pincram.prepare, (subject,), [task_n4, task_mni],
+                           outputs=malpem.pincram.get_outputs(subject))
+        for level in range(malpem.pincram.get_levels()):
+            level_name = malpem.pincram.level_names[level]
+            tasks_level = []
+            for index in range(1, malpem.pincram.get_atlas_count() + 1):
+                tasks_level.append(add("pincram-" + level_name, malpem.pincram.register, (subject, level, index),
+                                       [task_pincram], "m" + str(index),
+                                       outputs=malpem.pincram.get_outputs(subject, level, index)))
+                pincram_files += malpem.pincram.get_outputs(subject, level, index)
+            last = level == malpem.pincram.get_levels() - 1
+            task_pincram = add("pincram-select", malpem.pincram.select, (subject, level), tasks_level, level_name,
+                               outputs=malpem.pincram.get_outputs(subject, level),
+                               removes=list(pincram_files) if last else None)
+            pincram_files += malpem.pincram.get_outputs(subject, level)
+
+    # The mask is an output unless it is found by the native pincram tasks (the mask of the user is copied by the
+    # task), the header of the mask is matched and the second bias correction rewrites the N4 corrected image
+    outputs_masked = [subject.image_n4_masked]
+    updates_masked = []
+    if not subject.input_mask == "":
+        outputs_masked.append(subject.image_mask)
+    elif malpem.brain_extraction.engine == "script":
+        outputs_masked += [subject.image_mask,
+                           malpem.brain_extraction.get_mni_dof(subject.image_n4, subject.output_dir)]
+    else:
+        updates_masked.append(subject.image_mask)
+    task_masked = add("brain-extraction", brain_extraction, (subject,), [task_n4, task_mni, task_pincram],
+                      outputs=outputs_masked, updates=updates_masked,
+                      inputs=[] if subject.input_mask == "" else [subject.input_mask],
+                      rewrites=[subject.image_n4] if subject.do_n4_pincram else None)
+
+    if pincram_only:
+        return schedule()
+
+    task_screenshots = None
+    if create_report and malpem.report.output_format == "pdf":
+        task_screenshots = add("screenshots-mask", malpem.report.take_mask_screenshots,
+                               (subject.image_n4, subject.image_mask, subject.report_file, subject.output_dir),
+                               [task_masked],
+                               outputs=malpem.report.get_screenshot_files(subject.report_file, subject.output_dir,
+                                                                          "mask"))
+
+    # Crop the target to the brain (the results are padded back below)
+    task_target = task_masked
+    if malpem.crop.enabled:
+        task_target = add("crop", malpem.crop.crop, (subject.image_n4_masked, subject.image_mask,
+                                                     subject.image_target, subject.crop_box), [task_masked],
+                          outputs=[subject.image_target, subject.crop_box])
+
+    # Rank the atlases on a downsampled MNI grid, the atlases can be resampled while the target is prepared
+    task_selection = None
+    if 0 < subject.atlas_select < len(subject.atlases):
+        tasks_resample = [add("atlas-selection-target", malpem.atlas_selection.resample,
+                              ("target", subject.image_target, subject.mni_dof,
+                               subject.atlas_selection_timing_file, subject.output_dir), [task_target, task_mni],
+                              outputs=[malpem.atlas_selection.get_resampled_file("target", subject.output_dir)])]
+        for atlas in subject.atlases:
+            tasks_resample.append(add("atlas-selection", malpem.atlas_selection.resample,
+                                      (atlas.name, atlas.image, atlas.mni_dof,
+                                       subject.atlas_selection_timing_file, subject.output_dir), [], atlas.name,
+                                      outputs=[malpem.atlas_selection.get_resampled_file(atlas.name,
+                                                                                         subject.output_dir)]))
+        task_selection = add("atlas-selection", malpem.atlas_selection.select_atlases,
+                             ([atlas.name for atlas in subject.atlases], subject.atlas_select,
+                              subject.atlas_selection_file, subject.atlas_selection_timing_file,
+                              subject.output_dir), tasks_resample, outputs=[subject.atlas_selection_file])
+
+    tasks_propagation = []
+    for i in range(len(subject.atlases)):
+        atlas = subject.atlases[i]
+        task_register = add("register", register_atlas, (subject, i), [task_mni, task_target, task_selection],
+                            atlas.name, outputs=[subject.a_dofs[i], subject.a_init_dofs[i]])
+
+        if malpem.registration.resampling == "field":
+            tasks_propagation.append(add("transform", propagate_atlas, (subject, i),
+                                         [task_register, task_target, task_selection], atlas.name,
+                                         outputs=[subject.a_images_scaled_tgtspc[i], subject.a_labels_tgtspc[i],
+                                                  subject.a_fields[i]]))
+            continue
+
+        tasks_propagation.append(add("transform-image", transform_atlas,
+                                     (subject, i, atlas.image_scaled, subject.a_images_scaled_tgtspc[i], "linear"),
+                                     [task_register, task_target, task_selection], atlas.name,
+                                     outputs=[subject.a_images_scaled_tgtspc[i]]))
+        tasks_propagation.append(add("transform-labels", transform_atlas,
+                                     (subject, i, atlas.labels, subject.a_labels_tgtspc[i], "nn"),
+                                     [task_register, task_target, task_selection], atlas.name,
+                                     outputs=[subject.a_labels_tgtspc[i]]))
+
+    # Run Label Fusion (probability maps of all labels, per-label NIfTI files or with compact_posteriors one compact
+    # file, which MALPEM and the tissue maps read directly)
+    outputs_fusion = [subject.segmentation_fusion] + get_prob_files(subject.fusion_prob_base) + \
+        [malpem.posteriors.get_compact_file(subject.fusion_prob_base)]
+    if not malpem.label_fusion.engine == "native":
+        outputs_fusion.append(malpem.label_fusion.get_scaled_file(subject.image_target, subject.output_dir))
+    task_fusion = add("fusion", label_fusion, (subject,), tasks_propagation + [task_target, task_selection],
+                      outputs=outputs_fusion)
+
+    # Run EM-refinement (MALPEM, Ledig et al. 2015)
+    task_malpem = add("malpem", malpem.label_refinement.malpem_refinement,
+                      (subject.image_target, subject.fusion_prob_base, malpem.label_fusion.label_count,
+                       subject.segmentation_malpem, subject.malpem_prob_dir, subject.output_dir, compact_posteriors),
+                      [task_fusion, task_target],
+                      outputs=[subject.segmentation_malpem] + get_prob_files(subject.malpem_prob_base) +
+                      [malpem.posteriors.get_compact_file(subject.malpem_prob_base)])
+
+    # Segmentations and probability maps of the cropped grid are padded back into the geometry of the input image
+    task_results = task_malpem
+    if malpem.crop.enabled:
+        task_results = add("uncrop", malpem.crop.uncrop,
+                           (subject.image_n4_masked, [subject.segmentation_fusion, subject.segmentation_malpem],
+                            [subject.fusion_prob_dir, subject.malpem_prob_dir], subject.crop_box),
+                           [task_fusion, task_malpem], outputs=[],
+                           updates=[subject.segmentation_fusion, subject.segmentation_malpem] +
+                           get_prob_files(subject.fusion_prob_base) + get_prob_files(subject.malpem_prob_base) +
+                           [malpem.posteriors.get_compact_file(subject.fusion_prob_base),
+                            malpem.posteriors.get_compact_file(subject.malpem_prob_base)])
+
+    add("tissue-segmentation", malpem.label_fusion.create_tissue_seg,
+        (subject.image_n4_masked, subject.segmentation_malpem, subject.segmentation_malpem_tissues,
+         subject.output_dir), [task_results], outputs=[subject.segmentation_malpem_tissues])
+    add("tissue-maps", malpem.label_fusion.create_tissue_maps,
+        (subject.image_n4_masked, subject.malpem_prob_dir, subject.output_dir), [task_results],
+        outputs=[os.path.join(subject.malpem_prob_dir, "tissueMap_" + name + ".nii.gz")
+                 for name in [tissue[1] for tissue in malpem.tissues.tissue_classes] + ["background"]])
+
+    # Create report (csv-only: only the volumes)
+    if create_report:
+        report_files = malpem.report.get_volume_report_files(subject.report_file, subject.output_dir)
+        if malpem.report.output_format == "pdf":
+            report_files = [subject.report_file] + report_files + \
+                malpem.report.get_screenshot_files(subject.report_file, subject.output_dir, "MALPEM")
+        add("report", malpem.report.create_report,
+            (subject.image_n4, subject.image_mask, subject.segmentation_malpem, subject.report_file,
+             subject.output_dir), [task_results, task_screenshots], outputs=report_files)
+
+    # Clean up if necessary (the journal keeps track of the removed files)
+    if do_cleanup:
+        removes = [filename for task in tasks for filename in task[0]["outputs"] or []
+                   if journal.is_temporary(filename)]
+        add("cleanup", cleanup, (subject.output_dir,), [task[0]["task"] for task in tasks], outputs=[],
+            removes=removes)
+
+    return schedule()
@@ -0,0 +1,172 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Compact storage of probability maps (label fusion probabilities, MALPEM posteriors). Instead of one full float
+# volume per label (<prob_base>_<label>.nii.gz), a single file <prob_base>.npz stores per label only the voxels with
+# non-zero probability (delta encoded voxel indices) and their quantised probabilities. Voxels with negative values
+# (padding, -1) are stored once as a bit mask.
+
+import os
+import numpy
+import nibabel
+
+# Probabilities are stored as multiples of 1/quantisation (uint16)
+quantisation = 65535
+
+
+def get_nifti_file(prob_base, label, ext=".nii.gz"):
+    return prob_base + "_" + str(label) + ext
+
+
+def get_compact_file(prob_base):
+    return prob_base + ".npz"
+
+
+def exists(prob_base):
+    return os.path.isfile(get_compact_file(prob_base))
+
+
+class PosteriorWriter(object):
+    # Collects the probability maps label by label (or slab by slab along z) and writes the compact file on close
+    def __init__(self, filename, reference, label_count):
+        self.filename = filename
+        self.header = reference.header.copy()
+        self.header.set_data_dtype(numpy.float32)
+        self.header.set_slope_inter(1, 0)
+        self.shape = reference.shape[0:3]
+        self.label_count = label_count
+        self.padding = numpy.zeros(self.shape, dtype=bool)
+        self.chunks = []
+
+    def add(self, label, data, z_start=0):
+        data = numpy.asarray(data).reshape(data.shape[0:2] + (-1,))
+        z_end = z_start + data.shape[2]
+        self.padding[:, :, z_start:z_end] |= data < 0
+
+        values = numpy.rint(numpy.clip(data, 0, 1) * quantisation).astype(numpy.uint16)
+        coords = numpy.nonzero(values)
+        indices = numpy.ravel_multi_index((coords[0], coords[1], coords[2] + z_start), self.shape)
+        self.chunks.append((label, indices.astype(numpy.uint32), values[coords]))
+
+    def close(self):
+        labels = numpy.concatenate([numpy.repeat(numpy.uint16(c[0]), len(c[1])) for c in self.chunks] +
+                                   [numpy.zeros(0, dtype=numpy.uint16)])
+        indices = numpy.concatenate([c[1] for c in self.chunks] + [numpy.zeros(0, dtype=numpy.uint32)])
+        values = numpy.concatenate([c[2] for c in self.chunks] + [numpy.zeros(0, dtype=numpy.uint16)])
+        self.chunks = []
+
+        # Sorted by label and voxel, the indices of a label are stored as differences to the previous index
+        order = numpy.lexsort((indices, labels))
+        labels = labels[order]
+        indices = indices[order]
+        values = values[order]
+        offsets = numpy.searchsorted(labels, numpy.arange(self.label_count + 1)).astype(numpy.int64)
+        deltas = indices.copy()
+        deltas[1:] -= indices[:-1]
+        starts = offsets[0:-1][numpy.diff(offsets) > 0]
+        deltas[starts] = indices[starts]
+
+        header = numpy.frombuffer(self.header.binaryblock, dtype=numpy.uint8)
+        tmp_file = os.path.join(os.path.dirname(self.filename), ".tmp-" + str(os.getpid()) + "-" +
+                                os.path.basename(self.filename))
+        f = open(tmp_file, "wb")
+        numpy.savez_compressed(f, shape=numpy.array(self.shape), header=header, offsets=offsets, deltas=deltas,
+                               values=values, padding=numpy.packbits(self.padding.ravel()))
+        f.close()
+        os.rename(tmp_file, self.filename)
+
+
+class PosteriorReader(object):
+    def __init__(self, filename):
+        content = numpy.load(filename)
+        self.shape = tuple(int(s) for s in content["shape"])
+        self.header = nibabel.Nifti1Header(content["header"].tobytes())
+        self.offsets = content["offsets"]
+        self.label_count = len(self.offsets) - 1
+        self.values = content["values"]
+        self.padding = numpy.unpackbits(content["padding"])[0:numpy.prod(self.shape)].astype(bool)
+
+        # Undo the delta encoding of every label
+        deltas = content["deltas"].astype(numpy.int64)
+        self.indices = numpy.zeros(len(deltas), dtype=numpy.int64)
+        for label in range(self.label_count):
+            start = self.offsets[label]
+            end = self.offsets[label + 1]
+            self.indices[start:end] = numpy.cumsum(deltas[start:end])
+
+    def get_reference(self):
+        # Image with the geometry of the probability maps, e.g. for malpem.imageio.save_image
+        return nibabel.Nifti1Image(numpy.zeros(self.shape, dtype=numpy.uint8), self.header.get_best_affine(),
+                                   self.header)
+
+    def get_probabilities(self, label):
+        # Flat voxel indices and probabilities of one label
+        start = self.offsets[label]
+        end = self.offsets[label + 1]
+        return self.indices[start:end], self.values[start:end].astype(numpy.float32) / quantisation
+
+    def get_map(self, label):
+        indices, probabilities = self.get_probabilities(label)
+        data = numpy.zeros(numpy.prod(self.shape), dtype=numpy.float32)
+        data[indices] = probabilities
+        data[self.padding] = -1
+        return data.reshape(self.shape)
+
+    def get_sums(self, label_groups, group_count):
+        # Sum of the probability maps of the labels in each group (label_groups: group of every label),
+        # computed without expanding the individual maps. As for the sum of the expanded maps, padded voxels are
+        # -1 times the number of labels in the group.
+        label_groups = numpy.asarray(label_groups)[0:self.label_count]
+        groups = numpy.repeat(label_groups, numpy.diff(self.offsets))
+        sums = []
+        for group in range(group_count):
+            selection = groups == group
+            data = numpy.bincount(self.indices[selection], weights=self.values[selection] / float(quantisation),
+                                  minlength=numpy.prod(self.shape))
+            data[self.padding] = -numpy.sum(label_groups == group)
+            sums.append(data.astype(numpy.float32).reshape(self.shape))
+        return sums
+
+
+def nifti_to_compact(prob_base, label_count, delete=False):
+    reference = nibabel.load(get_nifti_file(prob_base, 0))
+    writer = PosteriorWriter(get_compact_file(prob_base), reference, label_count)
+    for label in range(label_count):
+        writer.add(label, numpy.asanyarray(nibabel.load(get_nifti_file(prob_base, label)).dataobj))
+    writer.close()
+
+    if delete:
+        for label in range(label_count):
+            os.remove(get_nifti_file(prob_base, label))
+
+
+def compact_to_nifti(prob_base, output_base, ext=".nii.gz"):
+    reader = PosteriorReader(get_compact_file(prob_base))
+    reference = reader.get_reference()
+    for label in range(reader.label_count):
+        image = nibabel.Nifti1Image(reader.get_map(label), reference.affine, reference.header)
+        nibabel.save(image, get_nifti_file(output_base, label, ext))
+
+
+def expand_for_reading(prob_base, output_base, ext=".nii.gz"):
+    # Expands the maps for a program that only reads them: labels without any non-zero probability share one file
+    # (<output_base>_empty). Returns the file of every label.
+    reader = PosteriorReader(get_compact_file(prob_base))
+    reference = reader.get_reference()
+    filenames = []
+    empty_file = None
+    for label in range(reader.label_count):
+        if reader.offsets[label + 1] > reader.offsets[label]:
+            filenames.append(get_nifti_file(output_base, label, ext))
+        elif empty_file is None:
+            empty_file = output_base + "_empty" + ext
+            filenames.append(empty_file)
+        else:
+            filenames.append(empty_file)
+            continue
+        image = nibabel.Nifti1Image(reader.get_map(label), reference.affine, reference.header)
+        nibabel.save(image, filenames[-1])
+    return filenames
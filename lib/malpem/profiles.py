@@ -0,0 +1,104 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Speed/accuracy presets of the external tools (--profile). "accurate" uses all five resolution levels of
+# etc/ireg.cfg (down to 1 mm with 2.5 mm control point spacing), N4 with 50x40x30x20 iterations (half of them in the
+# second, masked pass, see bias_correction.N4_refine) and pincram with 3 levels. The faster profiles stop the registrations at
+# a coarser level (the ireg configuration is generated from etc/ireg.cfg), run fewer N4 iterations on the same
+# fitting levels and fewer pincram levels. bin/malpem-benchmark-profiles measures runtime and Dice overlap of the
+# profiles against "accurate".
+
+import os
+import malpem.mytools
+
+profile = "accurate"
+
+# ireg_levels: resolution levels of etc/ireg.cfg that are kept (coarsest first), n4_iterations: iterations per
+# fitting level of N4, n4_refine_iterations: the same for the second (masked) N4 pass of the already corrected
+# image, pincram_levels: refinement levels of pincram
+profiles = {"accurate": {"ireg_levels": 5, "n4_iterations": "50x40x30x20", "n4_refine_iterations": "25x20x15x10",
+                         "pincram_levels": 3},
+            "balanced": {"ireg_levels": 4, "n4_iterations": "30x25x20x15", "n4_refine_iterations": "15x12x10x8",
+                         "pincram_levels": 3},
+            "fast": {"ireg_levels": 3, "n4_iterations": "20x15x10x5", "n4_refine_iterations": "10x8x5x3",
+                     "pincram_levels": 2}}
+
+
+def get(name):
+    return profiles[profile][name]
+
+
+def read_config(config_file):
+    # Sections of an ireg configuration: [(name, [lines])], lines before the first section have the name ""
+    sections = [("", [])]
+    f = open(config_file, "rb")
+    for line in f:
+        if line.strip().startswith("[") and line.strip().endswith("]"):
+            sections.append((line.strip()[1:-1].strip(), []))
+        else:
+            sections[-1][1].append(line)
+    f.close()
+    return sections
+
+
+def get_newline(line):
+    # etc/ireg.cfg has Windows line endings, generated lines keep them
+    return line[len(line.rstrip("\r\n")):] or "\n"
+
+
+def set_value(lines, key, value):
+    for i, line in enumerate(lines):
+        if "=" in line and line.split("=")[0].strip() == key:
+            lines[i] = line.split("=")[0] + "= " + str(value) + get_newline(line)
+
+
+def get_value(lines, key):
+    for line in lines:
+        if "=" in line and line.split("=")[0].strip() == key:
+            return line.split("=", 1)[1].strip()
+    return None
+
+
+def create_ireg_config(config_file, output_file, levels):
+    # Keeps the 'levels' coarsest resolution levels, the finest of them becomes level 1 and its control point
+    # spacing the one of the transformation model
+    sections = read_config(config_file)
+    level_sections = [(name, lines) for name, lines in sections if name.startswith("resolution level")]
+    level_sections.sort(key=lambda section: int(section[0].split()[-1]))
+    dropped = len(level_sections) - levels
+
+    newline = get_newline(sections[0][1][0] if len(sections[0][1]) > 0 else "\n")
+    f = open(output_file + ".tmp-" + str(os.getpid()), "wb")
+    for name, lines in sections:
+        lines = list(lines)
+        if name.startswith("resolution level"):
+            level = int(name.split()[-1]) - dropped
+            if level < 1:
+                continue
+            name = "resolution level " + str(level)
+        elif name == "optimization":
+            set_value(lines, "No. of resolution levels", levels)
+        elif name == "transformation model":
+            set_value(lines, "Control point spacing", get_value(level_sections[dropped][1], "Control point spacing"))
+
+        if not name == "":
+            f.write("[ " + name + " ]" + newline)
+        f.writelines(lines)
+    f.close()
+    os.rename(output_file + ".tmp-" + str(os.getpid()), output_file)
+
+
+def get_ireg_config(output_dir):
+    # Configuration of the registrations of the selected profile (generated once in the log directory)
+    config_ireg = os.path.join(malpem.mytools.__malpem_path__, "etc", "ireg.cfg")
+    if get("ireg_levels") >= profiles["accurate"]["ireg_levels"]:
+        return config_ireg
+
+    profile_config = os.path.join(output_dir, "log", "ireg-" + profile + ".cfg")
+    if not os.path.isfile(profile_config):
+        malpem.mytools.check_ex_dir(os.path.dirname(profile_config))
+        create_ireg_config(config_ireg, profile_config, get("ireg_levels"))
+    return profile_config
@@ -8,7 +8,19 @@
 import time
 from subprocess import call
 import os
+import numpy
+import nibabel
+import scipy.ndimage
 import malpem.mytools
+import malpem.imageio
+import malpem.cache
+import malpem.profiles
+
+# Propagation of an atlas: "binary" transforms the image and the labels with one transformation call each, "field"
+# evaluates the deformation once per atlas (deformation field) and resamples both with it in-process
+resampling = "binary"
+# Grids whose voxel positions differ less than this [mm] are considered identical (match_header)
+header_tolerance = 1e-3
 
 def sym_dof(dof_a, dof_b, dof_out, output_dir):
 # DEFINITIONS
@@ -67,9 +79,10 @@ def dofinvert(dof_in, dof_out, output_dir):
     malpem.mytools.check_ex_dir(log_dir)
     logfile = os.path.join(log_dir, "dofinvert.log")
 
-    parameters_dofinvert = dof_in + " " + dof_out
+    tmp_dof = malpem.mytools.tmp_file(dof_out)
+    parameters_dofinvert = dof_in + " " + tmp_dof
     malpem.mytools.execute_cmd(binary_dofinvert, parameters_dofinvert, logfile)
-    malpem.mytools.ensure_file(dof_out, "")
+    malpem.mytools.commit_file(tmp_dof, dof_out)
 
 
 def dofcombine(dof_a, dof_b, dof_out, inv_a, inv_b, output_dir):
@@ -83,20 +96,21 @@ def dofcombine(dof_a, dof_b, dof_out, inv_a, inv_b, output_dir):
     malpem.mytools.check_ex_dir(log_dir)
     logfile = os.path.join(log_dir, "dofcombine.log")
 
-    parameters_dofcombine = dof_a + " " + dof_b + " " + dof_out
+    tmp_dof = malpem.mytools.tmp_file(dof_out)
+    parameters_dofcombine = dof_a + " " + dof_b + " " + tmp_dof
     if inv_a:
         parameters_dofcombine += " -invert1"
     if inv_b:
         parameters_dofcombine += " -invert2"
 
     malpem.mytools.execute_cmd(binary_dofcombine, parameters_dofcombine, logfile)
-    malpem.mytools.ensure_file(dof_out, "")
+    malpem.mytools.commit_file(tmp_dof, dof_out)
 
 
 def register(target, source, dof_in, dof_out, transformation_model, output_dir):
 # DEFINITIONS
     binary_ireg = os.path.join(malpem.mytools.__malpem_path__, "lib", "irtk", "ireg")
-    config_ireg = os.path.join(malpem.mytools.__malpem_path__, "etc", "ireg.cfg")
+    config_ireg = malpem.profiles.get_ireg_config(output_dir)
 # END DEFINITIONS
 
     task_name = "Registration (" + transformation_model + ")"
@@ -110,7 +124,8 @@ def register(target, source, dof_in, dof_out, transformation_model, output_dir):
     logfile = os.path.join(log_dir, "registration-" + malpem.mytools.nifty_basename(source) + "-" +
                            malpem.mytools.nifty_basename(target) + ".log")
 
-    parameters_ireg = target + " " + source + " -parin " + config_ireg + " -dofout " + dof_out
+    tmp_dof = malpem.mytools.tmp_file(dof_out)
+    parameters_ireg = target + " " + source + " -parin " + config_ireg + " -dofout " + tmp_dof
 
     if transformation_model == "rigid":
         parameters_ireg += " -model Rigid"
@@ -120,9 +135,17 @@ def register(target, source, dof_in, dof_out, transformation_model, output_dir):
     if not dof_in == "":
         parameters_ireg += " -dofin " + dof_in
 
+    # The format of the output (compressed or not) is part of the key
+    cache_key = malpem.cache.get_key("ireg", [target, source, dof_in, config_ireg],
+                                     transformation_model + " " + malpem.mytools.file_extension(dof_out))
+    if malpem.cache.fetch(cache_key, dof_out):
+        malpem.mytools.finished_task(start_time, task_name)
+        return True
+
     malpem.mytools.execute_cmd(binary_ireg, parameters_ireg, logfile)
 
-    malpem.mytools.ensure_file(dof_out, "")
+    malpem.mytools.commit_file(tmp_dof, dof_out)
+    malpem.cache.store(cache_key, dof_out)
     malpem.mytools.finished_task(start_time, task_name)
     return True
 
@@ -154,16 +177,117 @@ def transform(target, source, output_file, dof_in, interpolation, output_dir):
     else:
         par_interpolation = "-linear"
 
+    tmp_output = malpem.mytools.tmp_file(output_file)
     if not dof_in == "":
-        parameters_transformation = source + " " + output_file + " -target " + target + " -dofin " + \
+        parameters_transformation = source + " " + tmp_output + " -target " + target + " -dofin " + \
                                     dof_in + " " + par_interpolation + " -matchInputType"
     else:
-        parameters_transformation = source + " " + output_file + " -target " + target + \
+        parameters_transformation = source + " " + tmp_output + " -target " + target + \
                                     " " + par_interpolation + " -matchInputType"
 
+    cache_key = malpem.cache.get_key("transformation", [target, source, dof_in],
+                                     par_interpolation + " " + malpem.mytools.file_extension(output_file))
+    if malpem.cache.fetch(cache_key, output_file):
+        malpem.mytools.finished_task(start_time, task_name)
+        return True
+
     malpem.mytools.execute_cmd(binary_transformation, parameters_transformation, logfile)
-    malpem.mytools.ensure_file(output_file, "")
+    malpem.mytools.commit_file(tmp_output, output_file)
+    malpem.cache.store(cache_key, output_file)
 
     malpem.mytools.finished_task(start_time, task_name)
     return True
 
+
+
+def match_header(target, source, output_dir):
+    # Gives source exactly the header geometry of target. If both are on the same grid (within header_tolerance)
+    # only the header of source is rewritten, otherwise source is resampled (nearest neighbour) and, as IRTK
+    # writes the header, target as well so that both headers match numerically.
+    task_name = "Matching header of " + os.path.basename(source)
+    start_time = malpem.mytools.start_task(task_name)
+
+    malpem.mytools.ensure_file(target, "")
+    malpem.mytools.ensure_file(source, "")
+
+    try:
+        target_image = nibabel.load(target)
+        grid_matches = malpem.imageio.same_grid(target_image, nibabel.load(source), header_tolerance)
+    except (IOError, ValueError):
+        grid_matches = False
+
+    if grid_matches:
+        malpem.imageio.copy_geometry(target_image, source)
+    else:
+        print "Grid of " + source + " differs from " + target + ": resampling"
+        transform(target, source, source, "", "nn", output_dir)
+        transform(target, target, target, "", "nn", output_dir)
+
+    malpem.mytools.finished_task(start_time, task_name)
+    return True
+
+
+def get_coordinate_image(source, output_file):
+    # 4D image on the grid of source, frame d holds the voxel coordinate d + 1 (0 marks points outside of the
+    # source after the transformation). As linear interpolation of a linear function is exact, transforming it
+    # yields the source coordinates of every target voxel.
+    if not os.path.isfile(output_file):
+        image = nibabel.load(source)
+        coordinates = numpy.indices(image.shape[0:3], dtype=numpy.float32) + 1
+        # Several tasks might create the same file at the same time (written under a unique name first)
+        malpem.imageio.save_image(coordinates.transpose(1, 2, 3, 0), image, output_file, numpy.float32)
+    return output_file
+
+
+def get_frame_grid(target, output_file, frames):
+    # Target grid with several frames, so that all frames of the coordinate image are transformed
+    if not os.path.isfile(output_file):
+        image = nibabel.load(target)
+        malpem.imageio.save_image(numpy.zeros(image.shape[0:3] + (frames,), dtype=numpy.uint8), image, output_file,
+                                  numpy.uint8)
+    return output_file
+
+
+def deformation_field(target, source, dof_in, field_file, output_dir):
+    # Source voxel coordinates (+1) of every target voxel, one evaluation of the transformation for all images
+    # with the grid of source
+    tmp_dir = os.path.join(output_dir, "tmp", "propagate")
+    coordinate_file = get_coordinate_image(source, malpem.mytools.intermediate_file(
+        tmp_dir, "coordinates-" + malpem.mytools.nifty_basename(source)))
+    grid_file = get_frame_grid(target, malpem.mytools.intermediate_file(
+        tmp_dir, "grid-" + malpem.mytools.nifty_basename(target)), 3)
+    return transform(grid_file, coordinate_file, field_file, dof_in, "linear", output_dir)
+
+
+def resample_field(target, field_file, sources, output_files, interpolations):
+    # Resamples several images (same grid as the source of the field) on the target grid, each with its own
+    # interpolation. The output has the data type of the input (cf. transformation -matchInputType).
+    task_name = "Resampling " + str(len(sources)) + " images with deformation field"
+    start_time = malpem.mytools.start_task(task_name)
+
+    malpem.mytools.ensure_file(field_file, "")
+    field, field_image = malpem.imageio.load_image(field_file)
+    coordinates = field.transpose(3, 0, 1, 2) - 1
+    outside = field.min(axis=3) < 0.5
+    del field
+    target_image = nibabel.load(target)
+
+    for i in range(len(sources)):
+        malpem.mytools.ensure_file(sources[i], "")
+        data, image = malpem.imageio.load_image(sources[i])
+        order = 1
+        if interpolations[i] == "nn":
+            order = 0
+        elif interpolations[i] == "bspline":
+            order = 3
+
+        result = scipy.ndimage.map_coordinates(data.astype(numpy.float32), coordinates, order=order, mode="nearest")
+        result[outside] = 0
+        dtype = image.get_data_dtype()
+        if numpy.issubdtype(dtype, numpy.integer):
+            result = numpy.rint(result)
+        malpem.imageio.save_image(result, target_image, output_files[i], dtype)
+        malpem.mytools.ensure_file(output_files[i], "")
+
+    malpem.mytools.finished_task(start_time, task_name)
+    return True
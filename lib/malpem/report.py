@@ -7,9 +7,25 @@
 
 import os
 import time
+import numpy
 import shutil
-from reportlab.pdfgen import canvas
+import nibabel
+import multiprocessing.pool
 import malpem.mytools
+import malpem.imageio
+import malpem.tissues
+import malpem.volumetrics
+
+# Screenshots: IRTK display with offscreen rendering (one call per view, needs OpenGL) or native rendering of the
+# mid-slices in-process (all views of an image at once, no OpenGL needed)
+engine = "display"
+# Report: pdf with screenshots and the csv files or only the csv files of the volumes (csv-only)
+output_format = "pdf"
+
+# Native screenshots: pixel size [mm], opacity of the labels and colour of the mask contour
+pixel_size = 1.0
+label_opacity = 0.5
+contour_colour = (255, 0, 0)
 
 
 def take_screenshot(output_file, parameters):
@@ -33,64 +49,209 @@ def take_screenshot(output_file, parameters):
 
 
 def calculate_volume(input_seg, output_file):
-# DEFINITIONS
-    binary_volumes = os.path.join(malpem.mytools.__malpem_path__, "lib", "irtk", "cl_compute_volume")
-# END DEFINITIONS
-
     task_name = "Calculating volumes"
     start_time = malpem.mytools.start_task(task_name)
 
-    malpem.mytools.execute_cmd(binary_volumes, input_seg + " > " + output_file, "")
+    malpem.mytools.ensure_file(input_seg, "")
+    volumetrics = malpem.volumetrics.Volumetrics(input_seg)
+
+    # Raw volumes [mm^3] of all labels (starting with background) in one line
+    f = open(output_file, 'w')
+    f.write(", ".join([str(volume) for volume in volumetrics.volumes]) + "\n")
+    f.close()
 
     malpem.mytools.ensure_file(output_file, "")
     malpem.mytools.finished_task(start_time, task_name)
+    return volumetrics
 
 
-def create_report(input_file, input_mask, input_seg_malpem, output_report, output_dir):
+def read_lut(lut_file):
+    # Colour table of the labels (rows "label r g b alpha visible name" after the irtkSegmentTable header)
+    rows = []
+    f = open(lut_file)
+    for row in f:
+        arr = row.split()
+        if len(arr) >= 6 and arr[0].isdigit():
+            rows.append([int(value) for value in arr[0:6]])
+    f.close()
+
+    lut = numpy.zeros((max(row[0] for row in rows) + 1, 4))
+    for row in rows:
+        lut[row[0]] = [row[1], row[2], row[3], label_opacity * row[4] * row[5]]
+    return lut
+
+
+def get_mid_slice(data, view):
+    # Slice through the centre of the volume (RAS orientation), rows top to bottom: anterior/superior first
+    centre = [n // 2 for n in data.shape[0:3]]
+    if view == "xy":
+        slice_2d = data[:, :, centre[2]]
+    elif view == "xz":
+        slice_2d = data[:, centre[1], :]
+    else:
+        slice_2d = data[centre[0], :, :]
+    return slice_2d.T[::-1]
+
+
+def get_slice_zooms(zooms, view):
+    # Pixel height and width [mm] of the mid slice
+    axes = {"xy": (1, 0), "xz": (2, 0), "yz": (2, 1)}[view]
+    return zooms[axes[0]], zooms[axes[1]]
+
+
+def resize_slice(slice_2d, zooms, interpolation):
+    # Square pixels of pixel_size, centred on a square canvas
+    from PIL import Image
+    size = (max(1, int(round(slice_2d.shape[1] * zooms[1] / pixel_size))),
+            max(1, int(round(slice_2d.shape[0] * zooms[0] / pixel_size))))
+    resized = numpy.asarray(Image.fromarray(numpy.ascontiguousarray(slice_2d, dtype=numpy.float32), "F")
+                            .resize(size, interpolation))
+    length = max(resized.shape)
+    canvas = numpy.zeros((length, length), dtype=numpy.float32)
+    top = (length - resized.shape[0]) // 2
+    left = (length - resized.shape[1]) // 2
+    canvas[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+    return canvas
+
+
+def get_contour(mask):
+    # Mask voxels with a 4-neighbour outside of the mask
+    inner = mask.copy()
+    inner[1:, :] &= mask[:-1, :]
+    inner[:-1, :] &= mask[1:, :]
+    inner[:, 1:] &= mask[:, :-1]
+    inner[:, :-1] &= mask[:, 1:]
+    return mask & ~inner
+
+
+def render_screenshot(image, window, zooms, overlay, kind, view, lut, output_file):
+    from PIL import Image
+    slice_zooms = get_slice_zooms(zooms, view)
+    grey = resize_slice(get_mid_slice(image, view), slice_zooms, Image.BILINEAR)
+    grey = numpy.clip((grey - window[0]) / max(window[1] - window[0], 1e-6), 0, 1) * 255
+    rgb = numpy.repeat(grey[:, :, numpy.newaxis], 3, axis=2)
+
+    labels = numpy.rint(resize_slice(get_mid_slice(overlay, view), slice_zooms, Image.NEAREST)).astype(int)
+    if kind == "contour":
+        rgb[get_contour(labels > 0)] = contour_colour
+    else:
+        labels[(labels < 0) | (labels >= lut.shape[0])] = 0
+        colours = lut[labels]
+        alpha = colours[:, :, 3:4]
+        rgb = (1 - alpha) * rgb + alpha * colours[:, :, 0:3]
+
+    tmp = malpem.mytools.tmp_file(output_file)
+    Image.fromarray(numpy.rint(rgb).astype(numpy.uint8), "RGB").save(tmp, "PNG")
+    malpem.mytools.commit_file(tmp, output_file)
+    return output_file
+
+
+def render_screenshots(input_file, overlays):
+    # overlays: [(segmentation/mask, "seg"/"contour", screenshot files of the xy, xz and yz view)]. The image and
+    # every overlay are loaded once, all missing screenshots are rendered concurrently.
 # DEFINITIONS
-    structure_names = os.path.join(malpem.mytools.__malpem_path__, "etc", "nmm_info.csv")
     structure_lut = os.path.join(malpem.mytools.__malpem_path__, "etc", "lut.csv")
+    png_na = os.path.join(malpem.mytools.__malpem_path__, "etc", "screenshotNA.png")
+# END DEFINITIONS
 
-    # PAPER SIZE
-    left_start = 50
-    top_start = 800
-    right_stop = 550
+    jobs = [(overlay, kind, view, screenshot) for overlay, kind, screenshots in overlays
+            for view, screenshot in zip(["xy", "xz", "yz"], screenshots) if not os.path.isfile(screenshot)]
+    if len(jobs) == 0:
+        return
 
-    # NMM STRUCTURE IDs FOR RESPECTIVE TISSUE CLASSES
-    vent_list = [1, 2, 21, 22, 23, 24]
-    cgm_list = range(41, 139, 1)
-    dgm_list = range(1, 41, 1)
-    wm_list = [12, 13, 16, 17]
-    other_list = [14, 15, 18, 33, 34]
-    for i in wm_list:
-        dgm_list.remove(i)
-    for i in vent_list:
-        dgm_list.remove(i)
-    for i in other_list:
-        dgm_list.remove(i)
+    task_name = "Rendering " + str(len(jobs)) + " screenshot(s)"
+    start_time = malpem.mytools.start_task(task_name)
 
-    total_brain_string = "[1-138]"
-    vent_string = malpem.mytools.get_id_string(vent_list)
-    cgm_string = malpem.mytools.get_id_string(cgm_list)
-    dgm_string = malpem.mytools.get_id_string(dgm_list)
-    wm_string = malpem.mytools.get_id_string(wm_list)
-    other_string = malpem.mytools.get_id_string(other_list)
-# END DEFINITIONS
+    try:
+        import PIL.Image
+    except ImportError:
+        PIL = None
+    missing = [job for job in jobs if PIL is None or not os.path.isfile(job[0])]
+    for overlay, kind, view, screenshot in missing:
+        print("WARNING: Couldn't create screenshot (" + screenshot + "): " +
+              ("PIL is not installed" if PIL is None else "missing file '" + overlay + "'"))
+        shutil.copyfile(png_na, screenshot)
+    jobs = [job for job in jobs if job not in missing]
+
+    if len(jobs) > 0:
+        image_nii = nibabel.as_closest_canonical(malpem.imageio.load_image(input_file)[1])
+        image = numpy.asanyarray(image_nii.dataobj).reshape(image_nii.shape[0:3] + (-1,))[:, :, :, 0]
+        zooms = image_nii.header.get_zooms()[0:3]
+        # Grey values between the 1st and 99th percentile of the foreground
+        foreground = image[::2, ::2, ::2]
+        foreground = foreground[foreground > 0]
+        window = numpy.percentile(foreground, [1, 99]) if foreground.size > 0 else (0, 1)
+
+        overlay_data = {}
+        for overlay in set(job[0] for job in jobs):
+            overlay_nii = nibabel.as_closest_canonical(malpem.imageio.load_image(overlay)[1])
+            if not overlay_nii.shape[0:3] == image_nii.shape[0:3]:
+                print "--- ERROR: " + overlay + " doesn't match the image " + input_file + " ---"
+                exit(1)
+            overlay_data[overlay] = numpy.asanyarray(overlay_nii.dataobj).reshape(overlay_nii.shape[0:3] + (-1,))
+            overlay_data[overlay] = overlay_data[overlay].max(axis=3)
+        lut = read_lut(structure_lut)
+
+        pool = multiprocessing.pool.ThreadPool(len(jobs))
+        pool.map(lambda job: render_screenshot(image, window, zooms, overlay_data[job[0]], job[1], job[2], lut,
+                                               job[3]), jobs)
+        pool.close()
+        pool.join()
+
+    for job in jobs:
+        malpem.mytools.ensure_file(job[3], "")
+    malpem.mytools.finished_task(start_time, task_name)
 
-# CALCULATE STRUCTURAL VOLUMES
+
+def get_screenshot_files(output_report, output_dir, kind):
     report_dir = os.path.join(output_dir, "report")
-    malpem.mytools.check_ex_dir(report_dir)
-    malpem_volume_file = os.path.join(report_dir, malpem.mytools.basename(output_report) + "_MALPEM_raw.csv")
-    malpem_report_file = os.path.join(report_dir, malpem.mytools.basename(output_report) + "_MALPEM_Report.csv")
+    screenshots = []
+    for view in ["xy", "xz", "yz"]:
+        screenshots.append(os.path.join(report_dir, malpem.mytools.basename(output_report) + "_" + kind + "_" +
+                                        view + ".png"))
+    return screenshots
+
+
+def take_segmentation_screenshots(input_file, input_seg, output_report, output_dir):
+# DEFINITIONS
+    structure_lut = os.path.join(malpem.mytools.__malpem_path__, "etc", "lut.csv")
+# END DEFINITIONS
+    malpem.mytools.check_ex_dir(os.path.join(output_dir, "report"))
+    screenshots = get_screenshot_files(output_report, output_dir, "MALPEM")
+    views = ["-xy", "-xz", "-yz"]
+
+    if engine == "native":
+        render_screenshots(input_file, [(input_seg, "seg", screenshots)])
+        return
+
+    for i in range(len(screenshots)):
+        if not os.path.isfile(screenshots[i]):
+            take_screenshot(screenshots[i], input_file + " -seg " + input_seg + " -lut " + structure_lut + " " +
+                            views[i] + " -res 2")
+
+
+def take_mask_screenshots(input_file, input_mask, output_report, output_dir):
+    malpem.mytools.check_ex_dir(os.path.join(output_dir, "report"))
+    screenshots = get_screenshot_files(output_report, output_dir, "mask")
+    views = ["-xy", "-xz", "-yz"]
 
-    calculate_volume(input_seg_malpem, malpem_volume_file)
+    if engine == "native":
+        render_screenshots(input_file, [(input_mask, "contour", screenshots)])
+        return
+
+    for i in range(len(screenshots)):
+        if not os.path.isfile(screenshots[i]):
+            take_screenshot(screenshots[i], input_file + " " + input_mask + " -scontour " + views[i] + " -res 2")
+
+
+def read_structure_names():
+    structure_names = os.path.join(malpem.mytools.__malpem_path__, "etc", "nmm_info.csv")
 
     f = open(structure_names)
     s_id = []
     s_short = []
     s_long = []
     s_side = []
-    s_volumes = []
     for row in f:
         arr = row.split(',')
         s_id.append(arr[0])
@@ -99,71 +260,104 @@ def create_report(input_file, input_mask, input_seg_malpem, output_report, outpu
         s_side.append(arr[3])
     f.close()
 
-    f = open(malpem_volume_file)
-    for row in f:
-        arr = row.split(',')
-    for i in range(len(arr)):
-        s_volumes.append(arr[i].lstrip())
-    f.close()
+    return s_id, s_short, s_long, s_side
 
-    total_brain_volume = 0
-    cgm_volume = 0
-    dgm_volume = 0
-    vent_volume = 0
-    wm_volume = 0
-    other_volume = 0
-
-    for i in range(1, 139, 1):
-        if i in vent_list:
-            vent_volume += float(s_volumes[i])
-        if i in cgm_list:
-            cgm_volume += float(s_volumes[i])
-        if i in dgm_list:
-            dgm_volume += float(s_volumes[i])
-        if i in wm_list:
-            wm_volume += float(s_volumes[i])
-        if i in other_list:
-            other_volume += float(s_volumes[i])
 
-    total_brain_volume = other_volume + vent_volume + cgm_volume + dgm_volume + wm_volume
-# END
+def get_volume_report_files(output_report, output_dir):
+    report_dir = os.path.join(output_dir, "report")
+    return [os.path.join(report_dir, malpem.mytools.basename(output_report) + "_MALPEM_raw.csv"),
+            os.path.join(report_dir, malpem.mytools.basename(output_report) + "_MALPEM_Report.csv")]
+
+
+def create_volume_report(input_seg_malpem, output_report, output_dir):
+# DEFINITIONS
+    total_brain_string = "[1-138]"
+    tissue_lists = malpem.tissues.get_tissue_lists()
+    vent_string = malpem.mytools.get_id_string(tissue_lists[1])
+    dgm_string = malpem.mytools.get_id_string(tissue_lists[2])
+    cgm_string = malpem.mytools.get_id_string(tissue_lists[3])
+    wm_string = malpem.mytools.get_id_string(tissue_lists[4])
+    other_string = malpem.mytools.get_id_string(tissue_lists[5])
+# END DEFINITIONS
 
-# TAKE RELEVANT SCREENSHOTS
-    screenshots_malpem = []
-    screenshots_malpem.append(os.path.join(report_dir, malpem.mytools.basename(output_report) + "_MALPEM_xy.png"))
-    screenshots_malpem.append(os.path.join(report_dir, malpem.mytools.basename(output_report) + "_MALPEM_xz.png"))
-    screenshots_malpem.append(os.path.join(report_dir, malpem.mytools.basename(output_report) + "_MALPEM_yz.png"))
+# CALCULATE STRUCTURAL VOLUMES
+    malpem.mytools.check_ex_dir(os.path.join(output_dir, "report"))
+    malpem_volume_file, malpem_report_file = get_volume_report_files(output_report, output_dir)
 
-    screenshots_mask = []
-    screenshots_mask.append(os.path.join(report_dir, malpem.mytools.basename(output_report) + "_mask_xy.png"))
-    screenshots_mask.append(os.path.join(report_dir, malpem.mytools.basename(output_report) + "_mask_xz.png"))
-    screenshots_mask.append(os.path.join(report_dir, malpem.mytools.basename(output_report) + "_mask_yz.png"))
+    volumetrics = calculate_volume(input_seg_malpem, malpem_volume_file)
+    s_id, s_short, s_long, s_side = read_structure_names()
+    s_volumes = volumetrics.volumes[0:len(s_id)]
 
-    take_screenshot(screenshots_malpem[0], input_file + " -seg " + input_seg_malpem + " -lut " + structure_lut + " -xy -res 2")
-    take_screenshot(screenshots_malpem[1], input_file + " -seg " + input_seg_malpem + " -lut " + structure_lut + " -xz -res 2")
-    take_screenshot(screenshots_malpem[2], input_file + " -seg " + input_seg_malpem + " -lut " + structure_lut + " -yz -res 2")
+    tissue_volumes = volumetrics.get_tissue_volumes()
+    vent_volume = tissue_volumes[1]
+    dgm_volume = tissue_volumes[2]
+    cgm_volume = tissue_volumes[3]
+    wm_volume = tissue_volumes[4]
+    other_volume = tissue_volumes[5]
 
-    take_screenshot(screenshots_mask[0], input_file + " " + input_mask + " -scontour -xy -res 2")
-    take_screenshot(screenshots_mask[1], input_file + " " + input_mask + " -scontour -xz -res 2")
-    take_screenshot(screenshots_mask[2], input_file + " " + input_mask + " -scontour -yz -res 2")
+    total_brain_volume = other_volume + vent_volume + cgm_volume + dgm_volume + wm_volume
+# END
+
+    # IDs, name and volume [mm^3] of the brain and of every tissue class
+    summary = [(total_brain_string, "TotalBrain", total_brain_volume), (vent_string, "Ventricle", vent_volume),
+               (dgm_string, "NonCortical", dgm_volume), (cgm_string, "Cortical", cgm_volume),
+               (wm_string, "WhiteMatter", wm_volume), (other_string, "Other", other_volume)]
 # END
 
 # CREATE CSV FILES
     f = open(malpem_report_file, 'wb+')
     f.write("ID,Structure,Volume [ml]\n")
-    f.write(total_brain_string + "," + "TotalBrain" + "," + str(total_brain_volume/1000) + "\n")
-    f.write(vent_string + "," + "Ventricle" + "," + str(vent_volume/1000) + "\n")
-    f.write(dgm_string + "," + "NonCortical" + "," + str(dgm_volume/1000) + "\n")
-    f.write(cgm_string + "," + "Cortical" + "," + str(cgm_volume/1000) + "\n")
-    f.write(wm_string + "," + "WhiteMatter" + "," + str(wm_volume/1000) + "\n")
-    f.write(other_string + "," + "Other" + "," + str(other_volume/1000) + "\n")
+    for ids, name, volume in summary:
+        f.write(ids + "," + name + "," + str(volume/1000) + "\n")
 
     for i in range(0, 139, 1):
         f.write(str(i) + "," + str(s_short[i]) + "," + str(float(s_volumes[i])/1000) + "\n")
     f.close()
 # END
 
+    # The pdf report uses the same volumes and structure names
+    return volumetrics, (s_id, s_short, s_long, s_side), summary
+
+
+def create_report(input_file, input_mask, input_seg_malpem, output_report, output_dir):
+# DEFINITIONS
+    # PAPER SIZE
+    left_start = 50
+    top_start = 800
+    right_stop = 550
+# END DEFINITIONS
+
+# CALCULATE STRUCTURAL VOLUMES AND CREATE CSV FILES
+    volumetrics, structure_names, summary = create_volume_report(input_seg_malpem, output_report, output_dir)
+    if output_format == "csv-only":
+        return volumetrics
+    s_id, s_short, s_long, s_side = structure_names
+    s_volumes = volumetrics.volumes[0:len(s_id)]
+
+    total_brain_string, total_brain_volume = summary[0][0], summary[0][2]
+    vent_string, vent_volume = summary[1][0], summary[1][2]
+    dgm_string, dgm_volume = summary[2][0], summary[2][2]
+    cgm_string, cgm_volume = summary[3][0], summary[3][2]
+    wm_string, wm_volume = summary[4][0], summary[4][2]
+    other_string, other_volume = summary[5][0], summary[5][2]
+# END
+
+# TAKE RELEVANT SCREENSHOTS (mask screenshots might have been taken while the segmentation was running)
+    screenshots_malpem = get_screenshot_files(output_report, output_dir, "MALPEM")
+    screenshots_mask = get_screenshot_files(output_report, output_dir, "mask")
+
+    if engine == "native":
+        malpem.mytools.check_ex_dir(os.path.join(output_dir, "report"))
+        render_screenshots(input_file, [(input_seg_malpem, "seg", screenshots_malpem),
+                                        (input_mask, "contour", screenshots_mask)])
+    else:
+        take_segmentation_screenshots(input_file, input_seg_malpem, output_report, output_dir)
+        take_mask_screenshots(input_file, input_mask, output_report, output_dir)
+# END
+
 ## START CREATING ACTUAL REPORT
+    # reportlab is only needed (and imported) for the pdf report
+    from reportlab.pdfgen import canvas
     c = canvas.Canvas(output_report)
     c.line(left_start, top_start, right_stop, top_start)
     c.drawString(left_start, top_start-10, "Report based on MALPEM pipeline")
@@ -0,0 +1,92 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Resource model of the pipeline stages: number of CPU threads and estimated peak memory of every task. The
+# scheduler only starts a task if its threads and memory fit into the budget and passes the thread count to the
+# binaries (OMP_NUM_THREADS, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS). Stages with more than one maximum thread get
+# the free threads once only a few tasks are left (e.g. the last registrations).
+#
+# The memory estimates are rough (bytes per voxel of the input image plus a constant), measured peaks of a previous
+# run (log/trace.jsonl) can be loaded instead with load_profile.
+
+import os
+import malpem.trace
+import malpem.label_fusion
+
+# Maximum number of threads of a task in the tail of the run
+tail_threads = 4
+
+# stage: (threads, scales to tail_threads, bytes per voxel, constant bytes)
+costs = {"N4": (1, True, 40, 100 * 1024 ** 2),
+         "mni": (1, True, 30, 200 * 1024 ** 2),
+         "brain-extraction": (1, False, 60, 500 * 1024 ** 2),
+         "pincram-prepare": (1, False, 8, 100 * 1024 ** 2),
+         "pincram-rigid": (1, True, 60, 300 * 1024 ** 2),
+         "pincram-affine": (1, True, 60, 300 * 1024 ** 2),
+         "pincram-nonrigid": (1, True, 60, 300 * 1024 ** 2),
+         "pincram-select": (1, True, 40, 200 * 1024 ** 2),
+         "atlas-selection-target": (1, False, 4, 200 * 1024 ** 2),
+         "atlas-selection": (1, False, 4, 200 * 1024 ** 2),
+         "register": (1, True, 60, 300 * 1024 ** 2),
+         "transform-image": (1, False, 16, 100 * 1024 ** 2),
+         "transform-labels": (1, False, 16, 100 * 1024 ** 2),
+         "transform": (1, False, 48, 200 * 1024 ** 2),
+         "malpem": (1, False, 2 * 4 * malpem.label_fusion.label_count + 16, 200 * 1024 ** 2),
+         "crop": (1, False, 12, 100 * 1024 ** 2),
+         "uncrop": (1, True, 16, 100 * 1024 ** 2),
+         "tissue-segmentation": (1, False, 16, 100 * 1024 ** 2),
+         "tissue-maps": (1, False, 40, 100 * 1024 ** 2),
+         "screenshots-mask": (1, False, 20, 200 * 1024 ** 2),
+         "report": (1, False, 20, 200 * 1024 ** 2)}
+default_cost = (1, False, 0, 100 * 1024 ** 2)
+
+# Measured peak memory [bytes] per stage (load_profile), used instead of the estimates
+profile = {}
+# Safety margin on top of the measured peak memory
+profile_margin = 1.2
+
+
+def get_physical_memory():
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def load_profile(trace_file):
+    # Peak memory of every stage in the execution trace of a previous run
+    for record in malpem.trace.read_records(trace_file):
+        if record["kind"] == "task" and record["exit_code"] == 0:
+            stage = record.get("stage", record["name"])
+            profile[stage] = max(profile.get(stage, 0), int(record["max_rss_mb"] * 1024 ** 2 * profile_margin))
+    return profile
+
+
+def get_cost(stage, voxels, atlas_count, pincram_threads=1):
+    # Returns threads, maximum threads and estimated memory [bytes] of a task of this stage
+    threads, scales, voxel_bytes, constant_bytes = costs.get(stage, default_cost)
+
+    if stage == "brain-extraction":
+        # pincram runs pincram_threads registrations at the same time
+        threads = int(pincram_threads)
+        constant_bytes *= threads
+        voxel_bytes *= threads
+    elif stage == "fusion":
+        if malpem.label_fusion.engine == "native":
+            # Slab buffers are limited, only the target is held completely
+            threads = malpem.label_fusion.fusion_threads
+            voxel_bytes = 8
+            constant_bytes = malpem.label_fusion.memory_limit + 200 * 1024 ** 2
+        else:
+            # All atlas images and labels, probability maps of all labels
+            voxel_bytes = 4 * malpem.label_fusion.label_count + 8 * atlas_count
+            constant_bytes = 200 * 1024 ** 2
+
+    memory = int(voxel_bytes * voxels + constant_bytes)
+    if stage in profile:
+        memory = profile[stage]
+
+    max_threads = threads
+    if scales:
+        max_threads = max(threads, tail_threads)
+    return threads, max_threads, memory
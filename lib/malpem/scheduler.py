@@ -0,0 +1,206 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+import os
+import traceback
+import Queue
+import multiprocessing
+
+# Seconds to wait for a finished task before checking for crashed worker processes
+poll_interval = 1.0
+
+# Environment variables that set the number of threads of the binaries started by a task
+thread_variables = ["OMP_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"]
+
+
+class Task(object):
+    def __init__(self, name, target, args, deps, group, threads=1, max_threads=1, memory=0):
+        self.name = name
+        self.group = group
+        self.target = target
+        self.args = args
+        self.deps = deps
+        # CPU threads (at least/at most, see Scheduler.get_threads) and estimated memory [bytes]
+        self.threads = threads
+        self.max_threads = max(threads, max_threads)
+        self.memory = memory
+        self.assigned_threads = threads
+        self.process = None
+        self.exitcode = None
+
+
+def execute_task(target, args, threads):
+    # Pipeline functions report errors with exit(1), translate this into an exit code for the scheduler
+    for variable in thread_variables:
+        os.environ[variable] = str(threads)
+
+    exitcode = 0
+    try:
+        target(*args)
+    except SystemExit as e:
+        if e.code is None:
+            exitcode = 0
+        elif isinstance(e.code, int):
+            exitcode = e.code
+        else:
+            exitcode = 1
+    except Exception:
+        traceback.print_exc()
+        exitcode = 1
+    return exitcode
+
+
+def run_task(result_queue, name, target, args, threads):
+    result_queue.put((name, execute_task(target, args, threads)))
+
+
+class Scheduler(object):
+    # Runs a graph of tasks with at most 'threads' CPU threads and (if memory_limit > 0) 'memory_limit' bytes of
+    # estimated memory in use. A task is started as soon as all tasks it depends on have finished successfully and
+    # it fits into the budget, tasks depending on a failed task are cancelled. A task that doesn't fit into the
+    # budget on its own is started once nothing else is running. Free worker slots are shared fairly between
+    # groups of tasks (e.g. subjects of a batch): the group with the fewest running tasks wins.
+    def __init__(self, threads, memory_limit=0):
+        self.threads = max(1, int(threads))
+        self.memory_limit = memory_limit
+        self.tasks = []
+        self.names = {}
+
+    def add(self, name, target, args, deps=None, group="", threads=1, max_threads=1, memory=0):
+        if name in self.names:
+            print("--- ERROR: Task has been scheduled twice (" + name + ") ---")
+            exit(1)
+
+        # Dependencies on tasks that were not scheduled (e.g. output exists already) are fulfilled by definition
+        task_deps = []
+        if deps is not None:
+            for dep in deps:
+                if dep is not None and dep in self.names:
+                    task_deps.append(dep)
+
+        threads = min(threads, self.threads)
+        task = Task(name, target, args, task_deps, group, threads, min(max_threads, self.threads), memory)
+        self.tasks.append(task)
+        self.names[name] = task
+        return name
+
+    def is_ready(self, task):
+        for dep in task.deps:
+            if self.names[dep].exitcode != 0:
+                return False
+        return True
+
+    def is_cancelled(self, task):
+        for dep in task.deps:
+            dep_task = self.names[dep]
+            if dep_task.exitcode is not None and dep_task.exitcode != 0:
+                return True
+        return False
+
+    def fits(self, task, running):
+        if len(running) == 0:
+            return True
+        if sum(t.assigned_threads for t in running) + task.threads > self.threads:
+            return False
+        if self.memory_limit > 0 and sum(t.memory for t in running) + task.memory > self.memory_limit:
+            return False
+        return True
+
+    def next_task(self, pending, running):
+        group_running = {}
+        for task in running:
+            group_running[task.group] = group_running.get(task.group, 0) + 1
+
+        best = None
+        for task in pending:
+            if self.is_ready(task) and self.fits(task, running):
+                if best is None or group_running.get(task.group, 0) < group_running.get(best.group, 0):
+                    best = task
+        return best
+
+    def get_threads(self, task, pending, running):
+        # The free threads are shared between the tasks that are ready, e.g. the last registrations of a run get
+        # more threads each (up to their maximum)
+        free_threads = self.threads - sum(t.assigned_threads for t in running)
+        ready = len([t for t in pending if self.is_ready(t)])
+        return max(task.threads, min(task.max_threads, free_threads / max(1, ready)))
+
+    def finish(self, task, exitcode, running):
+        task.exitcode = exitcode
+        task.process.join()
+        running.remove(task)
+        if exitcode != 0:
+            print("--- ERROR: Task failed (" + task.name + ", exit code " + str(exitcode) + ") ---")
+
+    def failed_tasks(self):
+        return [task for task in self.tasks if task.exitcode is not None and task.exitcode != 0]
+
+    def cancel_tasks(self, pending):
+        # Cancel tasks that can never run (propagates along the graph in insertion order)
+        for task in list(pending):
+            if self.is_cancelled(task):
+                print("Cancelling task (" + task.name + "): a task it depends on failed")
+                task.exitcode = -1
+                pending.remove(task)
+
+    def report(self):
+        failed = self.failed_tasks()
+        if len(failed) > 0:
+            print("--- ERROR: " + str(len(failed)) + " of " + str(len(self.tasks)) + " tasks failed or were cancelled ---")
+            return False
+
+        return True
+
+    def run(self):
+        if len(self.tasks) == 0:
+            return True
+
+        result_queue = multiprocessing.Queue()
+        pending = list(self.tasks)
+        running = []
+
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                self.cancel_tasks(pending)
+
+                # Start tasks whose inputs are ready while threads (and memory) are free
+                while True:
+                    task = self.next_task(pending, running)
+                    if task is None:
+                        break
+                    task.assigned_threads = self.get_threads(task, pending, running)
+                    task.process = multiprocessing.Process(target=run_task, args=(result_queue, task.name,
+                                                                                  task.target, task.args,
+                                                                                  task.assigned_threads))
+                    task.process.start()
+                    pending.remove(task)
+                    running.append(task)
+
+                if len(running) == 0:
+                    continue
+
+                try:
+                    name, exitcode = result_queue.get(True, poll_interval)
+                    self.finish(self.names[name], exitcode, running)
+                except Queue.Empty:
+                    # Worker processes that died without reporting back (e.g. killed) count as failed
+                    for task in list(running):
+                        if not task.process.is_alive() and task.exitcode is None:
+                            try:
+                                while True:
+                                    name, exitcode = result_queue.get_nowait()
+                                    self.finish(self.names[name], exitcode, running)
+                            except Queue.Empty:
+                                pass
+                            if task in running:
+                                self.finish(task, task.process.exitcode or 1, running)
+        except (KeyboardInterrupt, SystemExit):
+            # Don't leave workers behind (e.g. writing into a scratch directory that is removed)
+            for task in running:
+                task.process.terminate()
+            raise
+
+        return self.report()
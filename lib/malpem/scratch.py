@@ -0,0 +1,72 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Runs a subject in a working directory on local disk (or tmpfs) instead of the (network) output directory. The
+# results of a previous run are staged into the working directory so that a run can be resumed, and the declared
+# results are copied back atomically once the run has finished or failed.
+
+import os
+import shutil
+import tempfile
+
+# Below this amount of free space [bytes] in the scratch directory the output directory is used directly
+min_free_space = 10 * 1024 ** 3
+# Copy the atlas transformations (dofs/) back as well
+keep_dofs = False
+
+
+def get_free_space(directory):
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+
+def create(scratch_dir, name):
+    # Returns a new working directory in scratch_dir or "" if there isn't enough free space
+    if not os.path.isdir(scratch_dir):
+        os.makedirs(scratch_dir)
+
+    free_space = get_free_space(scratch_dir)
+    if free_space < min_free_space:
+        print("WARNING: Not using scratch directory " + scratch_dir + " (" + str(free_space / 1024 ** 2) +
+              " MB free, " + str(min_free_space / 1024 ** 2) + " MB required), working in the output directory")
+        return ""
+
+    return tempfile.mkdtemp(prefix="malpem-" + name + "-", dir=os.path.abspath(scratch_dir))
+
+
+def copy_atomic(source, destination):
+    tmp_file = os.path.join(os.path.dirname(destination), ".tmp-" + str(os.getpid()) + "-" +
+                            os.path.basename(destination))
+    shutil.copy2(source, tmp_file)
+    os.rename(tmp_file, destination)
+
+
+def copy_results(source_dir, destination_dir, results):
+    # Copies the files and directories (relative paths) that exist in source_dir, every file is renamed into place
+    # once complete so that an interrupted copy never leaves a truncated result behind
+    for result in results:
+        source = os.path.join(source_dir, result)
+        if os.path.isfile(source):
+            files = [result]
+        elif os.path.isdir(source):
+            files = []
+            for root, dirs, names in os.walk(source):
+                for name in names:
+                    if name.startswith(".tmp-"):
+                        continue
+                    files.append(os.path.relpath(os.path.join(root, name), source_dir))
+        else:
+            continue
+
+        for curfile in files:
+            destination = os.path.join(destination_dir, curfile)
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            copy_atomic(os.path.join(source_dir, curfile), destination)
+
+
+def remove(work_dir):
+    shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,45 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+import os
+import malpem.mytools
+
+# TISSUE CLASSES: ID, NAME OF TISSUE MAP, NAME IN REPORT (STRUCTURE IDs OF EACH CLASS ARE DEFINED IN etc/nmm_tissues.csv)
+tissue_classes = [(1, "ventricles", "Ventricle"),
+                  (2, "dGM", "NonCortical"),
+                  (3, "cGM", "Cortical"),
+                  (4, "WM", "WhiteMatter"),
+                  (5, "other", "Other")]
+
+
+def get_tissue_table():
+    # Returns a list where entry i is the tissue class of NMM structure i (0: background / not assigned)
+    tissue_file = os.path.join(malpem.mytools.__malpem_path__, "etc", "nmm_tissues.csv")
+    malpem.mytools.ensure_file(tissue_file, "tissue mapping")
+
+    structures = []
+    f = open(tissue_file)
+    for row in f:
+        row = row.strip()
+        if row == "" or row.startswith("#"):
+            continue
+        arr = row.split(',')
+        structures.append((int(arr[0]), int(arr[1])))
+    f.close()
+
+    table = [0] * (max([structure for structure, tissue in structures]) + 1)
+    for structure, tissue in structures:
+        table[structure] = tissue
+    return table
+
+
+def get_tissue_lists():
+    # Returns a dictionary with the list of NMM structure IDs for every tissue class ID
+    table = get_tissue_table()
+    tissue_lists = {}
+    for tissue_id, tissue_name, report_name in tissue_classes:
+        tissue_lists[tissue_id] = [i for i in range(len(table)) if table[i] == tissue_id]
+    return tissue_lists
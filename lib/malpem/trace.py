@@ -0,0 +1,221 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Execution timeline of a run. Every scheduler task, every stage (start_task/finished_task) and every external
+# command appends one JSON record to <output_dir>/log/trace.jsonl with wall time, exit code, CPU time, peak memory
+# and I/O, tagged with subject, stage and atlas. At the end of a run the records are converted into a Chrome trace
+# (chrome://tracing, trace.json) and a summary per stage (trace_summary.csv).
+
+import os
+import json
+import time
+import resource
+import subprocess
+
+# Records are appended to this file (no tracing if empty), tags are added to every record (set per task)
+__trace_file__ = ""
+__tags__ = {}
+
+# Resource usage snapshots of the stages that are currently running (innermost last)
+__open_stages__ = []
+
+
+def read_io():
+    # I/O of this process including all children it has waited for (Linux only)
+    counters = {}
+    try:
+        f = open("/proc/self/io")
+        for row in f:
+            key, value = row.split(":")
+            counters[key.strip()] = int(value)
+        f.close()
+    except (IOError, ValueError):
+        pass
+    return counters
+
+
+def get_usage():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"user": self_usage.ru_utime + children_usage.ru_utime,
+            "sys": self_usage.ru_stime + children_usage.ru_stime,
+            "max_rss": max(self_usage.ru_maxrss, children_usage.ru_maxrss),
+            "io": read_io()}
+
+
+def get_io_delta(io_before, io_after):
+    delta = {}
+    for key, name in [("read_bytes", "read_bytes"), ("write_bytes", "write_bytes"), ("rchar", "read_chars"),
+                      ("wchar", "write_chars")]:
+        if key in io_before and key in io_after:
+            delta[name] = io_after[key] - io_before[key]
+        else:
+            delta[name] = None
+    return delta
+
+
+def write_record(kind, name, start_time, end_time, exitcode, user_time, sys_time, max_rss, io_delta):
+    if __trace_file__ == "":
+        return
+
+    record = {"kind": kind, "name": name, "start": start_time, "end": end_time, "wall": end_time - start_time,
+              "exit_code": exitcode, "user": user_time, "sys": sys_time, "max_rss_mb": max_rss / 1024.0,
+              "pid": os.getpid()}
+    record.update(io_delta)
+    record.update(__tags__)
+
+    # One write per record, the file is shared by all worker processes of a subject
+    f = open(__trace_file__, "a")
+    f.write(json.dumps(record, sort_keys=True) + "\n")
+    f.close()
+
+
+def run_command(final_cmd, name):
+    # Runs a shell command like subprocess.call, the resource usage is that of the command and its children
+    start_time = time.time()
+    io_before = read_io()
+    process = subprocess.Popen(final_cmd, shell=True)
+    pid, status, usage = os.wait4(process.pid, 0)
+    end_time = time.time()
+    io_after = read_io()
+
+    if os.WIFEXITED(status):
+        exitcode = os.WEXITSTATUS(status)
+    else:
+        exitcode = -os.WTERMSIG(status)
+    process.returncode = exitcode
+
+    write_record("command", name, start_time, end_time, exitcode, usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+                 get_io_delta(io_before, io_after))
+    return exitcode
+
+
+def begin_stage(name):
+    __open_stages__.append((name, get_usage()))
+
+
+def end_stage(name, start_time):
+    # The peak memory of a stage is the peak of the process (and its children) up to the end of the stage
+    for i in reversed(range(len(__open_stages__))):
+        if __open_stages__[i][0] == name:
+            usage_before = __open_stages__.pop(i)[1]
+            usage_after = get_usage()
+            write_record("stage", name, start_time, time.time(), 0, usage_after["user"] - usage_before["user"],
+                         usage_after["sys"] - usage_before["sys"], usage_after["max_rss"],
+                         get_io_delta(usage_before["io"], usage_after["io"]))
+            return
+
+
+def run_traced(trace_file, tags, target, args):
+    # Scheduler task wrapper: sets the context of the records of this task and records the task itself
+    global __trace_file__, __tags__
+    __trace_file__ = trace_file
+    __tags__ = dict(tags)
+
+    start_time = time.time()
+    usage_before = get_usage()
+    exitcode = 1
+    try:
+        result = target(*args)
+        exitcode = 0
+        return result
+    except SystemExit as e:
+        exitcode = e.code if isinstance(e.code, int) else 1
+        raise
+    finally:
+        usage_after = get_usage()
+        write_record("task", tags.get("task", ""), start_time, time.time(), exitcode,
+                     usage_after["user"] - usage_before["user"], usage_after["sys"] - usage_before["sys"],
+                     usage_after["max_rss"], get_io_delta(usage_before["io"], usage_after["io"]))
+
+
+def read_records(trace_file):
+    records = []
+    f = open(trace_file)
+    for row in f:
+        row = row.strip()
+        if row:
+            records.append(json.loads(row))
+    f.close()
+    return records
+
+
+def write_timeline(records, output_file):
+    # Chrome trace event format: one row (thread) per worker process, nested stages and commands as stacked spans
+    events = []
+    thread_names = {}
+    for record in records:
+        if record["kind"] == "task":
+            thread_names[record["pid"]] = record["name"]
+        events.append({"name": record["name"], "cat": record["kind"], "ph": "X", "pid": 1, "tid": record["pid"],
+                       "ts": int(record["start"] * 1e6), "dur": int(record["wall"] * 1e6),
+                       "args": dict((key, record[key]) for key in record
+                                    if key not in ["name", "kind", "start", "end", "pid"])})
+    for pid in thread_names:
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": pid, "args": {"name": thread_names[pid]}})
+
+    f = open(output_file, "w")
+    json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    f.close()
+
+
+def get_summary(records):
+    # Per stage (scheduler task records): number of tasks, wall time, CPU time, peak memory, I/O
+    stages = {}
+    for record in records:
+        if not record["kind"] == "task":
+            continue
+        stage = record.get("stage", record["name"])
+        if stage not in stages:
+            stages[stage] = {"count": 0, "failed": 0, "wall": 0.0, "wall_max": 0.0, "straggler": "", "cpu": 0.0,
+                             "max_rss_mb": 0.0, "read_bytes": 0, "write_bytes": 0, "first": record["start"],
+                             "last": record["end"]}
+        summary = stages[stage]
+        summary["count"] += 1
+        summary["failed"] += int(not record["exit_code"] == 0)
+        summary["wall"] += record["wall"]
+        if record["wall"] >= summary["wall_max"]:
+            summary["wall_max"] = record["wall"]
+            summary["straggler"] = record.get("atlas", "") or record["name"]
+        summary["cpu"] += record["user"] + record["sys"]
+        summary["max_rss_mb"] = max(summary["max_rss_mb"], record["max_rss_mb"])
+        summary["read_bytes"] += record.get("read_bytes") or 0
+        summary["write_bytes"] += record.get("write_bytes") or 0
+        summary["first"] = min(summary["first"], record["start"])
+        summary["last"] = max(summary["last"], record["end"])
+    return stages
+
+
+def write_summary(records, output_file):
+    stages = get_summary(records)
+    order = sorted(stages.keys(), key=lambda stage: stages[stage]["first"])
+
+    columns = ["count", "failed", "wall", "wall_max", "straggler", "cpu", "max_rss_mb", "read_bytes", "write_bytes"]
+    f = open(output_file, "w")
+    f.write("Stage,Tasks,Failed,Wall time [s],Max. wall time [s],Slowest,CPU time [s],Peak memory [MB],"
+            "Read [bytes],Written [bytes],Elapsed [s]\n")
+    for stage in order:
+        summary = stages[stage]
+        f.write(stage + "," + ",".join(str(summary[column]) for column in columns) + "," +
+                str(summary["last"] - summary["first"]) + "\n")
+    f.close()
+
+    print("%-24s %6s %10s %10s %10s %10s" % ("Stage", "Tasks", "Wall [s]", "Max [s]", "CPU [s]", "Peak [MB]"))
+    for stage in order:
+        summary = stages[stage]
+        print("%-24s %6d %10.1f %10.1f %10.1f %10.0f" % (stage, summary["count"], summary["wall"],
+                                                         summary["wall_max"], summary["cpu"], summary["max_rss_mb"]))
+
+
+def write_reports(trace_file):
+    if not os.path.isfile(trace_file):
+        return False
+
+    records = read_records(trace_file)
+    log_dir = os.path.dirname(trace_file)
+    write_timeline(records, os.path.join(log_dir, "trace.json"))
+    write_summary(records, os.path.join(log_dir, "trace_summary.csv"))
+    return True
@@ -0,0 +1,62 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+import numpy
+import scipy.ndimage
+import malpem.imageio
+import malpem.tissues
+
+# Volumes are computed at least for these labels (background + 138 NMM structures)
+label_count = 139
+
+
+class Volumetrics(object):
+    # Per-label voxel counts, volumes [mm^3], bounding boxes and centroids of a label map, computed in one load
+    def __init__(self, input_seg):
+        seg, seg_image = malpem.imageio.load_image(input_seg)
+        seg = numpy.rint(seg).astype(numpy.int64)
+        seg[seg < 0] = 0
+
+        self.affine = seg_image.affine
+        zooms = seg_image.header.get_zooms()
+        self.voxel_volume = float(zooms[0] * zooms[1] * zooms[2])
+
+        labels = seg.ravel()
+        n = max(label_count, int(labels.max()) + 1)
+        self.counts = numpy.bincount(labels, minlength=n)
+        self.volumes = self.counts * self.voxel_volume
+
+        # Centroids (voxel coordinates) from coordinate weighted counts, NaN for labels that don't occur
+        self.centroids = numpy.zeros((n, 3))
+        for axis in range(3):
+            shape = [1, 1, 1]
+            shape[axis] = seg.shape[axis]
+            coords = numpy.broadcast_to(numpy.arange(seg.shape[axis]).reshape(shape), seg.shape[0:3])
+            coord_sums = numpy.bincount(labels, weights=coords.ravel(), minlength=n)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                self.centroids[:, axis] = coord_sums / self.counts
+
+        # Bounding boxes (voxel index ranges, inclusive), None for labels that don't occur
+        self.bounding_boxes = [None] * n
+        objects = scipy.ndimage.find_objects(seg.reshape(seg.shape[0:3]))
+        for i in range(len(objects)):
+            if objects[i] is not None:
+                self.bounding_boxes[i + 1] = [(int(s.start), int(s.stop) - 1) for s in objects[i]]
+
+    def get_centroids_world(self):
+        return numpy.dot(self.centroids, self.affine[0:3, 0:3].T) + self.affine[0:3, 3]
+
+    def get_tissue_volumes(self):
+        # Returns a dictionary tissue class ID -> volume [mm^3]
+        tissue_table = numpy.array(malpem.tissues.get_tissue_table())
+        n = min(len(tissue_table), len(self.volumes))
+        tissue_volumes = numpy.bincount(tissue_table[0:n], weights=self.volumes[0:n],
+                                        minlength=len(malpem.tissues.tissue_classes) + 1)
+
+        result = {}
+        for tissue_id, tissue_name, report_name in malpem.tissues.tissue_classes:
+            result[tissue_id] = float(tissue_volumes[tissue_id])
+        return result
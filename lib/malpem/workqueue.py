@@ -0,0 +1,333 @@
+# Author: Christian Ledig
+#         Imperial College London
+#
+#         see license file in project root directory
+
+
+# Execution of the task graph on several machines through a queue directory on a shared file system. The
+# coordinator (QueueScheduler, bin/malpem --queue) writes every task whose inputs are ready into <queue>/pending,
+# workers (bin/malpem-worker) on any node claim a task by renaming it into <queue>/running, run it and write its exit
+# code into <queue>/done. A worker touches <queue>/workers/<worker> while it is alive, tasks claimed by a worker
+# whose heartbeat is older than worker_timeout are put back into pending (at most max_attempts times).
+#
+# Tasks are pickled (module level function and arguments) together with the parameters of the loaded malpem
+# modules, workers therefore need the same MALPEM version and the same paths (installation, input and output).
+# Several local workers on one machine work the same way, e.g.
+#   bin/malpem-worker -q /shared/queue -t 8 &
+#   bin/malpem -i input.nii.gz -o /shared/out --queue /shared/queue -t 8
+
+import os
+import sys
+import time
+import json
+import signal
+import socket
+import cPickle
+import traceback
+import malpem.scheduler
+
+# Seconds between two scans of the queue directory
+poll_interval = 0.5
+# Seconds between two heartbeats of a worker, a worker without heartbeat for worker_timeout seconds is lost
+heartbeat_interval = 5.0
+worker_timeout = 60.0
+# Number of times a task is run before it counts as failed when its workers are lost
+max_attempts = 3
+
+queue_dirs = ["pending", "running", "done", "workers"]
+# Types of module parameters passed to the workers
+setting_types = (str, unicode, int, long, float, bool)
+ignored_settings = ["__name__", "__file__", "__doc__", "__package__"]
+
+
+def create_queue(queue_dir):
+    for sub_dir in queue_dirs:
+        path = os.path.join(queue_dir, sub_dir)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(path):
+                    raise
+
+
+def get_host_id():
+    # Unique name of this process, e.g. node01.12345
+    return socket.gethostname().replace("--", "-") + "." + str(os.getpid())
+
+
+def write_atomic(filename, data):
+    # Files appear complete in the queue, temporary files start with a dot and are ignored
+    tmp_file = os.path.join(os.path.dirname(filename), ".tmp-" + get_host_id() + "-" + os.path.basename(filename))
+    f = open(tmp_file, "wb")
+    f.write(data)
+    f.close()
+    os.rename(tmp_file, filename)
+
+
+def list_files(path, extension):
+    return sorted([name for name in os.listdir(path) if name.endswith(extension) and not name.startswith(".")])
+
+
+def get_task_file(seq, coordinator, task):
+    # <seq>-<coordinator>-<threads>-<max threads>-<memory MB>.task: workers choose tasks without reading them, the
+    # sequence number first interleaves the tasks of several coordinators
+    return "%06d-%s-%d-%d-%d.task" % (seq, coordinator, task.threads, task.max_threads, task.memory / 1024 ** 2)
+
+
+def parse_task_file(task_file):
+    # Returns threads, maximum threads and memory [bytes] of a task
+    threads, max_threads, memory = task_file[:-len(".task")].rsplit("-", 3)[1:]
+    return int(threads), int(max_threads), int(memory) * 1024 ** 2
+
+
+def get_settings():
+    # Parameters of all loaded malpem modules (set by the command line of the coordinator)
+    settings = {}
+    for module_name, module in sys.modules.items():
+        if module is None or not module_name.startswith("malpem."):
+            continue
+        for name, value in vars(module).items():
+            if name not in ignored_settings and isinstance(value, setting_types):
+                settings[module_name + ":" + name] = value
+    return settings
+
+
+def apply_settings(settings):
+    for key in settings:
+        module_name, name = key.split(":", 1)
+        __import__(module_name)
+        setattr(sys.modules[module_name], name, settings[key])
+
+
+class QueueScheduler(malpem.scheduler.Scheduler):
+    # Same task graph as Scheduler, but the tasks run on the workers of the queue directory. The thread and memory
+    # budgets are those of the workers, 'threads' only limits the threads of a single task.
+    def __init__(self, queue_dir, threads, memory_limit=0):
+        malpem.scheduler.Scheduler.__init__(self, threads, memory_limit)
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.coordinator = get_host_id()
+        self.seq = 0
+
+    def get_path(self, sub_dir, name):
+        return os.path.join(self.queue_dir, sub_dir, name)
+
+    def publish(self, task, settings):
+        self.seq += 1
+        task.file = get_task_file(self.seq, self.coordinator, task)
+        task.attempts = 1
+        data = cPickle.dumps({"name": task.name, "target": task.target, "args": task.args, "settings": settings}, 2)
+        write_atomic(self.get_path("pending", task.file), data)
+
+    def collect(self, published):
+        # Tasks with an exit code in <queue>/done
+        for task in list(published):
+            result_file = self.get_path("done", task.file + ".result")
+            if not os.path.isfile(result_file):
+                continue
+
+            f = open(result_file)
+            result = json.load(f)
+            f.close()
+            os.remove(result_file)
+
+            task.exitcode = result["exit_code"]
+            published.remove(task)
+            if task.exitcode != 0:
+                print("--- ERROR: Task failed (" + task.name + " on " + result["worker"] + ", exit code " +
+                      str(task.exitcode) + ") ---")
+
+    def requeue(self, published):
+        # Tasks claimed by workers without heartbeat are put back into pending
+        tasks = dict((task.file, task) for task in published)
+        now = time.time()
+        for claimed in list_files(os.path.join(self.queue_dir, "running"), ".task"):
+            worker, task_file = claimed.split("--", 1)
+            if task_file not in tasks:
+                continue
+            try:
+                age = now - os.stat(self.get_path("workers", worker)).st_mtime
+            except OSError:
+                # Worker stopped
+                age = worker_timeout + 1
+            if age <= worker_timeout or os.path.isfile(self.get_path("done", task_file + ".result")):
+                continue
+
+            task = tasks[task_file]
+            if task.attempts >= max_attempts:
+                print("--- ERROR: Task failed (" + task.name + "), lost " + str(task.attempts) + " workers ---")
+                os.remove(self.get_path("running", claimed))
+                task.exitcode = 1
+                published.remove(task)
+            else:
+                print("Worker " + worker + " lost, requeueing task (" + task.name + ")")
+                task.attempts += 1
+                os.rename(self.get_path("running", claimed), self.get_path("pending", task_file))
+
+            try:
+                os.remove(self.get_path("workers", worker))
+            except OSError:
+                pass
+
+    def run(self):
+        if len(self.tasks) == 0:
+            return True
+
+        create_queue(self.queue_dir)
+        settings = get_settings()
+        pending = list(self.tasks)
+        published = []
+        waiting = False
+
+        try:
+            while len(pending) > 0 or len(published) > 0:
+                self.cancel_tasks(pending)
+
+                if len(list_files(os.path.join(self.queue_dir, "workers"), "")) == 0:
+                    if not waiting:
+                        print("Waiting for workers (bin/malpem-worker -q " + self.queue_dir + ")")
+                    waiting = True
+                else:
+                    waiting = False
+
+                for task in list(pending):
+                    if self.is_ready(task):
+                        self.publish(task, settings)
+                        pending.remove(task)
+                        published.append(task)
+
+                self.collect(published)
+                self.requeue(published)
+                if len(published) > 0:
+                    time.sleep(poll_interval)
+        except (KeyboardInterrupt, SystemExit):
+            # Withdraw the tasks that no worker has claimed yet
+            for task in published:
+                try:
+                    os.remove(self.get_path("pending", task.file))
+                except OSError:
+                    pass
+            raise
+
+        return self.report()
+
+
+def stop(signum, frame):
+    exit(1)
+
+
+def run_claimed(task_file, threads):
+    f = open(task_file, "rb")
+    task = cPickle.load(f)
+    f.close()
+
+    apply_settings(task["settings"])
+    print("Running task (" + task["name"] + ") with " + str(threads) + " thread(s)")
+    return malpem.scheduler.execute_task(task["target"], task["args"], threads)
+
+
+class Worker(object):
+    # Runs the tasks of a queue directory with at most 'threads' CPU threads and (if memory_limit > 0)
+    # 'memory_limit' bytes of estimated memory, every task in a forked process
+    def __init__(self, queue_dir, threads, memory_limit=0):
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.threads = max(1, int(threads))
+        self.memory_limit = memory_limit
+        self.id = get_host_id()
+        self.heartbeat_file = os.path.join(self.queue_dir, "workers", self.id)
+        self.last_heartbeat = 0
+        # pid: (task file, claimed file, threads, memory)
+        self.running = {}
+
+    def heartbeat(self):
+        if time.time() - self.last_heartbeat >= heartbeat_interval:
+            f = open(self.heartbeat_file, "w")
+            f.write(str(len(self.running)) + " running\n")
+            f.close()
+            self.last_heartbeat = time.time()
+
+    def reap(self):
+        while len(self.running) > 0:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            task_file, claimed, threads, memory = self.running.pop(pid)
+            exitcode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+
+            result = {"exit_code": exitcode, "worker": self.id}
+            write_atomic(os.path.join(self.queue_dir, "done", task_file + ".result"), json.dumps(result))
+            try:
+                os.remove(os.path.join(self.queue_dir, "running", claimed))
+            except OSError:
+                # Requeued by the coordinator in the meantime
+                pass
+
+    def claim(self):
+        # Claims the first pending task that fits into the free threads and memory, returns False if there is none
+        used_threads = sum(entry[2] for entry in self.running.values())
+        used_memory = sum(entry[3] for entry in self.running.values())
+        pending = list_files(os.path.join(self.queue_dir, "pending"), ".task")
+
+        for task_file in pending:
+            threads, max_threads, memory = parse_task_file(task_file)
+            if len(self.running) > 0:
+                if used_threads + threads > self.threads:
+                    continue
+                if self.memory_limit > 0 and used_memory + memory > self.memory_limit:
+                    continue
+
+            claimed = self.id + "--" + task_file
+            try:
+                os.rename(os.path.join(self.queue_dir, "pending", task_file),
+                          os.path.join(self.queue_dir, "running", claimed))
+            except OSError:
+                # Claimed by another worker
+                continue
+
+            # The free threads are shared between the pending tasks (see Scheduler.get_threads)
+            threads = max(threads, min(max_threads, (self.threads - used_threads) / max(1, len(pending))))
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                exitcode = 1
+                try:
+                    exitcode = run_claimed(os.path.join(self.queue_dir, "running", claimed), threads)
+                except Exception:
+                    traceback.print_exc()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exitcode)
+            self.running[pid] = (task_file, claimed, threads, memory)
+            return True
+        return False
+
+    def run(self, idle_timeout=0):
+        # Works until it is stopped or, if idle_timeout > 0, nothing ran for idle_timeout seconds
+        create_queue(self.queue_dir)
+        signal.signal(signal.SIGTERM, stop)
+        print("Worker " + self.id + ": " + str(self.threads) + " thread(s), queue " + self.queue_dir)
+        idle_since = time.time()
+
+        try:
+            while True:
+                self.heartbeat()
+                self.reap()
+                while self.claim():
+                    pass
+
+                if len(self.running) > 0:
+                    idle_since = time.time()
+                elif idle_timeout > 0 and time.time() - idle_since > idle_timeout:
+                    break
+                time.sleep(poll_interval)
+        finally:
+            # Running tasks are stopped, the coordinator requeues them as the heartbeat disappears
+            for pid in self.running:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            if os.path.isfile(self.heartbeat_file):
+                os.remove(self.heartbeat_file)
@@ -54,6 +54,8 @@ echo "-ref        : Reference label against which to log Jaccard overlap results
 echo 
 echo "-par        : Number of jobs to run in parallel (shell level).  Please use with consideration."
 echo 
+echo "-ext        : File extension of the intermediate images, e.g. .nii for uncompressed files (default: .nii.gz)"
+echo 
 fatal "Parameter error"
 }
 
@@ -72,6 +74,7 @@ atlasdir=$(normalpath "$cdir"/atlas)
 atlasn=0
 tdbase="$cdir"/temp
 outdir=notspecified
+ext=.nii.gz
 while [ $# -gt 0 ]
 do
     case "$1" in
@@ -87,6 +90,7 @@ do
 	-excludeatlas)  exclude="$2"; shift;;
 	-par)               par="$2"; shift;;
 	-queue)           queue="$2"; shift;;
+	-ext)               ext="$2"; shift;;
 	--) shift; break;;
         -*)
             usage;;
@@ -117,6 +121,8 @@ maxlevel=$[$levels-1]
 
 [[ $queue =~ ^[[:alpha:]]+$ ]] || queue=
 
+[[ "$ext" =~ ^\.nii(\.gz)?$ ]] || ext=.nii.gz
+
 echo "Extracting $tgt"
 echo "Writing brain label to $result"
 
@@ -182,9 +188,9 @@ reg () {
 
 assess() {
     local glabels="$1"
-    if [ -e ref.nii.gz ] ; then 
-	transformation "$glabels" assess.nii.gz -target ref.nii.gz >>noisy.log 2>&1
-	echo -e "$glabels:\t\t"$(labelStats ref.nii.gz assess.nii.gz -q | cut -d ',' -f 1)
+    if [ -e ref$ext ] ; then 
+	transformation "$glabels" assess$ext -target ref$ext >>noisy.log 2>&1
+	echo -e "$glabels:\t\t"$(labelStats ref$ext assess$ext -q | cut -d ',' -f 1)
     fi
     return 0
 }
@@ -199,9 +205,9 @@ echo "$commandline" >commandline.log
 
 # Target preparation
 originalorigin=$(info "$tgt" | grep origin | cut -d ' ' -f 4-6)
-headertool "$tgt" target-full.nii.gz -origin 0 0 0 
-convert "$tgt" target-full.nii.gz -float
-[ -e "$ref" ] && cp "$ref" ref.nii.gz
+headertool "$tgt" target-full$ext -origin 0 0 0 
+convert "$tgt" target-full$ext -float
+[ -e "$ref" ] && cp "$ref" ref$ext
 
 # Arrays
 levelname[0]="rigid"
@@ -218,7 +224,7 @@ thr[1]=60
 thr[2]=40
 
 # Initialize first loop
-tgt="$PWD"/target-full.nii.gz
+tgt="$PWD"/target-full$ext
 prevlevel=init
 seq 1 $atlasn | grep -vw $exclude >selection-$prevlevel.csv
 nselected=$(cat selection-$prevlevel.csv | wc -l)
@@ -233,9 +239,9 @@ for level in $(seq 0 $maxlevel) ; do
 	sourcenii=m$srcindex.nii.gz
 	src="$atlasdir"/limages/full/$sourcenii
 	[ $level -ge 2 ] && src="$atlasdir"/limages/margin-d5/$sourcenii
-	srctr="$PWD"/srctr-$thislevel-s$srcindex.nii.gz
+	srctr="$PWD"/srctr-$thislevel-s$srcindex$ext
 	msk="$atlasdir"/lmasks/full/$sourcenii
-	masktr="$PWD"/masktr-$thislevel-s$srcindex.nii.gz
+	masktr="$PWD"/masktr-$thislevel-s$srcindex$ext
 	dofin="$PWD"/reg-s$srcindex-$prevlevel.dof.gz 
 	dofout="$PWD"/reg-s$srcindex-$thislevel.dof.gz
 	spn="$atlasdir"/mninorm/m$srcindex.dof.gz
@@ -251,20 +257,20 @@ for level in $(seq 0 $maxlevel) ; do
     set -- $(ls masktr-$thislevel-s*)
     thissize=$#
     set -- $(echo $@ | sed 's/ / -add /g')
-    seg_maths $@ -div $thissize tmask-$thislevel-atlas.nii.gz
-    seg_maths tmask-$thislevel-atlas.nii.gz -thr 0.$thisthr -bin tmask-$thislevel.nii.gz 
-    dilation tmask-$thislevel.nii.gz tmask-$thislevel-wide.nii.gz -iterations 1 >>noisy.log 2>&1
-    erosion tmask-$thislevel.nii.gz tmask-$thislevel-narrow.nii.gz -iterations 1 >>noisy.log 2>&1
-    subtract tmask-$thislevel-wide.nii.gz tmask-$thislevel-narrow.nii.gz emargin-$thislevel.nii.gz >>noisy.log 2>&1
-    dilation emargin-$thislevel.nii.gz emargin-$thislevel-dil.nii.gz -iterations 3 >>noisy.log 2>&1
-    padding target-full.nii.gz emargin-$thislevel-dil.nii.gz emasked-$thislevel.nii.gz 0 0
-    assess tmask-$thislevel.nii.gz
+    seg_maths $@ -div $thissize tmask-$thislevel-atlas$ext
+    seg_maths tmask-$thislevel-atlas$ext -thr 0.$thisthr -bin tmask-$thislevel$ext 
+    dilation tmask-$thislevel$ext tmask-$thislevel-wide$ext -iterations 1 >>noisy.log 2>&1
+    erosion tmask-$thislevel$ext tmask-$thislevel-narrow$ext -iterations 1 >>noisy.log 2>&1
+    subtract tmask-$thislevel-wide$ext tmask-$thislevel-narrow$ext emargin-$thislevel$ext >>noisy.log 2>&1
+    dilation emargin-$thislevel$ext emargin-$thislevel-dil$ext -iterations 3 >>noisy.log 2>&1
+    padding target-full$ext emargin-$thislevel-dil$ext emasked-$thislevel$ext 0 0
+    assess tmask-$thislevel$ext
 # Selection
     echo "Selecting"
     for srcindex in $(cat selection-init.csv) ; do
-	srctr="$PWD"/srctr-$thislevel-s$srcindex.nii.gz
+	srctr="$PWD"/srctr-$thislevel-s$srcindex$ext
 	if [ -e $srctr ] ; then
-	    echo $(evaluation emasked-$thislevel.nii.gz $srctr -Tp 0 -mask emargin-$thislevel-dil.nii.gz -linear | grep NMI | cut -d ' ' -f 2 )",$srcindex"
+	    echo $(evaluation emasked-$thislevel$ext $srctr -Tp 0 -mask emargin-$thislevel-dil$ext -linear | grep NMI | cut -d ' ' -f 2 )",$srcindex"
 	fi
     done | sort -rn | tee simm-$thislevel.csv | cut -d , -f 2 > ranking-$thislevel.csv
     nselected=$[$thissize*$usepercent/100]
@@ -274,24 +280,24 @@ for level in $(seq 0 $maxlevel) ; do
     [ -e xab ] && cat x?? > unselected-$thislevel.csv 
     echo "Selected $nselected at $thislevel"
 # Build label from selection 
-    set -- $(head -n 19 selection-$thislevel.csv | while read -r item ; do echo masktr-$thislevel-s$item.nii.gz ; done)
+    set -- $(head -n 19 selection-$thislevel.csv | while read -r item ; do echo masktr-$thislevel-s$item$ext ; done)
     thissize=$#
     set -- $(echo $@ | sed 's/ / -add /g')
-    seg_maths $@ -div $thissize tmask-$thislevel-sel-atlas.nii.gz 
-    seg_maths tmask-$thislevel-sel-atlas.nii.gz -thr 0.$thisthr -bin tmask-$thislevel-sel.nii.gz 
-    assess tmask-$thislevel-sel.nii.gz
+    seg_maths $@ -div $thissize tmask-$thislevel-sel-atlas$ext 
+    seg_maths tmask-$thislevel-sel-atlas$ext -thr 0.$thisthr -bin tmask-$thislevel-sel$ext 
+    assess tmask-$thislevel-sel$ext
 # Data mask (skip on last iteration)
     [ $level -eq $maxlevel ] && continue
-    seg_maths tmask-$thislevel-sel-atlas.nii.gz -thr 0.15 -bin tmask-$thislevel-wide.nii.gz
-    seg_maths tmask-$thislevel-sel-atlas.nii.gz -thr 0.99 -bin tmask-$thislevel-narrow.nii.gz
-    subtract tmask-$thislevel-wide.nii.gz tmask-$thislevel-narrow.nii.gz dmargin-$thislevel.nii.gz -no_norm >>noisy.log 2>&1
-    dilation dmargin-$thislevel.nii.gz dmargin-$thislevel-dil.nii.gz -iterations ${dmaskdil[$level]} >>noisy.log 2>&1
-    padding target-full.nii.gz dmargin-$thislevel-dil.nii.gz dmasked-$thislevel.nii.gz 0 0
-    tgt="$PWD"/dmasked-$thislevel.nii.gz
+    seg_maths tmask-$thislevel-sel-atlas$ext -thr 0.15 -bin tmask-$thislevel-wide$ext
+    seg_maths tmask-$thislevel-sel-atlas$ext -thr 0.99 -bin tmask-$thislevel-narrow$ext
+    subtract tmask-$thislevel-wide$ext tmask-$thislevel-narrow$ext dmargin-$thislevel$ext -no_norm >>noisy.log 2>&1
+    dilation dmargin-$thislevel$ext dmargin-$thislevel-dil$ext -iterations ${dmaskdil[$level]} >>noisy.log 2>&1
+    padding target-full$ext dmargin-$thislevel-dil$ext dmasked-$thislevel$ext 0 0
+    tgt="$PWD"/dmasked-$thislevel$ext
     prevlevel=$thislevel
 done
 
-convert tmask-$thislevel-sel.nii.gz output.nii.gz -short >>noisy.log 2>&1
-headertool output.nii.gz "$result" -origin $originalorigin
+convert tmask-$thislevel-sel$ext output$ext -short >>noisy.log 2>&1
+headertool output$ext "$result" -origin $originalorigin
 
 exit 0